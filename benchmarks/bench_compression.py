@@ -0,0 +1,143 @@
+"""
+Bytes on the wire and CPU time per message for protocol v2 compression.
+
+Two workloads, encoded with protocol.BinaryCodec exactly as the server sends them:
+
+  * single messages (one MESSAGE frame each) of several sizes, either chat-like
+    text or PGP-armored base64 like the encrypted bodies the README plans for
+  * a long history pulled with /open, sent as HISTORY pages of 100 messages
+
+each uncompressed, with "zlib", and with "zlib" plus the preset dictionary. For
+history, "per page" compresses every page on its own, for comparison with the
+stream that spans all the pages. CPU time is the sender's encode and the
+receiver's decode, per message.
+
+Usage: python benchmarks/bench_compression.py [--sizes 64 256 1024 4096 16384]
+       [--count 2000] [--history 1000] [--threshold 512] [--level 6]
+"""
+
+import argparse
+import base64
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from messages import Message
+from protocol import BinaryCodec, Deflate, Inflate, HEADER, COMPRESS_LEVEL, decode_payload
+
+WORDS = ("the be to of and a in that have I it for not on with you do at this but we say what so up out if "
+         "about who get which go me when make can like time no just know take people into good some see "
+         "meeting tomorrow lunch code review deploy server client message thanks lol ok sure").split()
+
+
+def chat_text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+def armored_text(rng, size):
+    # Ciphertext is random, so only the armor and base64's smaller alphabet help
+    raw = bytes(rng.getrandbits(8) for _ in range(max(1, size * 3 // 4 - 60)))
+    body = base64.b64encode(raw).decode()
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    return "-----BEGIN PGP MESSAGE-----\n\n" + "\n".join(lines) + "\n-----END PGP MESSAGE-----\n"
+
+
+def split_frames(data):
+    offset = 0
+    while offset < len(data):
+        length, _, flags, _ = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        yield flags, data[start:start + length]
+        offset = start + length
+
+
+VARIANTS = (("none", None), ("zlib", False), ("zdict", True))
+
+
+def make_codec(zdict, threshold, level):
+    return BinaryCodec(None if zdict is None else Deflate(zdict, threshold, level))
+
+
+def bench_messages(kind, make_text, size, count, threshold, level):
+    rng = random.Random(size)
+    msgs = [Message("alice", make_text(rng, size), datetime.now(), seq) for seq in range(count)]
+    row = [f"{kind:<8} {size:>6}"]
+    for name, zdict in VARIANTS:
+        codec = make_codec(zdict, threshold, level)
+        inflate = Inflate(bool(zdict))
+        start = time.perf_counter()
+        frames = [codec.messages("alice", 1, [msg]) for msg in msgs]
+        encode = time.perf_counter() - start
+        start = time.perf_counter()
+        for frame in frames:
+            for flags, payload in split_frames(frame):
+                decode_payload(flags, payload, inflate)
+        decode = time.perf_counter() - start
+        wire = sum(map(len, frames)) / count
+        row.append(f"{wire:>8.0f} B {encode / count * 1e6:6.1f}+{decode / count * 1e6:5.1f} us")
+    print("  ".join(row))
+
+
+def bench_history(count, threshold, level):
+    rng = random.Random(0)
+    msgs = [Message(rng.choice(("alice", "bob")), chat_text(rng, rng.randint(10, 120)), datetime.now(), seq)
+            for seq in range(count)]
+    pages = [msgs[i:i + 100] for i in range(0, count, 100)]
+    print(f"\n/open of {count} chat messages in {len(pages)} HISTORY pages")
+    print(f"{'':<18} {'bytes':>9}  {'encode':>10}  {'decode':>10}")
+    cases = [("none", None, False)]
+    for name, zdict in VARIANTS[1:]:
+        cases += [(f"{name} per page", zdict, False), (f"{name} stream", zdict, True)]
+    for name, zdict, stream in cases:
+        codec = make_codec(zdict, threshold, level)
+        inflate = Inflate(bool(zdict))
+        start = time.perf_counter()
+        data = []
+        for i, page in enumerate(pages):
+            if zdict is None or stream:
+                # What the server sends: the pages of a reply share one stream
+                data.append(codec.history_page("bob", page, 0, count, count, count, None, None,
+                                               first=i == 0, last=i == len(pages) - 1))
+            else:
+                data.append(codec.history_page("bob", page, 0, count, count, count, None, None,
+                                               first=True, last=True))
+        encode = time.perf_counter() - start
+        start = time.perf_counter()
+        for frame in data:
+            for flags, payload in split_frames(frame):
+                decode_payload(flags, payload, inflate)
+        decode = time.perf_counter() - start
+        print(f"{name:<18} {sum(map(len, data)):>9,}  {encode / count * 1e6:7.2f} us  {decode / count * 1e6:7.2f} us"
+              f"  per message")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 256, 1024, 4096, 16384])
+    parser.add_argument("--count", type=int, default=2000, help="messages per size")
+    parser.add_argument("--history", type=int, default=1000, help="messages in the /open benchmark")
+    parser.add_argument("--threshold", type=int, default=512,
+                        help="smallest payload compressed (0 to compress everything)")
+    parser.add_argument("--level", type=int, default=COMPRESS_LEVEL, help="zlib level, 1-9")
+    args = parser.parse_args()
+    print(f"Single MESSAGE frames, level {args.level}, threshold {args.threshold} bytes: wire bytes per message, "
+          f"encode+decode CPU per message")
+    print(f"{'body':<8} {'size':>6}  " + "  ".join(f"{name:<24}" for name, _ in VARIANTS))
+    for kind, make_text in (("chat", chat_text), ("armored", armored_text)):
+        for size in args.sizes:
+            bench_messages(kind, make_text, size, args.count, args.threshold, args.level)
+    bench_history(args.history, args.threshold, args.level)
+
+
+if __name__ == "__main__":
+    main()
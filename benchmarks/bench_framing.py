@@ -0,0 +1,91 @@
+"""
+Micro-benchmark for line framing: the old byte-at-a-time reader against
+framing.LineReader. Counts recv syscalls and measures lines per second
+over a local socketpair.
+
+Usage: python benchmarks/bench_framing.py [lines] [line_size]
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from framing import LineReader
+
+
+class CountingSocket:
+    """Wraps a socket and counts how many recv calls reach the kernel."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def recv(self, size):
+        self.calls += 1
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer):
+        self.calls += 1
+        return self.sock.recv_into(buffer)
+
+
+def legacy_recv_line(conn):
+    # The reader server.py and client.py used before framing.py existed
+    message = b""
+    while True:
+        chunk = conn.recv(1)
+        if not chunk:
+            return None
+        if chunk == b'\n':
+            return message
+        message += chunk
+
+
+def writer(sock, payload, count):
+    for _ in range(count):
+        sock.sendall(payload)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def run(name, read_line, count, line_size):
+    left, right = socket.socketpair()
+    payload = b"bob: " + b"x" * (line_size - 5) + b"\n"
+    counting = CountingSocket(right)
+    read = read_line(counting)
+
+    thread = threading.Thread(target=writer, args=(left, payload, count), daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    lines = 0
+    while True:
+        line = read()
+        if line is None:
+            break
+        assert len(line) == line_size
+        lines += 1
+    elapsed = time.perf_counter() - start
+    thread.join()
+    left.close()
+    right.close()
+
+    assert lines == count
+    print(f"{name:<10} {lines:>8} lines  {counting.calls:>9} recv calls  "
+          f"{counting.calls / lines:>7.3f} calls/line  {lines / elapsed:>12,.0f} lines/s  "
+          f"{lines * line_size / elapsed / 1e6:>8.1f} MB/s")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    line_size = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+
+    print(f"Framing benchmark: {count} lines of {line_size} bytes")
+    run("legacy", lambda s: (lambda: legacy_recv_line(s)), count, line_size)
+    run("buffered", lambda s: LineReader(s).read_line, count, line_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Hot restarts under load: the server is restarted over and over (SIGUSR2, see
+hotrestart.py) while pairs of clients chat and new clients keep logging in.
+
+Every chat message carries a per-sender counter, so each receiver can check it
+got every message its partner sent, in order and exactly once. The run fails
+(exit status 1) if any message is lost, duplicated or reordered, if any client
+is disconnected, or if any new login fails; otherwise it reports how long each
+handover took and the delivery latency, whose tail is the clients' pause
+during the restarts.
+
+Usage: python benchmarks/bench_hot_restart.py [--pairs 100] [--rate 10] [--restarts 5]
+       [--interval 2] [--mode threaded|asyncio] [--server-env NAME=VALUE ...]
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def read_pid(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def wait_for_pid(path, old, timeout=30.0):
+    """Wait until the pid file names a process other than old; returns the new pid."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pid = read_pid(path)
+        if pid and pid != old:
+            return pid
+        time.sleep(0.005)
+    raise RuntimeError(f"no new server process took over from {old}")
+
+
+class Client:
+    """A logged-in text client that sends numbered messages to its partner and checks what it gets back."""
+
+    def __init__(self, name, partner):
+        self.name = name
+        self.partner = partner
+        self.sent = 0
+        self.acked = 0
+        self.received = []
+        self.latencies = []
+        self.errors = []
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        self.writer.write(f"{self.name}\n".encode())
+        line = await self.reader.readline()
+        if not line.startswith(b"Welcome"):
+            raise RuntimeError(f"{self.name} couldn't log in: {line!r}")
+
+    async def send(self, rate, stop):
+        while not stop.is_set():
+            self.writer.write(f"{self.partner}: {self.sent} {time.time()}\n".encode())
+            self.sent += 1
+            await self.writer.drain()
+            await asyncio.sleep(1 / rate)
+
+    async def read(self):
+        prefix = f"[from {self.partner}]: ".encode()
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                self.errors.append("disconnected")
+                return
+            if line.startswith(prefix):
+                counter, sent_at = line[len(prefix):].split()
+                self.received.append(int(counter))
+                self.latencies.append(time.time() - float(sent_at))
+            elif line.startswith(b"Message sent"):
+                self.acked += 1
+            elif line.startswith(b"("):
+                # "(N earlier messages ...)": fell behind, and live delivery skipped some
+                self.errors.append(line.decode().strip())
+
+    def check(self, partner):
+        problems = list(self.errors)
+        if self.received != list(range(partner.sent)):
+            missing = len(set(range(partner.sent)) - set(self.received))
+            extra = len(self.received) - len(set(self.received))
+            problems.append(f"got {len(self.received)} of {partner.sent} messages "
+                            f"({missing} missing, {extra} duplicated, in order: {self.received == sorted(self.received)})")
+        if self.acked != self.sent:
+            problems.append(f"{self.acked} of {self.sent} sends acknowledged")
+        return problems
+
+
+async def logins(port, stop, stats):
+    """New clients logging in throughout, to check the listening socket keeps accepting."""
+    while not stop.is_set():
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"visitor{stats['logins']}\n".encode())
+            line = await asyncio.wait_for(reader.readline(), 30)
+            if not line.startswith(b"Welcome"):
+                stats["failed"].append(line.decode().strip() or "closed")
+            stats["logins"] += 1
+            writer.close()
+        except (OSError, asyncio.TimeoutError) as e:
+            stats["failed"].append(repr(e))
+        await asyncio.sleep(0.05)
+
+
+async def run(port, pid_file, args):
+    clients = []
+    for i in range(args.pairs):
+        clients += [Client(f"a{i}", f"b{i}"), Client(f"b{i}", f"a{i}")]
+    for client in clients:
+        await client.connect(port)
+    by_name = {client.name: client for client in clients}
+
+    stop = asyncio.Event()
+    readers = [asyncio.ensure_future(client.read()) for client in clients]
+    senders = [asyncio.ensure_future(client.send(args.rate, stop)) for client in clients]
+    login_stats = {"logins": 0, "failed": []}
+    visitor = asyncio.ensure_future(logins(port, stop, login_stats))
+
+    handovers = []
+    loop = asyncio.get_running_loop()
+    for _ in range(args.restarts):
+        await asyncio.sleep(args.interval)
+        old = read_pid(pid_file)
+        start = time.perf_counter()
+        os.kill(old, signal.SIGUSR2)
+        await loop.run_in_executor(None, wait_for_pid, pid_file, old)
+        handovers.append(time.perf_counter() - start)
+    await asyncio.sleep(args.interval)
+
+    stop.set()
+    await asyncio.gather(*senders, visitor)
+    # Let the last messages arrive
+    await asyncio.sleep(2.0)
+    for task in readers:
+        task.cancel()
+    for client in clients:
+        client.writer.close()
+
+    problems = []
+    for client in clients:
+        problems += [f"{client.name}: {problem}" for problem in client.check(by_name[client.partner])]
+    problems += [f"new login failed: {failure}" for failure in login_stats["failed"]]
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    return problems, handovers, latencies, sum(client.sent for client in clients), login_stats["logins"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pairs", type=int, default=100, help="pairs of clients chatting")
+    parser.add_argument("--rate", type=float, default=10.0, help="messages per second per client")
+    parser.add_argument("--restarts", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between restarts")
+    parser.add_argument("--mode", choices=("threaded", "asyncio"), default="asyncio")
+    parser.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the server, e.g. LUCIA_DATA_DIR=/tmp/lucia")
+    parser.add_argument("--server-log", help="file for the server's output (warnings and up)")
+    args = parser.parse_args()
+
+    port = free_port()
+    pid_file = os.path.join(tempfile.mkdtemp(prefix="lucia-bench-"), "server.pid")
+    env = dict(os.environ, LUCIA_PORT=str(port), LUCIA_LOG_LEVEL="warning", LUCIA_RATE_LIMITS="0",
+               LUCIA_PID_FILE=pid_file, **dict(env.split("=", 1) for env in args.server_env))
+    # The server replaces itself on every restart, so it's stopped through the pid file rather than this handle
+    log = open(args.server_log, "w") if args.server_log else subprocess.DEVNULL
+    subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(port), f"--{args.mode}"],
+                     stdout=log, stderr=subprocess.STDOUT, env=env)
+    try:
+        wait_for_port(port)
+        problems, handovers, latencies, sent, logins_done = asyncio.run(run(port, pid_file, args))
+    finally:
+        try:
+            os.kill(read_pid(pid_file), signal.SIGTERM)
+        except (OSError, ValueError):
+            pass
+
+    print(f"{args.mode}: {args.pairs * 2} clients at {args.rate:g} msg/s, {len(handovers)} restarts, "
+          f"{sent} messages, {logins_done} new logins")
+    if handovers:
+        print(f"handover: mean {statistics.mean(handovers) * 1000:.0f} ms, max {max(handovers) * 1000:.0f} ms")
+    if latencies:
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000
+        print(f"latency: p50 {p50:.2f} ms, p99 {p99:.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+    if problems:
+        for problem in problems[:20]:
+            print("FAIL", problem)
+        if len(problems) > 20:
+            print(f"FAIL ... and {len(problems) - 20} more")
+        sys.exit(1)
+    print("OK: no messages lost and no connections dropped")
+
+
+if __name__ == "__main__":
+    main()
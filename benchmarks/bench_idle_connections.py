@@ -0,0 +1,93 @@
+"""
+Opens N logged-in, idle clients against server.py and reports the server's
+RSS and thread count, for both the threaded and asyncio engines.
+
+Usage: python benchmarks/bench_idle_connections.py [clients] [threaded|asyncio ...]
+Linux only (reads /proc). Each client needs a file descriptor on both ends,
+so raise `ulimit -n` above 2 * clients first.
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def proc_status(pid):
+    """Returns (rss_kib, threads) for a process, read from /proc."""
+    rss = threads = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+            elif line.startswith("Threads:"):
+                threads = int(line.split()[1])
+    return rss, threads
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def run(mode, clients):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "server.py"), str(port), f"--{mode}"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    socks = []
+    try:
+        wait_for_port(port)
+        base_rss, base_threads = proc_status(server.pid)
+        start = time.perf_counter()
+        for i in range(clients):
+            s = socket.create_connection(("127.0.0.1", port))
+            s.sendall(f"idle{i}\n".encode())
+            socks.append(s)
+        # Wait for every welcome line so the server has finished each login
+        for s in socks:
+            reply = b""
+            while not reply.endswith(b"\n"):
+                chunk = s.recv(4096)
+                if not chunk:
+                    raise RuntimeError("server closed an idle client")
+                reply += chunk
+        elapsed = time.perf_counter() - start
+        time.sleep(0.5)
+        rss, threads = proc_status(server.pid)
+        print(f"{mode:<9} {clients:>6} clients  login {elapsed:6.2f}s  "
+              f"RSS {base_rss / 1024:6.1f} -> {rss / 1024:7.1f} MiB "
+              f"({(rss - base_rss) / max(clients, 1):6.1f} KiB/client)  "
+              f"threads {base_threads} -> {threads}")
+    finally:
+        for s in socks:
+            s.close()
+        server.terminate()
+        server.wait()
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    modes = sys.argv[2:] or ["threaded", "asyncio"]
+    for mode in modes:
+        run(mode, clients)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+How long a print_received() call takes in the thread that makes it, with
+stdout synchronous (the default) or handed to the background LogSink, when
+stdout is slow. The slow stdout is simulated by a stream that sleeps on every
+write, like a terminal or a pipe nobody is reading fast enough.
+
+Usage: python benchmarks/bench_logging.py [lines_per_thread] [threads] [write_delay_ms]
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import colors
+
+
+class SlowStream:
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = 0
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        # A real stdout serializes writers too
+        with self.lock:
+            time.sleep(self.delay)
+            self.lines += text.count("\n")
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def run(name, lines, threads, delay, background):
+    stream = SlowStream(delay)
+    sys.stdout = stream
+    try:
+        colors.configure_logging(level="debug", background=background)
+        barrier = threading.Barrier(threads + 1)
+
+        def worker(t):
+            barrier.wait()
+            for i in range(lines):
+                colors.print_received(f"Message from user{t} to user{t + 1}: 'message number {i}'")
+
+        workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+        for w in workers:
+            w.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for w in workers:
+            w.join()
+        elapsed = time.perf_counter() - start
+        colors.shutdown_logging()
+        written = stream.lines
+    finally:
+        sys.stdout = sys.__stdout__
+    total = lines * threads
+    print(f"{name:<10} {total:>7,} calls in {elapsed:6.3f}s  {elapsed / total * 1e6:8.1f} us/call in the caller  "
+          f"({written:,} lines reached stdout)")
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    delay = (float(sys.argv[3]) if len(sys.argv) > 3 else 0.2) / 1000
+    run("sync", lines, threads, delay, background=False)
+    run("background", lines, threads, delay, background=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Login latency while clients sit stalled in the middle of the handshake.
+Each stalled client sends a known username, gets "Enter password:" and never
+answers. With no lock held across the password round-trip, login latency for
+everyone else should stay flat as the number of stalled clients grows.
+
+The run fails (exit status 1) if the median login with stalled clients is more
+than STALL_FACTOR times the median with none (plus STALL_SLACK_MS for noise),
+or if any login takes longer than MAX_LOGIN_MS, which a login waiting behind a
+stalled one would.
+
+Usage: python benchmarks/bench_login_stall.py [threaded|asyncio] [stalled counts...]
+"""
+
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = b"a"
+LOGINS = 200
+# Logins rotate through this many accounts, so the server has long finished with
+# each one's last session before it logs in again
+PROBERS = 10
+# Bounds on login latency with stalled clients, against the run with none
+STALL_FACTOR = 2.0
+STALL_SLACK_MS = 10.0
+MAX_LOGIN_MS = 1000.0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def read_line(sock):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise RuntimeError("server closed the connection")
+        data += chunk
+    return data
+
+
+def register(port, username):
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.sendall(username.encode() + b"\n")
+        read_line(s)
+
+
+def login(port, username):
+    """Logs in as an existing user and returns how long it took, in seconds."""
+    start = time.perf_counter()
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as s:
+        s.sendall(username.encode() + b"\n")
+        line = read_line(s)
+        if b"Enter password" not in line:
+            raise RuntimeError(f"{username}: expected a password prompt, got {line!r}")
+        s.sendall(PASSWORD + b"\n")
+        if b"success" not in read_line(s):
+            raise RuntimeError(f"{username}: login failed")
+    return time.perf_counter() - start
+
+
+def run(mode, stalled_count):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "server.py"), str(port), f"--{mode}"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    stalled = []
+    try:
+        wait_for_port(port)
+        for i in range(stalled_count):
+            register(port, f"stalled{i}")
+        for i in range(PROBERS):
+            register(port, f"prober{i}")
+
+        # Park the stalled clients at the password prompt
+        for i in range(stalled_count):
+            s = socket.create_connection(("127.0.0.1", port))
+            s.sendall(f"stalled{i}\n".encode())
+            read_line(s)
+            stalled.append(s)
+
+        # Give the server a moment to finish logging the disconnects from register()
+        time.sleep(0.5)
+        latencies = [login(port, f"prober{i % PROBERS}") for i in range(LOGINS)]
+        latencies.sort()
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+        print(f"{mode:<9} {stalled_count:>5} stalled  login p50 {p50:7.2f} ms  "
+              f"p99 {p99:7.2f} ms  max {latencies[-1] * 1000:7.2f} ms")
+        return p50, latencies[-1] * 1000
+    finally:
+        for s in stalled:
+            s.close()
+        server.terminate()
+        server.wait()
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else "threaded"
+    counts = [int(n) for n in sys.argv[2:] if int(n) > 0] or [10, 100, 500]
+    # The run with nobody stalled is the baseline the others are held to
+    baseline, _ = run(mode, 0)
+    bound = baseline * STALL_FACTOR + STALL_SLACK_MS
+    problems = []
+    for count in counts:
+        p50, slowest = run(mode, count)
+        if p50 > bound:
+            problems.append(f"{count} stalled: login p50 {p50:.2f} ms, over {bound:.2f} ms")
+        if slowest > MAX_LOGIN_MS:
+            problems.append(f"{count} stalled: a login took {slowest:.0f} ms")
+    for problem in problems:
+        print("FAIL", problem)
+    if problems:
+        sys.exit(1)
+    print(f"OK: logins stayed within {bound:.2f} ms (p50) with clients stalled at the password prompt")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Memory benchmark for conversation storage, measured with tracemalloc.
+Stores N messages three ways: the original list of Message objects with a
+__dict__ and a datetime each, a list of __slots__ Messages, and the columnar
+Conversation from messages.py.
+
+Usage: python benchmarks/bench_memory.py [messages] [content_size]
+"""
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from messages import Conversation, Message
+
+
+class LegacyMessage:
+    # Message as it was before __slots__ and columnar storage
+    def __init__(self, sender, content, timestamp=None):
+        self.sender = sender
+        self.content = content
+        self.timestamp = timestamp or datetime.now()
+
+
+def contents(count, size):
+    # Distinct strings built as they "arrive", like real traffic, so each layout
+    # pays for whatever copies of the content it keeps
+    padding = "x" * max(size - 8, 0)
+    for i in range(count):
+        yield f"{i:08d}" + padding
+
+
+def legacy_layout(bodies):
+    senders = ("alice", "bob")
+    return [LegacyMessage(senders[i & 1], body) for i, body in enumerate(bodies)]
+
+
+def slots_layout(bodies):
+    senders = ("alice", "bob")
+    return [Message(senders[i & 1], body) for i, body in enumerate(bodies)]
+
+
+def columnar_layout(bodies):
+    conversation = Conversation("alice", "bob")
+    senders = conversation.participants
+    for i, body in enumerate(bodies):
+        conversation.add_message(senders[i & 1], body)
+    return conversation
+
+
+def measure(name, build, count, size):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    stored = build(contents(count, size))
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<9} {current / 2**20:9.1f} MiB  {current / count:7.1f} B/msg  "
+          f"peak {peak / 2**20:9.1f} MiB  build {elapsed:6.2f}s")
+    del stored
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    print(f"{count} messages, {size} byte bodies ({count * size / 2**20:.1f} MiB of raw content)")
+    measure("legacy", legacy_layout, count, size)
+    measure("slots", slots_layout, count, size)
+    measure("columnar", columnar_layout, count, size)
+
+
+if __name__ == "__main__":
+    main()
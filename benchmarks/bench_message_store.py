@@ -0,0 +1,84 @@
+"""
+Multithreaded MessageStore benchmark: concurrent add_message calls mixed with
+/open-style history reads, at increasing thread counts. A store guarded by a
+single global lock is run alongside for comparison.
+
+Usage: python benchmarks/bench_message_store.py [ops_per_thread] [thread counts...]
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from messages import MessageStore
+
+USERS = 200
+# One in this many operations is an /open of the conversation instead of a send
+READ_EVERY = 20
+# How many of the newest messages each /open reads
+READ_WINDOW = 50
+
+
+class GlobalLockStore(MessageStore):
+    """The obvious alternative: one lock around every store operation."""
+
+    def __init__(self):
+        super().__init__()
+        self.global_lock = threading.Lock()
+
+    def add_message(self, sender, recipient, content):
+        with self.global_lock:
+            super().add_message(sender, recipient, content)
+
+    def get_conversation(self, user1, user2):
+        with self.global_lock:
+            return super().get_conversation(user1, user2)
+
+
+def worker(store, thread_id, ops, barrier):
+    barrier.wait()
+    for i in range(ops):
+        sender = f"user{(thread_id * 7 + i) % USERS}"
+        recipient = f"user{(thread_id * 7 + i + 1) % USERS}"
+        if i % READ_EVERY == 0:
+            conversation = store.get_conversation(sender, recipient)
+            if conversation is not None:
+                count = conversation.message_count()
+                for message in conversation.get_messages(max(0, count - READ_WINDOW), count):
+                    str(message)
+        else:
+            store.add_message(sender, recipient, f"message {i} from thread {thread_id}")
+
+
+def run(name, store_class, threads, ops):
+    store = store_class()
+    barrier = threading.Barrier(threads + 1)
+    workers = [threading.Thread(target=worker, args=(store, t, ops, barrier)) for t in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    stored = sum(c.message_count() for c in store.conversations.values())
+    expected = threads * (ops - (ops + READ_EVERY - 1) // READ_EVERY)
+    assert stored == expected, f"lost messages: {stored} != {expected}"
+    print(f"{name:<8} {threads:>3} threads  {threads * ops / elapsed:>12,.0f} ops/s  ({stored} messages stored)")
+
+
+def main():
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    counts = [int(n) for n in sys.argv[2:]] or [1, 2, 4, 8, 16]
+    print(f"CPU cores available: {os.cpu_count()}")
+    for threads in counts:
+        run("striped", MessageStore, threads, ops)
+        run("global", GlobalLockStore, threads, ops)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Latency of well-behaved clients while another client floods the server.
+
+Pairs of clients chat at a human-ish rate (--rate messages per second each) and
+every message carries its send time, so the partner can measure delivery
+latency. Each run starts a fresh server.py:
+
+  * baseline     no flooder
+  * unlimited    a flooder writes messages as fast as the server takes them,
+                 with rate limiting off (LUCIA_RATE_LIMITS=0)
+  * limited      the same flooder against the default per-user limits, or
+                 whatever --server-env sets
+
+Reported: the pairs' delivery latency, how many messages per second the flooder
+actually got routed, and the server's CPU time per second (from /proc).
+
+Usage: python benchmarks/bench_ratelimit.py [--pairs 20] [--rate 5] [--duration 5]
+       [--flooders 1] [--mode threaded|asyncio] [--server-env NAME=VALUE ...]
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def cpu_seconds(pid):
+    """User + system CPU time of a process, from /proc."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def login(port, name):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=1 << 20)
+    writer.write(name.encode() + b"\n")
+    await reader.readline()
+    return reader, writer
+
+
+async def chatter(port, name, partner, rate, stop_at, latencies):
+    """Sends rate messages a second to partner, and times the ones partner sends back."""
+    reader, writer = await login(port, name)
+
+    async def read():
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if line.startswith(b"[from "):
+                sent = float(line.rsplit(b": ", 1)[1])
+                latencies.append(time.time() - sent)
+
+    reader_task = asyncio.ensure_future(read())
+    while time.time() < stop_at:
+        writer.write(f"{partner}: {time.time()}\n".encode())
+        await writer.drain()
+        await asyncio.sleep(1 / rate)
+    # Let the last replies arrive
+    await asyncio.sleep(0.5)
+    reader_task.cancel()
+    writer.close()
+
+
+async def flooder(port, name, stop_at, routed, start_at):
+    """Sends to a sink user as fast as the server will take it; counts the acks."""
+    reader, writer = await login(port, name)
+    line = b"sink: " + b"spam " * 20 + b"\n"
+
+    async def read():
+        while True:
+            reply = await reader.readline()
+            if not reply:
+                return
+            if reply.startswith(b"Message sent") and start_at <= time.time() < stop_at:
+                routed[0] += 1
+
+    reader_task = asyncio.ensure_future(read())
+    try:
+        while time.time() < stop_at:
+            writer.write(line * 100)
+            # A throttled flooder's drain() can take much longer than the run
+            await asyncio.wait_for(writer.drain(), max(0.01, stop_at - time.time()))
+    except asyncio.TimeoutError:
+        pass
+    reader_task.cancel()
+    writer.transport.abort()
+
+
+async def sink(port):
+    reader, writer = await login(port, "sink")
+    while await reader.read(1 << 20):
+        pass
+
+
+async def load(port, args, flooders):
+    # Warm up for a second before measuring
+    start_at = time.time() + 1.0
+    stop_at = start_at + args.duration
+    latencies = []
+    routed = [0]
+    sink_task = asyncio.ensure_future(sink(port))
+    tasks = []
+    for i in range(args.pairs):
+        tasks.append(chatter(port, f"a{i}", f"b{i}", args.rate, stop_at, latencies))
+        tasks.append(chatter(port, f"b{i}", f"a{i}", args.rate, stop_at, latencies))
+    for i in range(flooders):
+        tasks.append(flooder(port, f"flood{i}", stop_at, routed, start_at))
+    await asyncio.gather(*tasks, return_exceptions=True)
+    sink_task.cancel()
+    return latencies, routed[0]
+
+
+def run(name, args, flooders, env):
+    port = free_port()
+    env = dict(os.environ, LUCIA_PORT=str(port), LUCIA_LOG_LEVEL="info", **env)
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(port), f"--{args.mode}"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+    try:
+        wait_for_port(port)
+        cpu_before = cpu_seconds(server.pid)
+        started = time.monotonic()
+        latencies, routed = asyncio.run(load(port, args, flooders))
+        cpu = (cpu_seconds(server.pid) - cpu_before) / (time.monotonic() - started)
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+    latencies.sort()
+    if not latencies:
+        print(f"{name:<10} no messages delivered")
+        return
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"{name:<10} {len(latencies):>6} delivered  p50 {p50:8.2f} ms  p99 {p99:8.2f} ms  "
+          f"max {latencies[-1] * 1000:8.2f} ms  flooder {routed / args.duration:>8,.0f} msg/s  "
+          f"server CPU {cpu * 100:5.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pairs", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=5.0, help="messages per second per well-behaved client")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--flooders", type=int, default=1)
+    parser.add_argument("--mode", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the limited run, e.g. LUCIA_USER_RATE_MESSAGES=20/40")
+    args = parser.parse_args()
+    limited_env = dict(env.split("=", 1) for env in args.server_env)
+    print(f"{args.mode}: {args.pairs} pairs at {args.rate:g} msg/s each, {args.flooders} flooder(s)")
+    run("baseline", args, 0, {})
+    run("unlimited", args, args.flooders, {"LUCIA_RATE_LIMITS": "0"})
+    run("limited", args, args.flooders, limited_env)
+
+
+if __name__ == "__main__":
+    main()
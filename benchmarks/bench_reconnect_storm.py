@@ -0,0 +1,202 @@
+"""
+A reconnect storm: thousands of clients logging back in at once, as after a
+network blip, while a few others keep chatting.
+
+Each run starts a fresh server.py and registers --clients users, getting each a
+session token with /token. Then all of them reconnect at the same moment, either
+with their session token ("token", one HMAC per login) or with the password
+("password", one KDF run per login). Clients the server turns away as busy try
+again after a jittered exponential backoff, like real ones would.
+
+Reported: the time until every client is logged in, how often they were turned
+away, the delivery latency of the chatting pairs during the storm, and the
+server's CPU time. Password logins cost the KDF's time each (see
+credentials.py), divided by LUCIA_KDF_WORKERS cores, so the "password" storm is
+slow with many clients on purpose.
+
+Usage: python benchmarks/bench_reconnect_storm.py [--clients 5000] [--pairs 10]
+       [--modes token password] [--mode threaded|asyncio] [--server-env NAME=VALUE ...]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "a"
+TOKEN = re.compile(rb"(lt1\.\S+)")
+# Turned-away clients retry after a jittered, doubling delay up to this
+MAX_BACKOFF = 5.0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def raise_fd_limit():
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def register(port, name, tokens, limit):
+    async with limit:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"{name}\n/token\n".encode())
+        await reader.readline()
+        tokens[name] = TOKEN.search(await reader.readline()).group(1).decode()
+        writer.close()
+
+
+async def reconnect(port, name, secret, stats, all_in, done):
+    """Logs back in, backing off whenever the server is busy; stays connected until done."""
+    backoff = 0.1
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"{name}\n{secret}\n".encode())
+            while True:
+                line = await reader.readline()
+                if not line or line.startswith(b"ERROR") or line.startswith(b"Authenticated"):
+                    break
+            if line.startswith(b"Authenticated"):
+                stats["in"] += 1
+                if stats["in"] == stats["clients"]:
+                    all_in.set()
+                await done.wait()
+                writer.close()
+                return
+            writer.close()
+        except OSError:
+            pass
+        stats["retries"] += 1
+        await asyncio.sleep(random.uniform(backoff / 2, backoff))
+        backoff = min(backoff * 2, MAX_BACKOFF)
+
+
+async def chatter(port, name, partner, rate, stop, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"{name}\n".encode())
+    await reader.readline()
+
+    async def read():
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if line.startswith(b"[from "):
+                latencies.append(time.time() - float(line.rsplit(b": ", 1)[1]))
+
+    reader_task = asyncio.ensure_future(read())
+    while not stop.is_set():
+        writer.write(f"{partner}: {time.time()}\n".encode())
+        await writer.drain()
+        await asyncio.sleep(1 / rate)
+    await asyncio.sleep(0.5)
+    reader_task.cancel()
+    writer.close()
+
+
+async def storm(port, args, how, server_pid):
+    tokens = {}
+    names = [f"user{i}" for i in range(args.clients)]
+    limit = asyncio.Semaphore(100)
+    await asyncio.gather(*(register(port, name, tokens, limit) for name in names))
+
+    # The pairs chat from a little before the storm until it's over
+    stop = asyncio.Event()
+    latencies = []
+    chatters = []
+    for i in range(args.pairs):
+        chatters.append(asyncio.ensure_future(chatter(port, f"a{i}", f"b{i}", args.rate, stop, latencies)))
+        chatters.append(asyncio.ensure_future(chatter(port, f"b{i}", f"a{i}", args.rate, stop, latencies)))
+    await asyncio.sleep(1.0)
+    before = len(latencies)
+
+    stats = {"retries": 0, "in": 0, "clients": len(names)}
+    all_in = asyncio.Event()
+    done = asyncio.Event()
+    cpu_before = cpu_seconds(server_pid)
+    start = time.perf_counter()
+    clients = [asyncio.ensure_future(reconnect(port, name, tokens[name] if how == "token" else PASSWORD,
+                                               stats, all_in, done))
+               for name in names]
+    await all_in.wait()
+    elapsed = time.perf_counter() - start
+    cpu = cpu_seconds(server_pid) - cpu_before
+    during = latencies[before:]
+    done.set()
+    stop.set()
+    await asyncio.gather(*clients, *chatters, return_exceptions=True)
+    return elapsed, stats["retries"], cpu, sorted(during)
+
+
+def run(how, args):
+    port = free_port()
+    env = dict(os.environ, LUCIA_PORT=str(port), LUCIA_LOG_LEVEL="warning", LUCIA_RATE_LIMITS="0",
+               **dict(env.split("=", 1) for env in args.server_env))
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(port), f"--{args.mode}"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+    try:
+        wait_for_port(port)
+        elapsed, retries, cpu, latencies = asyncio.run(storm(port, args, how, server.pid))
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+    line = (f"{how:<9} {args.clients:>6} clients  all in after {elapsed:7.2f}s  {retries:>6} retries  "
+            f"server CPU {cpu:6.2f}s")
+    if latencies:
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000
+        line += f"  chat p50 {p50:7.2f} ms  p99 {p99:8.2f} ms  max {latencies[-1] * 1000:8.2f} ms"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=5000)
+    parser.add_argument("--pairs", type=int, default=10, help="pairs chatting through the storm")
+    parser.add_argument("--rate", type=float, default=5.0, help="messages per second per chatting client")
+    parser.add_argument("--modes", nargs="+", choices=("token", "password"), default=["token", "password"])
+    parser.add_argument("--mode", choices=("threaded", "asyncio"), default="asyncio")
+    parser.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the server, e.g. LUCIA_KDF_WORKERS=4")
+    args = parser.parse_args()
+    raise_fd_limit()
+    print(f"{args.mode}: {args.clients} clients reconnecting, {args.pairs} pairs chatting at {args.rate:g} msg/s")
+    for how in args.modes:
+        run(how, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark and crash-recovery check for the durable LogBackend.
+
+1. Writes N messages spread over C conversations, then measures how long a
+   restart takes (opening the backend and rebuilding MessageStore) and how long
+   the first /open of a conversation takes to load its history lazily.
+2. Cuts the active segment off in the middle of a record, as a crash during a
+   write would, and checks that every complete record survives, the torn one is
+   dropped and the log keeps accepting writes.
+
+Usage: python benchmarks/bench_storage.py [messages] [conversations]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from messages import MessageStore
+from storage import LogBackend, RECORD
+
+
+def open_store(directory, **kwargs):
+    backend = LogBackend(directory, **kwargs)
+    return backend, MessageStore(backend=backend)
+
+
+def benchmark(directory, messages, conversations):
+    backend, store = open_store(directory)
+    start = time.perf_counter()
+    for i in range(messages):
+        pair = i % conversations
+        store.add_message(f"user{pair}", f"peer{pair}", f"message number {i} in conversation {pair}")
+    backend.close()
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    print(f"write     {messages:,} messages in {elapsed:.2f}s ({messages / elapsed:,.0f} msg/s), "
+          f"{size / 2**20:.1f} MiB on disk")
+
+    start = time.perf_counter()
+    backend, store = open_store(directory)
+    elapsed = time.perf_counter() - start
+    print(f"restart   {len(store.conversations):,} conversations indexed in {elapsed:.3f}s")
+
+    start = time.perf_counter()
+    conversation = store.get_conversation("user0", "peer0")
+    history = conversation.get_messages()
+    elapsed = time.perf_counter() - start
+    expected = len(range(0, messages, conversations))
+    assert len(history) == expected, f"{len(history)} != {expected}"
+    print(f"first /open loaded {len(history):,} messages in {elapsed * 1000:.1f} ms")
+    backend.close()
+
+
+def crash_recovery(directory):
+    backend, store = open_store(directory, segment_size=16 * 1024)
+    for i in range(1000):
+        store.add_message("alice", "bob", f"message {i}")
+    backend.close()
+
+    # Chop the newest segment in the middle of its last record
+    segment = sorted(name for name in os.listdir(directory) if name.endswith(".log") and name.startswith("seg-"))[-1]
+    path = os.path.join(directory, segment)
+    size = os.path.getsize(path)
+    with open(path, "r+b") as f:
+        f.truncate(size - len("message 999") // 2)
+
+    backend, store = open_store(directory, segment_size=16 * 1024)
+    conversation = store.get_conversation("alice", "bob")
+    history = conversation.get_messages()
+    assert len(history) == 999, f"expected 999 intact messages, found {len(history)}"
+    assert [m.content for m in history] == [f"message {i}" for i in range(999)]
+    # The torn bytes were cut off, so new records land on a clean boundary
+    assert os.path.getsize(path) == size - RECORD.size - len("message 999")
+    store.add_message("bob", "alice", "after the crash")
+    backend.close()
+
+    backend, store = open_store(directory, segment_size=16 * 1024)
+    history = store.get_conversation("alice", "bob").get_messages()
+    assert len(history) == 1000 and history[-1].content == "after the crash"
+    backend.close()
+    print("crash recovery: torn record dropped, 999 intact messages kept, log still writable - OK")
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    conversations = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+    for run in (lambda d: benchmark(d, messages, conversations), crash_recovery):
+        directory = tempfile.mkdtemp(prefix="lucia-storage-")
+        try:
+            run(directory)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+What TLS costs next to plaintext: connection setup and per-message overhead.
+
+Generates a throwaway self-signed certificate with the openssl command, then for
+each server engine starts a plaintext server and a TLS one (LUCIA_TLS_CERT) and
+measures:
+
+  * handshake rate: connections a second that connect, log in as a new user and
+    hang up, from several threads at once; over TLS both with full handshakes
+    and resuming the session from the previous connection (TLS 1.3 tickets)
+  * message round trip: one client sends to another and waits for the server's
+    acknowledgement before sending the next
+  * throughput: messages of each size sent in windows of 64, until the recipient
+    has them all, and the server's CPU time per message (Linux only)
+
+Usage: python benchmarks/bench_tls.py [--modes threaded asyncio] [--connections 500]
+       [--concurrency 8] [--messages 2000] [--sizes 64 1024 8192] [--key-type rsa|ec] [--no-ktls]
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOST = "127.0.0.1"
+WINDOW = 64
+
+
+def make_certificate(directory, key_type):
+    """A self-signed certificate for 127.0.0.1, valid for a day; returns (cert, key) paths."""
+    if shutil.which("openssl") is None:
+        sys.exit("This benchmark needs the openssl command to make its certificate")
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    newkey = ["-newkey", "rsa:2048"] if key_type == "rsa" else ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"]
+    subprocess.run(["openssl", "req", "-x509", *newkey, "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-addext", f"subjectAltName=IP:{HOST},DNS:localhost", "-keyout", key, "-out", cert],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, env):
+    port = free_port()
+    env = dict(os.environ, LUCIA_LOG_LEVEL="warning", LUCIA_RATE_LIMITS="0", LUCIA_HOT_RESTART="0", **env)
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(port), f"--{mode}"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, env=env)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return proc, port
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def server_cpu(pid):
+    """User plus system CPU seconds the process has used, or None off Linux."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Connection:
+    """A blocking text-protocol client, plain or TLS; only ever used from one thread."""
+
+    def __init__(self, port, context=None, session=None):
+        sock = socket.create_connection((HOST, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if context is not None:
+            sock = context.wrap_socket(sock, server_hostname=HOST, session=session)
+        self.sock = sock
+        self.file = sock.makefile("rb")
+
+    def login(self, name):
+        self.sock.sendall(f"{name}\n".encode())
+        line = self.file.readline()
+        if not line.startswith(b"Welcome"):
+            raise RuntimeError(f"{name} couldn't log in: {line!r}")
+
+    def close(self):
+        # Shut down first: that ends a read another thread is blocked in, which holds the file
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.file.close()
+        self.sock.close()
+
+
+def handshakes(port, context, resume, pid, connections, concurrency, prefix):
+    """
+    Connect, log in and hang up, from concurrency threads.
+    Returns (per second, latencies, how many resumed, server CPU µs per connection).
+    """
+    latencies = []
+    resumed = [0]
+    lock = threading.Lock()
+    per_thread = connections // concurrency
+
+    def run(worker):
+        session = None
+        for i in range(per_thread):
+            start = time.perf_counter()
+            conn = Connection(port, context, session if resume else None)
+            conn.login(f"{prefix}{worker}x{i}")
+            elapsed = time.perf_counter() - start
+            if context is not None:
+                # The tickets came in ahead of the welcome
+                session = conn.sock.session
+                if conn.sock.session_reused:
+                    with lock:
+                        resumed[0] += 1
+            conn.close()
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in range(concurrency)]
+    cpu = server_cpu(pid)
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    cpu_after = server_cpu(pid)
+    per_connection = None if cpu is None or cpu_after is None else (cpu_after - cpu) / len(latencies) * 1e6
+    return len(latencies) / elapsed, sorted(latencies), resumed[0], per_connection
+
+
+def messaging(port, context, pid, count, sizes, prefix):
+    """Round trip latencies, then (size, messages/s, server CPU µs per message) for each size."""
+    sender, receiver = Connection(port, context), Connection(port, context)
+    sender.login(f"{prefix}a")
+    receiver.login(f"{prefix}b")
+    got = threading.Semaphore(0)
+
+    def receive():
+        marker = f"[from {prefix}a]".encode()
+        for line in receiver.file:
+            if line.startswith(marker):
+                got.release()
+
+    threading.Thread(target=receive, daemon=True).start()
+
+    round_trips = []
+    for i in range(count):
+        start = time.perf_counter()
+        sender.sock.sendall(f"{prefix}b: ping {i}\n".encode())
+        sender.file.readline()
+        round_trips.append(time.perf_counter() - start)
+        got.acquire()
+
+    rates = []
+    for size in sizes:
+        line = f"{prefix}b: {'x' * size}\n".encode()
+        cpu = server_cpu(pid)
+        start = time.perf_counter()
+        for sent in range(0, count, WINDOW):
+            batch = min(WINDOW, count - sent)
+            sender.sock.sendall(line * batch)
+            for _ in range(batch):
+                sender.file.readline()
+        for _ in range(count):
+            got.acquire()
+        elapsed = time.perf_counter() - start
+        cpu_after = server_cpu(pid)
+        per_message = None if cpu is None or cpu_after is None else (cpu_after - cpu) / count * 1e6
+        rates.append((size, count / elapsed, per_message))
+    sender.close()
+    receiver.close()
+    return sorted(round_trips), rates
+
+
+def ms(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+def ktls_stats():
+    """The kernel's TLS counters, if its tls module is loaded."""
+    try:
+        with open("/proc/net/tls_stat") as f:
+            return dict(line.split() for line in f if line.strip())
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--modes", nargs="+", choices=("threaded", "asyncio"), default=["threaded", "asyncio"])
+    parser.add_argument("--connections", type=int, default=500, help="connections per handshake run")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads opening connections at once")
+    parser.add_argument("--messages", type=int, default=2000, help="messages per round trip and throughput run")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 1024, 8192], help="message sizes in bytes")
+    parser.add_argument("--key-type", choices=("rsa", "ec"), default="rsa",
+                        help="RSA 2048 or ECDSA P-256 certificate (default %(default)s)")
+    parser.add_argument("--no-ktls", action="store_true", help="keep TLS encryption out of the kernel (LUCIA_KTLS=0)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="lucia-tls-")
+    try:
+        cert, key = make_certificate(directory, args.key_type)
+        context = ssl.create_default_context(cafile=cert)
+        context.minimum_version = ssl.TLSVersion.TLSv1_3
+        tls_env = {"LUCIA_TLS_CERT": cert, "LUCIA_TLS_KEY": key, "LUCIA_KTLS": "0" if args.no_ktls else "1"}
+        ktls = "unavailable" if not hasattr(ssl, "OP_ENABLE_KTLS") else "off" if args.no_ktls else "requested"
+        print(f"{ssl.OPENSSL_VERSION}, {args.key_type} certificate, kernel TLS {ktls}")
+        ktls_before = ktls_stats()
+
+        for mode in args.modes:
+            print(f"\n{mode}")
+            runs = [("plain", None, {}), ("tls", context, tls_env)]
+            for name, client_context, env in runs:
+                proc, port = start_server(mode, env)
+                try:
+                    variants = [(name, False)] if client_context is None else [("tls full", False), ("tls resumed", True)]
+                    for label, resume in variants:
+                        rate, latencies, resumed, cpu = handshakes(port, client_context, resume, proc.pid,
+                                                                   args.connections, args.concurrency, f"h{label[-4:]}")
+                        cpu_note = f"   server CPU {cpu:6.0f} µs/conn" if cpu is not None else ""
+                        note = f", {resumed} of {len(latencies)} resumed" if client_context is not None else ""
+                        print(f"  {label:<12} handshakes  {rate:8.0f}/s   connect + login p50 {ms(latencies, 0.5):6.2f} ms"
+                              f" p99 {ms(latencies, 0.99):6.2f} ms{cpu_note}{note}")
+                    round_trips, rates = messaging(port, client_context, proc.pid, args.messages, args.sizes, "m")
+                    print(f"  {name:<12} round trip  p50 {ms(round_trips, 0.5):.3f} ms  p99 {ms(round_trips, 0.99):.3f} ms")
+                    for size, per_second, cpu in rates:
+                        cpu_note = f"   server CPU {cpu:6.1f} µs/msg" if cpu is not None else ""
+                        print(f"  {name:<12} {size:>6} B    {per_second:8.0f} msg/s  "
+                              f"{per_second * size / 2 ** 20:7.1f} MiB/s{cpu_note}")
+                finally:
+                    proc.terminate()
+                    proc.wait()
+
+        ktls_after = ktls_stats()
+        if ktls_before is not None and ktls_after is not None:
+            changed = {name: int(value) - int(ktls_before.get(name, 0)) for name, value in ktls_after.items()
+                       if int(value) != int(ktls_before.get(name, 0))}
+            print(f"\nkernel TLS counters during the run: {changed or 'unchanged'}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
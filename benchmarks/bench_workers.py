@@ -0,0 +1,200 @@
+"""
+Message throughput of server.py with 1, 2, 4... worker processes (LUCIA_WORKERS).
+
+The load comes from several generator processes so the clients themselves don't
+become the bottleneck. Each generator logs in its share of the clients, pairs
+them up, and every client keeps a window of messages in flight to its partner
+for the whole run. Partners usually end up on different workers, so most
+messages cross the hub. Reported: messages delivered per second and the
+server's total CPU time per message (workers and supervisor, from /proc).
+
+Prints the scaling curve: each worker count's speedup over the first one, and its
+efficiency (speedup divided by how many times more workers there are). Every
+worker applies every message to its replica of the store (see cluster.py), so
+efficiency falls as workers are added; the run fails (exit status 1) if it drops
+below --min-efficiency.
+
+Scaling needs as many free cores as workers plus generators; on a machine with
+fewer, extra workers just share the same cores and the numbers won't move, so
+those worker counts are reported but not checked.
+
+Usage: python benchmarks/bench_workers.py [--workers 1 2 4] [--clients 200]
+       [--generators 4] [--duration 5] [--window 4] [--mode threaded|asyncio]
+       [--min-efficiency 0.7]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds(pid):
+    """User + system CPU time of a process and its live children, from /proc."""
+    total = 0.0
+    tick = os.sysconf("SC_CLK_TCK")
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / tick
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+async def run_client(name, partner, port, window, duration, start_at, counts):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=1 << 20)
+    writer.write(name.encode() + b"\n")
+    await reader.readline()
+    frame = f"{partner}: x\n".encode()
+    credit = asyncio.Semaphore(window)
+    stop_at = start_at + duration
+
+    async def read():
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if line.startswith(b"Message sent"):
+                credit.release()
+            elif line.startswith(b"[from ") and time.time() < stop_at:
+                counts[0] += 1
+
+    reader_task = asyncio.ensure_future(read())
+    # Everyone starts at once, after the last generator has logged in
+    await asyncio.sleep(max(0.0, start_at - time.time()))
+    while time.time() < stop_at:
+        await credit.acquire()
+        writer.write(frame)
+        await writer.drain()
+    reader_task.cancel()
+    writer.close()
+
+
+def generator(index, clients, port, window, duration, start_at, results):
+    async def main():
+        counts = [0]
+        names = [f"g{index}c{i}" for i in range(clients)]
+        # Pair c0<->c1, c2<->c3, ...
+        tasks = [run_client(name, names[i ^ 1 if (i ^ 1) < clients else i - 1], port, window,
+                            duration, start_at, counts) for i, name in enumerate(names)]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        results.put(counts[0])
+    asyncio.run(main())
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def run(workers, args):
+    port = free_port()
+    # Without rate limits, which would cap the throughput we are measuring
+    env = dict(os.environ, LUCIA_PORT=str(port), LUCIA_WORKERS=str(workers), LUCIA_LOG_LEVEL="info",
+               LUCIA_RATE_LIMITS="0")
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(port), f"--{args.mode}"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+    try:
+        wait_for_port(port)
+        # Give every worker time to bind before the clients connect
+        time.sleep(0.5)
+        results = multiprocessing.Queue()
+        per_generator = max(2, args.clients // args.generators)
+        start_at = time.time() + 2.0 + args.clients / 500
+        procs = [multiprocessing.Process(target=generator, args=(g, per_generator, port, args.window,
+                                                                  args.duration, start_at, results))
+                 for g in range(args.generators)]
+        for proc in procs:
+            proc.start()
+        time.sleep(max(0.0, start_at - time.time()))
+        cpu_before = cpu_seconds(server.pid)
+        time.sleep(args.duration)
+        cpu_used = cpu_seconds(server.pid) - cpu_before
+        delivered = sum(results.get(timeout=args.duration + 30) for _ in procs)
+        for proc in procs:
+            proc.join()
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+    rate = delivered / args.duration
+    per_message = cpu_used / delivered * 1e6 if delivered else float("nan")
+    print(f"workers={workers:<2} {delivered:>9,} delivered  {rate:>10,.0f} msg/s  "
+          f"{per_message:7.1f} us server CPU/msg")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--generators", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--window", type=int, default=4, help="messages in flight per client")
+    parser.add_argument("--mode", choices=("threaded", "asyncio"), default="asyncio")
+    parser.add_argument("--min-efficiency", type=float, default=0.7,
+                        help="fail if speedup / worker ratio drops below this (default %(default)s)")
+    args = parser.parse_args()
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    print(f"{cpus} CPUs, {args.clients} clients from {args.generators} generators, {args.mode} mode")
+    rates = [(workers, run(workers, args)) for workers in args.workers]
+
+    first, baseline = rates[0]
+    print(f"\nscaling over workers={first}")
+    problems = []
+    unchecked = []
+    for workers, rate in rates:
+        speedup = rate / baseline if baseline else 0.0
+        efficiency = speedup / (workers / first)
+        if workers == first:
+            verdict = "baseline"
+        elif workers + args.generators > cpus:
+            verdict = f"not checked, needs {workers + args.generators} CPUs"
+            unchecked.append(workers)
+        elif efficiency < args.min_efficiency:
+            verdict = "FAIL"
+            problems.append(f"workers={workers}: efficiency {efficiency:.2f} < {args.min_efficiency}")
+        else:
+            verdict = "ok"
+        print(f"workers={workers:<2} {speedup:5.2f}x  efficiency {efficiency:4.2f}  {verdict}")
+
+    if problems:
+        for problem in problems:
+            print(f"FAIL {problem}")
+        sys.exit(1)
+    if unchecked:
+        print(f"Not enough CPUs to check scaling for workers={unchecked}")
+    else:
+        print("OK")
+
+
+if __name__ == "__main__":
+    main()
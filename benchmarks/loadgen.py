@@ -0,0 +1,467 @@
+"""
+Load generator and latency benchmark for server.py.
+
+Starts the server on an ephemeral port (passed the same way a user would, as
+LUCIA_PORT and the first argument), drives simulated clients through the real
+username/password handshake and runs one or more scenarios:
+
+    steady        every client sends to the next one at a fixed rate
+    fanin         everyone sends bursts to a single hot user
+    open          /open on conversations with long histories
+    login_storm   registered users all log back in at once
+    slow_readers  steady traffic where half the recipients read slowly
+
+For each scenario it reports throughput, p50/p95/p99 send-to-receive latency
+(or request latency for /open and logins) and the server's peak RSS and thread
+count, and with --json writes the results to a file so builds can be compared.
+
+Usage: python benchmarks/loadgen.py [--mode threaded|asyncio] [--clients N]
+       [--duration S] [--scenario NAME ...] [--json results.json]
+Linux only for the RSS/thread numbers (reads /proc).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = b"a"
+SCENARIOS = ("steady", "fanin", "open", "login_storm", "slow_readers")
+# Lines of /open history can be long, so give the client streams plenty of room
+STREAM_LIMIT = 4 * 1024 * 1024
+# How long to keep reading after the senders stop, for messages still in flight
+DRAIN_TIME = 2.0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit():
+    # Every simulated client needs a file descriptor
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def proc_status(pid):
+    """Returns (rss_kib, threads) for a process, read from /proc, or (None, None)."""
+    rss = threads = None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, threads
+
+
+def percentiles(samples):
+    """p50/p95/p99/max in milliseconds (nearest rank), from samples in seconds."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p * len(ordered))) - 1))] * 1000
+
+    return {"count": len(ordered), "p50": rank(0.50), "p95": rank(0.95),
+            "p99": rank(0.99), "max": ordered[-1] * 1000}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Server:
+    """server.py in a subprocess on a free port, with its RSS and thread count sampled."""
+
+    def __init__(self, mode, env, port=None):
+        self.port = port or free_port()
+        # Rate limits would cap the load we're trying to measure; bench_ratelimit.py covers them
+        env = dict(os.environ, LUCIA_PORT=str(self.port), **dict({"LUCIA_RATE_LIMITS": "0"}, **env))
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "server.py"), str(self.port), f"--{mode}"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env,
+        )
+        self.peak_rss = self.peak_threads = None
+
+    async def wait_ready(self, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", self.port)
+                writer.close()
+                return
+            except OSError:
+                await asyncio.sleep(0.05)
+        raise RuntimeError(f"server did not start on port {self.port}")
+
+    def sample(self):
+        rss, threads = proc_status(self.process.pid)
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+            self.peak_threads = max(self.peak_threads or 0, threads)
+        return rss, threads
+
+    async def sample_loop(self, interval=0.2):
+        while True:
+            self.sample()
+            await asyncio.sleep(interval)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Stats:
+    """Everything a scenario measures."""
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.latencies = []
+        # Latencies seen by slow readers, kept apart so they don't hide the fast ones
+        self.slow_latencies = []
+        self.requests = []
+        self.errors = 0
+
+
+class Client:
+    """One simulated user: logs in, sends, and reads everything the server sends back."""
+
+    def __init__(self, name, stats, read_delay=0.0):
+        self.name = name
+        self.stats = stats
+        self.read_delay = read_delay
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self._waiter = None
+
+    async def login(self, port):
+        """Connects and completes the handshake (registering or logging in). Returns seconds taken."""
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port, limit=STREAM_LIMIT)
+        self.writer.write(self.name.encode() + b"\n")
+        reply = await self.reader.readline()
+        if b"Enter password" in reply:
+            self.writer.write(PASSWORD + b"\n")
+            reply = await self.reader.readline()
+        if b"Welcome" not in reply and b"success" not in reply:
+            raise RuntimeError(f"{self.name}: login failed: {reply!r}")
+        return time.perf_counter() - start
+
+    def start_reading(self):
+        self.reader_task = asyncio.ensure_future(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    return
+                if line.startswith(b"[from "):
+                    _, _, body = line.partition(b"]: ")
+                    fields = body.split()
+                    if len(fields) == 2 and fields[0] == b"lg":
+                        latency = (time.monotonic_ns() - int(fields[1])) / 1e9
+                        (self.stats.slow_latencies if self.read_delay else self.stats.latencies).append(latency)
+                        self.stats.received += 1
+                elif line.startswith(b"ERROR"):
+                    self.stats.errors += 1
+                if self._waiter is not None and (b"=== End of conversation" in line or b"No conversation" in line):
+                    self._waiter.set_result(None)
+                    self._waiter = None
+                if self.read_delay:
+                    await asyncio.sleep(self.read_delay)
+        except (ConnectionError, asyncio.CancelledError):
+            return
+
+    def send(self, recipient):
+        """Sends a timestamped message; the recipient works out the latency when it arrives."""
+        self.writer.write(f"{recipient}: lg {time.monotonic_ns()}\n".encode())
+        self.stats.sent += 1
+
+    async def request(self, line):
+        """Sends a command and waits for the end of its history reply. Returns seconds taken."""
+        self._waiter = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        self.writer.write(line.encode() + b"\n")
+        await self._waiter
+        return time.perf_counter() - start
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+
+async def connect_all(port, clients, concurrency=100):
+    """Logs clients in, at most `concurrency` handshakes at a time. Returns their login latencies."""
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(client):
+        async with gate:
+            return await client.login(port)
+
+    return await asyncio.gather(*(one(client) for client in clients))
+
+
+async def send_at_rate(client, recipients, rate, duration):
+    """Sends to recipients in turn, `rate` messages a second, for `duration` seconds."""
+    interval = 1.0 / rate
+    start = time.monotonic()
+    next_send = start
+    i = 0
+    while time.monotonic() - start < duration:
+        client.send(recipients[i % len(recipients)])
+        i += 1
+        next_send += interval
+        # Keep to an absolute schedule so a slow iteration doesn't lower the rate
+        await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+        await client.writer.drain()
+
+
+async def scenario_steady(port, args, stats):
+    clients = [Client(f"steady{i}", stats) for i in range(args.clients)]
+    await connect_all(port, clients)
+    for client in clients:
+        client.start_reading()
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        send_at_rate(client, [clients[(i + 1) % len(clients)].name], args.rate, args.duration)
+        for i, client in enumerate(clients)
+    ))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(DRAIN_TIME)
+    return clients, elapsed, {"clients": args.clients, "rate_per_client": args.rate}
+
+
+async def scenario_fanin(port, args, stats):
+    hot = Client("hot", stats)
+    senders = [Client(f"fanin{i}", stats) for i in range(args.clients - 1)]
+    await connect_all(port, [hot] + senders)
+    for client in [hot] + senders:
+        client.start_reading()
+
+    async def bursts(client):
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            for _ in range(args.burst):
+                client.send(hot.name)
+            await client.writer.drain()
+            await asyncio.sleep(args.burst_interval)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(bursts(client) for client in senders))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(DRAIN_TIME)
+    return [hot] + senders, elapsed, {"senders": len(senders), "burst": args.burst,
+                                      "burst_interval": args.burst_interval}
+
+
+async def scenario_open(port, args, stats):
+    pairs = max(1, args.clients // 2)
+    writers = [Client(f"author{i}", stats) for i in range(pairs)]
+    readers = [Client(f"archive{i}", stats) for i in range(pairs)]
+    await connect_all(port, writers + readers)
+
+    # Fill each conversation, waiting for every "Message sent" so the history is complete
+    async def fill(author, archive):
+        for start in range(0, args.history, 1000):
+            count = min(1000, args.history - start)
+            author.writer.write(b"".join(f"{archive.name}: history {start + i}\n".encode() for i in range(count)))
+            for _ in range(count):
+                await author.reader.readline()
+
+    await asyncio.gather(*(fill(a, r) for a, r in zip(writers, readers)))
+    for client in writers + readers:
+        client.start_reading()
+
+    async def opener(archive, author):
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            stats.requests.append(await archive.request(f"/open {author.name} {args.open_limit}"))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(opener(r, a) for a, r in zip(writers, readers)))
+    elapsed = time.perf_counter() - start
+    return writers + readers, elapsed, {"pairs": pairs, "history": args.history, "open_limit": args.open_limit}
+
+
+async def scenario_login_storm(port, args, stats):
+    clients = [Client(f"storm{i}", stats) for i in range(args.clients)]
+    await connect_all(port, clients)
+    for client in clients:
+        await client.close()
+    # Let the server notice every disconnect before everyone comes back
+    await asyncio.sleep(1.0)
+
+    clients = [Client(client.name, stats) for client in clients]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(client.login(port) for client in clients), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    for result in results:
+        if isinstance(result, BaseException):
+            stats.errors += 1
+        else:
+            stats.requests.append(result)
+    return clients, elapsed, {"clients": args.clients}
+
+
+async def scenario_slow_readers(port, args, stats):
+    clients = [Client(f"reader{i}", stats, read_delay=args.read_delay if i % 2 else 0.0)
+               for i in range(args.clients)]
+    await connect_all(port, clients)
+    for client in clients:
+        client.start_reading()
+    # Everyone alternates between a fast and a slow recipient
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        send_at_rate(client, [clients[(i + 1) % len(clients)].name, clients[(i + 2) % len(clients)].name],
+                     args.rate, args.duration)
+        for i, client in enumerate(clients)
+    ))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(DRAIN_TIME)
+    return clients, elapsed, {"clients": args.clients, "rate_per_client": args.rate,
+                              "slow_read_delay": args.read_delay}
+
+
+async def run_scenario(name, args):
+    server = Server(args.mode, dict(env.split("=", 1) for env in args.server_env), args.port)
+    stats = Stats()
+    clients = []
+    try:
+        await server.wait_ready()
+        base_rss, base_threads = server.sample()
+        sampler = asyncio.ensure_future(server.sample_loop())
+        try:
+            clients, elapsed, params = await globals()[f"scenario_{name}"](server.port, args, stats)
+            end_rss, end_threads = server.sample()
+        finally:
+            sampler.cancel()
+    finally:
+        for client in clients:
+            await client.close()
+        server.stop()
+
+    result = {
+        "scenario": name,
+        "params": params,
+        "elapsed_s": elapsed,
+        "sent": stats.sent,
+        "received": stats.received,
+        "errors": stats.errors,
+        "server": {"rss_start_kib": base_rss, "rss_end_kib": end_rss, "rss_peak_kib": server.peak_rss,
+                   "threads_start": base_threads, "threads_end": end_threads,
+                   "threads_peak": server.peak_threads},
+    }
+    if stats.sent:
+        result["throughput_msg_s"] = stats.received / elapsed
+        result["latency_ms"] = percentiles(stats.latencies)
+        if stats.slow_latencies:
+            result["slow_reader_latency_ms"] = percentiles(stats.slow_latencies)
+    if stats.requests:
+        result["requests"] = len(stats.requests)
+        result["throughput_req_s"] = len(stats.requests) / elapsed
+        result["request_latency_ms"] = percentiles(stats.requests)
+    return result
+
+
+def report(result):
+    line = f"{result['scenario']:<13} {result['elapsed_s']:6.2f}s"
+    if "throughput_msg_s" in result:
+        line += f"  sent {result['sent']:>8,}  recv {result['received']:>8,}  {result['throughput_msg_s']:>9,.0f} msg/s"
+    if "throughput_req_s" in result:
+        line += f"  {result['requests']:>6,} requests  {result['throughput_req_s']:>8,.1f} req/s"
+    print(line)
+    for key, label in (("latency_ms", "latency"), ("slow_reader_latency_ms", "slow readers"),
+                       ("request_latency_ms", "request")):
+        stats = result.get(key)
+        if stats:
+            print(f"    {label:<13} p50 {stats['p50']:8.2f} ms  p95 {stats['p95']:8.2f} ms  "
+                  f"p99 {stats['p99']:8.2f} ms  max {stats['max']:8.2f} ms")
+    server = result["server"]
+    if server["rss_peak_kib"] is not None:
+        print(f"    server        RSS {server['rss_start_kib'] / 1024:.1f} -> peak {server['rss_peak_kib'] / 1024:.1f} MiB"
+              f"  threads {server['threads_start']} -> peak {server['threads_peak']}")
+    if result["errors"]:
+        print(f"    {result['errors']} errors")
+
+
+async def main_async(args):
+    results = []
+    for name in args.scenario or SCENARIOS:
+        result = await run_scenario(name, args)
+        report(result)
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-generation and latency benchmark for server.py")
+    parser.add_argument("--mode", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run (repeatable, default: all)")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of load per scenario")
+    parser.add_argument("--rate", type=float, default=20.0, help="messages per second per client")
+    parser.add_argument("--burst", type=int, default=50, help="fanin: messages per burst")
+    parser.add_argument("--burst-interval", type=float, default=0.5, help="fanin: seconds between bursts")
+    parser.add_argument("--history", type=int, default=10000, help="open: messages per conversation")
+    parser.add_argument("--open-limit", type=int, default=1000, help="open: messages asked for per /open")
+    parser.add_argument("--read-delay", type=float, default=0.05, help="slow_readers: seconds per line read")
+    parser.add_argument("--port", type=int, help="port for the server (default: a free one)")
+    parser.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the server, e.g. LUCIA_OVERFLOW_POLICY=drop_oldest")
+    parser.add_argument("--json", help="write machine-readable results to this file")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    results = asyncio.run(main_async(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "revision": git_revision(),
+                "timestamp": time.time(),
+                "mode": args.mode,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "results": results,
+            }, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,121 @@
+import argparse
+import itertools
+import json
+import os
 import socket
+import sqlite3
+import ssl
+import time
 import sys
 import threading
+from datetime import datetime
+from urllib.parse import quote
 from colors import cprint, print_error, print_info, print_success, print_warning, print_received, get_prompt, cstr
+from framing import LineReader
+from protocol import GREETING, GREETING_OK, encode_frame, read_frame, split_messages, greeting_options
+from protocol import Deflate, Inflate, ZLIB, ZDICT
+from protocol import LOGIN, PASSWORD, SEND, COMMAND
+from protocol import PASSWORD_REQUIRED, WELCOME, ERROR, INFO, SENT, USERS, CONTACTS, TEXT, MESSAGE, MISSED, HISTORY, UNREAD, GROUP_MESSAGE
+from protocol import SEARCH_RESULTS, SESSION_TOKEN, PRESENCE
+from history_cache import HistoryCache, DEFAULT_MAX_BYTES
+from tls import SessionCache, TLSSocket, client_context
 
 # Global state
 current_conversation = None
 active_conversation_lock = threading.Lock()
 sock = None
 should_exit = False
+# Oldest message sequence number we've been shown per contact, for /more
+oldest_seen = {}
+# Contacts whose history is partway through arriving (it comes in pages)
+history_in_progress = set()
+# Contacts whose cached history we've shown and asked the server to bring up to date
+delta_requests = set()
+# Local copy of this account's history, unless started with --no-cache
+cache = None
+# Request ids for the frames we send
+request_ids = itertools.count(1)
+# Set once the server agrees to compression
+deflate = None
+inflate = None
+# Set with --tls; connecting again resumes the last session with the server instead of a full handshake
+tls_context = None
+tls_sessions = SessionCache()
 
-# Helper function for the client (similar function found in server.py)
-def recv_line_client(s):
+# How many older messages /more asks for at a time
+MORE_PAGE_SIZE = 50
+# How many messages /open shows from the cache, like the server's default page
+OPEN_PAGE_SIZE = 50
+
+# Session tokens from the server, so logging back in doesn't need the password again.
+# Kept per server and username in a file only we can read.
+LUCIA_DIR = os.path.join(os.path.expanduser("~"), ".lucia")
+TOKENS_FILE = os.path.join(LUCIA_DIR, "tokens.json")
+# "host:port/username" of this session, for saving the tokens it gets
+session_key = None
+
+def load_tokens():
+    try:
+        with open(TOKENS_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_token(key, token, expires):
+    """Remember a token for key, or forget key's token if token is None."""
+    tokens = {k: v for k, v in load_tokens().items() if v[1] > time.time()}
+    if token is None:
+        tokens.pop(key, None)
+    else:
+        tokens[key] = [token, expires]
+    try:
+        os.makedirs(LUCIA_DIR, mode=0o700, exist_ok=True)
+        fd = os.open(TOKENS_FILE + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(tokens, f)
+        os.replace(TOKENS_FILE + ".tmp", TOKENS_FILE)
+    except OSError as e:
+        print_warning(f"Couldn't save the session token: {e}")
+
+def saved_token(key):
+    token, expires = load_tokens().get(key, (None, 0))
+    # Leave a little room so it doesn't expire on the way
+    return token if expires > time.time() + 5 else None
+
+def open_cache(key, max_bytes):
+    """The history cache for key ("host:port/username"), or None if it can't be opened."""
+    path = os.path.join(LUCIA_DIR, "history", quote(key, safe="") + ".sqlite3")
+    try:
+        return HistoryCache(path, max_bytes)
+    except (OSError, sqlite3.Error) as e:
+        print_warning(f"Couldn't open the history cache, carrying on without it: {e}")
+        return None
+
+def cache_messages(contact, messages):
+    if cache:
+        try:
+            cache.add_messages(contact, messages)
+        except sqlite3.Error as e:
+            print_warning(f"Couldn't cache messages from {contact}: {e}")
+
+# Helper function for the client (the server reads frames the same way)
+def recv_frame_client(reader):
     """
-    Reads a single line (up to a \n) from a socket.
-    Returns the line *without* the \n.
+    Reads a single protocol v2 frame through the shared buffered reader.
+    Returns (opcode, flags, request id, fields), or None once the server has gone.
     """
-    message = b""
-    while True:
-        try:
-            chunk = s.recv(1)
-            if not chunk:
-                # Server disconnected
-                return None
-            if chunk == b'\n':
-                # End of the line
-                return message
-            message += chunk
-        except ConnectionError:
-            return None
+    try:
+        return read_frame(reader, inflate)
+    except ConnectionError:
+        return None
+
+def send_frame(opcode, *fields):
+    """Sends a request frame to the server."""
+    frame = encode_frame(opcode, next(request_ids), *fields)
+    sock.sendall(deflate.pack(frame) if deflate else frame)
+
+def format_message(seq, sender, timestamp, body):
+    return f"#{seq} [{timestamp.strftime('%H:%M:%S')}] {sender}: {body}"
 
 def display_conversation_header(username):
     """Display conversation header for the given user."""
@@ -37,128 +125,328 @@ def display_conversation_footer():
     """Display conversation footer."""
     print_info("=== End of conversation ===\n")
 
-def receive_thread_func(sock):
+# Handlers for frames from the server, by opcode. Each gets the frame's fields.
+def on_message(fields):
+    # Incoming message from another user
+    messages = split_messages(fields)
+    sender, body = messages[0][1], messages[0][3]
+    cache_messages(sender, messages)
+    with active_conversation_lock:
+        # Only display if this is from the current conversation
+        if current_conversation == sender:
+            print_received(f"\n[from {sender}]: {body}")
+        else:
+            # Message from someone else - just note it
+            print_warning(f"\n[New message from {sender}] (type /open {sender} to view)")
+
+def on_group_message(fields):
+    # A message someone sent to a group we're in
+    group = fields[0].decode()
+    messages = split_messages(fields[1:])
+    sender, body = messages[0][1], messages[0][3]
+    cache_messages(group, messages)
+    with active_conversation_lock:
+        if current_conversation == group:
+            print_received(f"\n[from {sender} in {group}]: {body}")
+        else:
+            print_warning(f"\n[New message in {group} from {sender}] (type /open {group} to view)")
+
+def on_missed(fields):
+    sender = fields[0].decode()
+    where = "in" if sender.startswith("#") else "from"
+    print_warning(f"\n({int(fields[1])} earlier messages {where} {sender}, see /open {sender})")
+
+def on_history(fields):
+    # A page of history; the first one for a contact gets the header, the last the footer
+    contact = fields[0].decode()
+    start, end, total = int(fields[1]), int(fields[2]), int(fields[3])
+    older, newer, last = fields[4], fields[5], fields[6] == b"1"
+    messages = split_messages(fields[7:])
+    with active_conversation_lock:
+        # A delta goes under the cached messages /open already showed
+        delta = contact in delta_requests
+        first = contact not in history_in_progress
+        history_in_progress.add(contact)
+        if first and end > start:
+            # Remember where this page of history starts so /more can fetch the one before it
+            oldest_seen[contact] = min(start, oldest_seen.get(contact, start))
+    if cache:
+        cache_history(contact, messages, start, end, total, delta)
+    if first and delta:
+        if end > start:
+            print_info(f"(new: messages {start}-{end - 1} of {total})")
+    elif first:
+        display_conversation_header(contact)
+        if end > start:
+            print_info(f"(messages {start}-{end - 1} of {total})")
+        else:
+            print_info("(No messages yet)")
+        if older:
+            print_info("(older messages: /more)")
+    for seq, sender, timestamp, body in messages:
+        print_info(format_message(seq, sender, timestamp, body))
+    if last:
+        if newer and delta:
+            print_info(f"(more new messages: /open {contact} again)")
+        elif newer:
+            print_info(f"(newer messages: /history {contact} since={int(newer)})")
+        display_conversation_footer()
+        with active_conversation_lock:
+            history_in_progress.discard(contact)
+            delta_requests.discard(contact)
+
+def cache_history(contact, messages, start, end, total, delta):
+    try:
+        cursor = cache.cursor(contact)
+        if cursor is not None and total <= cursor:
+            # The conversation was deleted and started over since we cached it
+            cache.forget(contact)
+            print_warning(f"\n(Your conversation with {contact} changed on the server; /open {contact} to reload it)")
+            return
+        cache.add_page(contact, messages, start, end, total, delta)
+    except sqlite3.Error as e:
+        print_warning(f"Couldn't cache history with {contact}: {e}")
+
+def open_from_cache(contact, limit):
+    """
+    Shows the cached end of a conversation and asks the server only for what came
+    after it. Returns False if there's nothing cached for contact.
+    """
+    try:
+        cursor = cache.cursor(contact)
+        messages = cache.recent(contact, limit) if cursor is not None else []
+    except sqlite3.Error as e:
+        print_warning(f"Couldn't read the history cache: {e}")
+        return False
+    if cursor is None:
+        return False
+    display_conversation_header(contact)
+    if messages:
+        print_info(f"(messages {messages[0][0]}-{messages[-1][0]}, cached)")
+        if messages[0][0] > 0:
+            print_info("(older messages: /more)")
+    for message in messages:
+        print_info(format_message(*message))
+    with active_conversation_lock:
+        delta_requests.add(contact)
+        if messages:
+            oldest_seen[contact] = messages[0][0]
+    send_frame(COMMAND, "/history", contact, f"since={cursor}")
+    return True
+
+def on_unread(fields):
+    # What a contact sent while we were offline, pushed right after login
+    contact, unread, older = fields[0].decode(), int(fields[1]), fields[2]
+    print_warning(f"\n--- While you were away: {unread} new message(s) from {contact} ---")
+    if older:
+        print_info(f"(older unread: /open {contact} before={int(older)})")
+    messages = split_messages(fields[3:])
+    cache_messages(contact, messages)
+    for seq, sender, timestamp, body in messages:
+        print_info(format_message(seq, sender, timestamp, body))
+
+def on_users(fields):
+    print_info("Connected users: " + ", ".join(field.decode() for field in fields))
+
+def on_contacts(fields):
+    if not fields:
+        print_info("You have no contacts yet.")
+        return
+    entries = []
+    for contact, ts in zip(fields[::2], fields[1::2]):
+        when = f" ({datetime.fromtimestamp(float(ts)).strftime('%Y-%m-%d %H:%M:%S')})" if ts else ""
+        entries.append(contact.decode() + when)
+    print_info("Your contacts: " + ", ".join(entries))
+
+def on_text(fields):
+    # Multi-line responses (like /help)
+    print()  # New line for readability
+    for line in fields:
+        if line.strip():
+            print_info(line.decode())
+    print()  # Newline after multi-line response for spacing
+
+def on_search_results(fields):
+    query, page, next_page = fields[0].decode(), int(fields[1]), fields[2].decode()
+    results = fields[3:]
+    if not results and page == 1:
+        print_info(f"No messages found matching '{query}'.")
+        return
+    print_info(f"\n=== Search results for '{query}' (page {page}) ===")
+    for i in range(0, len(results) - 4, 5):
+        contact = results[i].decode()
+        for seq, sender, timestamp, body in split_messages(results[i + 1:i + 5]):
+            print(f"{contact} " + format_message(seq, sender, timestamp, body))
+    if next_page:
+        print_info(f"(more results: {next_page})")
+    print_info("(to see one in context: /open <contact> 20 before=<number + 10>)")
+    print_info("=== End of search results ===\n")
+
+def on_session_token(fields):
+    if session_key:
+        save_token(session_key, fields[0].decode(), int(fields[1]))
+
+def on_presence(fields):
+    # Who came online or left since the last update, for /presence subscribe
+    changes = list(zip(fields[::2], fields[1::2]))
+    online = [name.decode() for name, now_online in changes if now_online]
+    offline = [name.decode() for name, now_online in changes if not now_online]
+    if online:
+        print_info("Online: " + ", ".join(online))
+    if offline:
+        print_info("Offline: " + ", ".join(offline))
+
+RECEIVE_HANDLERS = {
+    MESSAGE: on_message,
+    GROUP_MESSAGE: on_group_message,
+    SEARCH_RESULTS: on_search_results,
+    MISSED: on_missed,
+    HISTORY: on_history,
+    UNREAD: on_unread,
+    USERS: on_users,
+    CONTACTS: on_contacts,
+    TEXT: on_text,
+    SESSION_TOKEN: on_session_token,
+    PRESENCE: on_presence,
+    SENT: lambda fields: print_info(f"Message sent to {fields[0].decode()}."),
+    INFO: lambda fields: print_info(fields[0].decode()),
+    ERROR: lambda fields: print_error("ERROR: " + fields[0].decode()),
+}
+
+def receive_thread_func(reader):
     """Background thread that listens for incoming messages and updates."""
-    global current_conversation, should_exit
+    global should_exit
     
     while not should_exit:
         try:
-            data = recv_line_client(sock)
-            if data is None:
+            frame = recv_frame_client(reader)
+            if frame is None:
                 print_warning("\nServer disconnected.")
                 should_exit = True
                 break
             
-            response = data.decode().strip()
-            if not response:
+            opcode, _, _, fields = frame
+            handler = RECEIVE_HANDLERS.get(opcode)
+            if handler is None:
+                print_warning(f"Ignoring frame with unknown opcode {opcode}")
                 continue
-            
-            # Handle incoming messages from other users
-            if response.startswith("[from "):
-                # Extract sender from "[from username]: message"
-                parts = response.split("]:", 1)
-                if len(parts) == 2:
-                    sender = parts[0].replace("[from ", "").strip()
-                    message_content = parts[1].strip()
-                    
-                    with active_conversation_lock:
-                        # Only display if this is from the current conversation
-                        if current_conversation == sender:
-                            print_received(f"\n[from {sender}]: {message_content}")
-                        else:
-                            # Message from someone else - just note it
-                            print_warning(f"\n[New message from {sender}] (type /open {sender} to view)")
-                continue
-            
-            # Handle multi-line responses (like /open, /help, /contacts, etc.)
-            if "|||" in response:
-                lines = response.split("|||")
-                print()  # New line for readability
-                for line in lines:
-                    if line.strip():
-                        print_info(line)
-                print()  # Newline after multi-line response for spacing
-                continue
-            
-            # Handle conversation displays
-            if response.startswith("==="):
-                print_info(response)
-                continue
-            
-            # Handle errors
-            if "ERROR:" in response:
-                print_error(response)
-                continue
-            
-            # Handle single-line info messages
-            if any(keyword in response for keyword in ["Connected users:", "Your contacts:", "Started new", "Deleted conversation", "Message sent"]):
-                print_info(response)
-                continue
-            
-            # Default handling for other messages
-            if response:
-                print_info(response)
+            handler(fields)
                 
         except Exception as e:
             if not should_exit:
                 print_error(f"Error in receive thread: {e}")
 
+def connect(host, port):
+    """Connects and switches to protocol v2. Returns the reader, or None if the server can't."""
+    global sock, deflate, inflate
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((host, port))
+    if tls_context is not None:
+        sock = TLSSocket(tls_context.wrap_socket(sock, server_hostname=host, session=tls_sessions.get(host, port)))
+    reader = LineReader(sock)
+    
+    # Ask for protocol v2 (binary frames) instead of the old text lines, compressed if the server agrees
+    sock.sendall(b" ".join([GREETING, ZLIB.encode(), ZDICT.encode()]) + b'\n')
+    options = greeting_options(reader.read_line() or b"", GREETING_OK)
+    if options is None:
+        print_error("Server doesn't speak protocol 2; please update it.")
+        return None
+    if tls_context is not None:
+        # The server's session tickets arrived ahead of its reply
+        tls_sessions.save(host, port, sock)
+    deflate = inflate = None
+    if ZLIB in options:
+        deflate = Deflate(ZDICT in options)
+        inflate = Inflate(ZDICT in options)
+    return reader
+
+def log_in(reader, username, token):
+    """
+    Sends our username, and the saved session token or the password if the server asks.
+    Returns the server's answer, or None if it hung up.
+    """
+    send_frame(LOGIN, username)
+    frame = recv_frame_client(reader)
+    if frame is None:
+        print_error("Server closed connection during login.")
+        return None
+    
+    if frame[0] == PASSWORD_REQUIRED:
+        password = token or input(get_prompt("Enter password >> "))
+        send_frame(PASSWORD, password)
+        
+        frame = recv_frame_client(reader)
+        if frame is None and not token:
+            print_error("Login failed. Server disconnected.")
+    return frame
+
 def main():
-    global current_conversation, sock, should_exit
+    global current_conversation, should_exit, session_key, cache, tls_context
+    
+    parser = argparse.ArgumentParser(description="Lucia chat client")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="don't keep a local copy of message history; /open fetches it all each time")
+    parser.add_argument("--cache-size", type=float, default=DEFAULT_MAX_BYTES / 2 ** 20, metavar="MiB",
+                        help="most history to keep locally per account (default %(default)g MiB)")
+    parser.add_argument("--tls", action="store_true", help="connect with TLS (the server needs LUCIA_TLS_CERT)")
+    parser.add_argument("--cafile", metavar="PEM",
+                        help="trust the server certificates signed by this CA (or a self-signed one) instead of the system's")
+    args = parser.parse_args()
+    if args.tls or args.cafile:
+        try:
+            tls_context = client_context(args.cafile)
+        except (OSError, ssl.SSLError) as e:
+            parser.error(f"can't load {args.cafile}: {e}")
     
     HOST = input(get_prompt("Enter server IP address >> "))
     if HOST == "":
         HOST = "127.0.0.1"
     PORT = 1337
     USERNAME = input(get_prompt("Enter your username >> "))
+    session_key = f"{HOST}:{PORT}/{USERNAME}"
+    if not args.no_cache:
+        cache = open_cache(session_key, int(args.cache_size * 2 ** 20))
 
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((HOST, PORT))
-        print_success(f"Connected to {HOST}:{PORT} as {USERNAME}")
-        
-        # Send username to server
-        sock.sendall(USERNAME.encode() + b'\n')
+        reader = connect(HOST, PORT)
+        if reader is None:
+            return
+        secured = ""
+        if tls_context is not None:
+            secured = f" over {sock.version()}" + (", session resumed" if sock.session_reused else "")
+        print_success(f"Connected to {HOST}:{PORT} as {USERNAME}{secured}")
 
-        # Login - Wait for server's first response
-        response_bytes = recv_line_client(sock)
-        if response_bytes is None:
-            print_error("Server closed connection during login.")
+        token = saved_token(session_key)
+        frame = log_in(reader, USERNAME, token)
+        if frame is None and token:
+            # Expired, or the password changed since; try again the long way
+            print_warning("Your saved session is no longer valid; please log in again.")
+            save_token(session_key, None, 0)
+            sock.close()
+            reader = connect(HOST, PORT)
+            frame = log_in(reader, USERNAME, None) if reader else None
+        if frame is None:
             return
-        
-        response_str = response_bytes.decode()
-        print_info(response_str)
-        
-        if "Enter password:" in response_str:
-            password = input(get_prompt(">> "))
-            sock.sendall(password.encode() + b'\n')
-            
-            auth_response_bytes = recv_line_client(sock)
-            if auth_response_bytes is None:
-                print_error("Login failed. Server disconnected.")
-                return
-                
-            auth_response_str = auth_response_bytes.decode()
-            print_success(auth_response_str) if "success" in auth_response_str.lower() else print_info(auth_response_str)
-            
-            if "ERROR:" in auth_response_str:
-                print_error("Authentication failed.")
-                return
 
-        elif "registered" in response_str:
-            pass
-        elif "ERROR:" in response_str:
+        opcode, _, _, fields = frame
+        if opcode == WELCOME:
+            if fields[1] == b"registered":
+                print_success(f"Welcome, {USERNAME}! You are now registered.")
+            else:
+                print_success("Authenticated successfully.")
+        elif opcode == ERROR:
+            print_error("ERROR: " + fields[0].decode())
             return
         else:
-            print(f"Unknown server response: {response_str}")
+            print(f"Unknown server response: opcode {opcode}")
             return
 
         # Start background receive thread
-        receiver = threading.Thread(target=receive_thread_func, args=(sock,), daemon=True)
+        receiver = threading.Thread(target=receive_thread_func, args=(reader,), daemon=True)
         receiver.start()
 
         # Main input loop
-        print_info("Commands: /list, /contacts, /open <user>, /delete <user>, /help")
+        print_info("Commands: /list, /presence, /contacts, /open <user>, /more, /delete <user>, /group, /search, /password, /help")
         print_info("To message someone: /msg <username> or type message after /open")
         
         while not should_exit:
@@ -169,11 +457,36 @@ def main():
                 
                 # Handle opening a conversation
                 if message.startswith("/open "):
-                    username = message.split(" ", 1)[1].strip()
+                    parts = message.split()
+                    username = parts[1]
                     with active_conversation_lock:
                         current_conversation = username
+                        # A fresh /open starts paging from the newest messages again
+                        oldest_seen.pop(username, None)
+                        delta_requests.discard(username)
                     
-                    sock.sendall(message.encode() + b'\n')
+                    # With the conversation cached, only fetch what's new (unless asked for an older page)
+                    limit = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else OPEN_PAGE_SIZE
+                    if cache and not any("=" in part for part in parts[2:]) and open_from_cache(username, limit):
+                        continue
+                    send_frame(COMMAND, *parts)
+                    continue
+                
+                # Handle /more: fetch the page of history before the oldest one shown
+                if message.strip() == "/more":
+                    with active_conversation_lock:
+                        contact = current_conversation
+                        oldest = oldest_seen.get(contact)
+                    if not contact:
+                        print_error("Open a conversation first with /open <user>")
+                    elif oldest is None:
+                        print_error(f"Waiting for history from {contact}, try again in a moment")
+                    elif oldest == 0:
+                        print_info(f"That's the start of your conversation with {contact}.")
+                    else:
+                        with active_conversation_lock:
+                            delta_requests.discard(contact)
+                        send_frame(COMMAND, "/open", contact, str(MORE_PAGE_SIZE), f"before={oldest}")
                     continue
                 
                 # Handle /msg command
@@ -185,23 +498,30 @@ def main():
                     
                     recipient = parts[1]
                     msg_content = parts[2]
-                    formatted_msg = f"{recipient}: {msg_content}"
                     
                     with active_conversation_lock:
                         current_conversation = recipient
                     
-                    sock.sendall(formatted_msg.encode() + b'\n')
+                    send_frame(SEND, recipient, msg_content)
                     continue
                 
                 # If in a conversation and message is plain text, send it
                 with active_conversation_lock:
-                    if current_conversation and not message.startswith("/"):
-                        formatted_msg = f"{current_conversation}: {message}"
-                        sock.sendall(formatted_msg.encode() + b'\n')
-                        continue
+                    recipient = current_conversation
+                if recipient and not message.startswith("/"):
+                    send_frame(SEND, recipient, message)
+                    continue
                 
-                # Otherwise, send as-is (could be a command)
-                sock.sendall(message.encode() + b'\n')
+                # Otherwise it's a command, or "recipient: message"
+                if message.startswith("/delete ") and cache and len(message.split()) > 1:
+                    cache.forget(message.split()[1])
+                if message.startswith("/"):
+                    send_frame(COMMAND, *message.split())
+                elif ":" in message:
+                    recipient, msg_content = message.split(":", 1)
+                    send_frame(SEND, recipient.strip(), msg_content.strip())
+                else:
+                    print_error("Open a conversation first with /open <user>, or type recipient: message")
                 
             except KeyboardInterrupt:
                 print_warning("\nDisconnecting...")
@@ -214,12 +534,16 @@ def main():
         print_warning("\nDisconnecting...")
     except ConnectionRefusedError:
         print_error(f"Connection refused. Is the server running on {HOST}:{PORT}?")
+    except ssl.SSLError as e:
+        print_error(f"TLS connection to {HOST}:{PORT} failed: {e}")
     except Exception as e:
         print_error(f"An error occurred: {e}")
     finally:
         should_exit = True
         if sock:
             sock.close()
+        if cache:
+            cache.close()
         print_info("Connection closed.")
 
 if __name__ == "__main__":
@@ -0,0 +1,489 @@
+"""
+Multi-process mode for Lucia.
+
+A supervisor runs a hub and starts K worker processes that all listen on the
+same port with SO_REUSEPORT, so the kernel spreads connections across them and
+routing isn't limited to one core by the GIL.
+
+Every worker keeps a full replica of the message store. Anything that changes
+it (messages, /new, /delete, delivery cursors) is published to the hub as an
+op; the hub puts ops from all workers into a single order and sends each one to
+every worker, the sender included, which applies it. Because every replica
+applies the same ops in the same order, sequence numbers match everywhere and
+/contacts and /open give the same answers as a single process would. Delivery
+cursors only matter where a user is logged in, so like the disk backend's they
+are sent to the other workers once, at logout.
+
+Full replication is deliberate. The kernel decides which worker a client lands
+on, and /open, /history, /contacts, /search and the catch-up at login all read
+the local store, so every worker needs every conversation. Sending an op only to
+the recipient's worker would mean forwarding all of those reads instead. The
+price is that every worker applies every op, so store work and memory per
+message grow with the worker count. Throughput stops scaling once applying the
+op stream costs a worker as much as its share of client I/O. Only the worker the
+presence directory has the recipient on delivers to them; the rest just store
+the message. benchmarks/bench_workers.py measures the scaling curve and fails
+below a set efficiency.
+
+The hub also owns the presence directory (username -> worker) and the set of
+known users. Logins claim a name at the hub, which rules out logging in twice
+on different workers, and every worker gets a copy of the directory for /list
+and for routing.
+
+Hub <-> worker traffic is length-prefixed frames over a unix domain socket:
+FRAME header (payload length, kind) followed by fields, each a FIELD length
+and UTF-8 bytes.
+"""
+
+import os
+import selectors
+import socket
+import struct
+import threading
+from concurrent.futures import Future, TimeoutError
+from itertools import count
+from typing import Any, Callable, Dict, List, Optional
+from colors import print_error
+
+FRAME = struct.Struct("<IB")
+FIELD = struct.Struct("<I")
+
+# Frame kinds
+HELLO = 1       # worker -> hub: worker id
+READY = 2       # hub -> worker: every worker has connected, start serving
+CLAIM = 3       # worker -> hub: request id, username, "new", "existing" or "register"
+REPLY = 4       # hub -> worker: request id, result
+RELEASE = 5     # worker -> hub: username logged out
+USER = 6        # hub -> all: username registered
+ONLINE = 7      # hub -> all: username, worker id
+OFFLINE = 8     # hub -> all: username
+OP = 9          # worker -> hub -> all: origin worker, op number, op name, arguments
+
+# Results of a CLAIM
+REGISTERED = "registered"   # New name, now registered (and logged in here, unless "register")
+KNOWN = "known"             # "new" or "register" claim for a name that already exists
+CONNECTED = "connected"     # Logged in here
+TAKEN = "taken"             # Already logged in somewhere
+
+RECV_SIZE = 256 * 1024
+# How long connect() and register_and_connect() wait for the hub's answer (seconds)
+CLAIM_TIMEOUT = 10.0
+
+
+def encode_frame(kind: int, *fields) -> bytes:
+    body = bytearray()
+    for field in fields:
+        data = field.encode() if isinstance(field, str) else bytes(field)
+        body += FIELD.pack(len(data))
+        body += data
+    return FRAME.pack(len(body), kind) + body
+
+
+def decode_fields(payload) -> List[str]:
+    fields = []
+    offset = 0
+    while offset < len(payload):
+        (length,) = FIELD.unpack_from(payload, offset)
+        offset += FIELD.size
+        fields.append(bytes(payload[offset:offset + length]).decode())
+        offset += length
+    return fields
+
+
+def split_frames(buffer: bytearray):
+    """Yields (kind, start, end) for each complete frame in buffer; end is where its payload stops."""
+    offset = 0
+    while offset + FRAME.size <= len(buffer):
+        length, kind = FRAME.unpack_from(buffer, offset)
+        end = offset + FRAME.size + length
+        if end > len(buffer):
+            break
+        yield kind, offset, end
+        offset = end
+
+
+class Hub:
+    """
+    Sequencer and presence directory, run by the supervisor on one thread.
+    OP frames are never decoded here: runs of them are copied as raw bytes onto
+    every worker's outbound buffer, which is what puts them in one global order.
+    """
+
+    def __init__(self, path: str, workers: int):
+        self.path = path
+        self.workers = workers
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(workers)
+        self.listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        # Per connection: inbound buffer, outbound buffer, worker id once it said HELLO
+        self.inbound: Dict[socket.socket, bytearray] = {}
+        self.outbound: Dict[socket.socket, bytearray] = {}
+        self.worker_ids: Dict[socket.socket, str] = {}
+        self.known = set()
+        self.presence: Dict[str, str] = {}
+        self.ready = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            for key, events in self.selector.select():
+                sock = key.fileobj
+                if sock is self.listener:
+                    self._accept()
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    self._flush(sock)
+                if events & selectors.EVENT_READ and sock in self.inbound:
+                    self._read(sock)
+
+    def _accept(self):
+        try:
+            conn, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self.inbound[conn] = bytearray()
+        self.outbound[conn] = bytearray()
+        self.selector.register(conn, selectors.EVENT_READ)
+
+    def _read(self, sock):
+        try:
+            data = sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(sock)
+            return
+        buffer = self.inbound[sock]
+        buffer += data
+        consumed = 0
+        run_start = run_end = None
+        for kind, start, end in split_frames(buffer):
+            consumed = end
+            if kind == OP:
+                # Extend the current run of ops; they're forwarded as one slice
+                if run_start is None:
+                    run_start = start
+                run_end = end
+                continue
+            if run_start is not None:
+                self._broadcast(buffer[run_start:run_end])
+                run_start = None
+            self._handle(sock, kind, decode_fields(memoryview(buffer)[start + FRAME.size:end]))
+        if run_start is not None:
+            self._broadcast(buffer[run_start:run_end])
+        del buffer[:consumed]
+
+    def _handle(self, sock, kind: int, fields: List[str]):
+        if kind == HELLO:
+            self.worker_ids[sock] = fields[0]
+            if len(self.worker_ids) == self.workers and not self.ready:
+                self.ready = True
+                self._broadcast(encode_frame(READY))
+        elif kind == CLAIM:
+            request_id, username, mode = fields
+            if mode == "register":
+                # Only add the name; nobody logs in
+                result = KNOWN if username in self.known else REGISTERED
+                if result == REGISTERED:
+                    self.known.add(username)
+                    self._broadcast(encode_frame(USER, username))
+            elif username in self.presence:
+                result = TAKEN
+            elif mode == "new" and username in self.known:
+                result = KNOWN
+            else:
+                result = REGISTERED if mode == "new" else CONNECTED
+                if username not in self.known:
+                    self.known.add(username)
+                    self._broadcast(encode_frame(USER, username))
+                self.presence[username] = self.worker_ids[sock]
+                self._broadcast(encode_frame(ONLINE, username, self.worker_ids[sock]))
+            self._send(sock, encode_frame(REPLY, request_id, result))
+        elif kind == RELEASE:
+            username = fields[0]
+            if self.presence.get(username) == self.worker_ids.get(sock):
+                del self.presence[username]
+                self._broadcast(encode_frame(OFFLINE, username))
+
+    def _send(self, sock, data):
+        out = self.outbound.get(sock)
+        if out is None:
+            return
+        if not out:
+            self.selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        out += data
+
+    def _broadcast(self, data):
+        for sock in self.worker_ids:
+            self._send(sock, data)
+
+    def _flush(self, sock):
+        out = self.outbound.get(sock)
+        if not out:
+            return
+        try:
+            sent = sock.send(out)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._drop(sock)
+            return
+        del out[:sent]
+        if not out:
+            self.selector.modify(sock, selectors.EVENT_READ)
+
+    def _drop(self, sock):
+        # A worker went away: everyone logged in there is offline now
+        self.selector.unregister(sock)
+        worker_id = self.worker_ids.pop(sock, None)
+        self.inbound.pop(sock, None)
+        self.outbound.pop(sock, None)
+        sock.close()
+        for username in [u for u, w in self.presence.items() if w == worker_id]:
+            del self.presence[username]
+            self._broadcast(encode_frame(OFFLINE, username))
+
+    def close(self):
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class ClusterBus:
+    """
+    A worker's connection to the hub. publish() sends an op to be applied
+    everywhere; a reader thread applies incoming ops with the registered handlers,
+    in hub order, and keeps the local copy of the presence directory current.
+    """
+
+    def __init__(self, path: str, worker_id: str):
+        self.worker_id = worker_id
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self._send_lock = threading.Lock()
+        self._request_ids = count(1)
+        self._pending: Dict[str, Future] = {}
+        self._pending_lock = threading.Lock()
+        # Ops we've published, and how many of those have come back and been applied
+        self._published = 0
+        self._applied = 0
+        self._applied_lock = threading.Lock()
+        # sync_future() callers still waiting: (op number, future)
+        self._sync_waiters: List[tuple] = []
+        # Replicated from the hub
+        self.known = set()
+        self.presence: Dict[str, str] = {}
+        self.ready = threading.Event()
+        self.handlers: Dict[str, Callable[..., Any]] = {}
+        # Called if the hub goes away
+        self.on_close: Optional[Callable[[], None]] = None
+        # Called with (username, True/False) when someone logs in or out on any worker
+        self.on_presence: Optional[Callable[[str, bool], None]] = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self, handlers: Dict[str, Callable[..., Any]]):
+        """Start applying ops with handlers (op name -> function taking the op's arguments)."""
+        self.handlers = handlers
+        self.thread.start()
+        self._send(encode_frame(HELLO, self.worker_id))
+
+    def _send(self, frame: bytes):
+        with self._send_lock:
+            self.sock.sendall(frame)
+
+    def publish(self, op: str, *args):
+        """Send an op for every worker (this one included) to apply, in hub order."""
+        with self._send_lock:
+            self._published += 1
+            self.sock.sendall(encode_frame(OP, self.worker_id, str(self._published), op, *args))
+
+    def sync_future(self) -> Future:
+        """
+        A Future that's done once every op published so far has been applied here
+        (read-your-writes). Callers wait on it rather than block, as the asyncio engine can't.
+        """
+        future = Future()
+        target = self._published
+        with self._applied_lock:
+            if self._applied < target:
+                self._sync_waiters.append((target, future))
+                return future
+        future.set_result(None)
+        return future
+
+    def request_future(self, kind: int, *fields) -> Future:
+        """Send a frame the hub answers with a REPLY; the Future gets the answer."""
+        request_id = str(next(self._request_ids))
+        future = Future()
+        with self._pending_lock:
+            self._pending[request_id] = future
+        self._send(encode_frame(kind, request_id, *fields))
+        return future
+
+    def request(self, kind: int, *fields, timeout: float = 10.0) -> Optional[str]:
+        """request_future(), waiting for the answer; None if it doesn't come in time."""
+        future = self.request_future(kind, *fields)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            return None
+
+    def release(self, username: str):
+        self._send(encode_frame(RELEASE, username))
+
+    def _run(self):
+        buffer = bytearray()
+        try:
+            while True:
+                data = self.sock.recv(RECV_SIZE)
+                if not data:
+                    break
+                buffer += data
+                consumed = 0
+                for kind, start, end in split_frames(buffer):
+                    consumed = end
+                    self._handle(kind, decode_fields(memoryview(buffer)[start + FRAME.size:end]))
+                del buffer[:consumed]
+        except OSError:
+            pass
+        except Exception as e:
+            # Past this point our replica would fall behind the others without anyone knowing
+            print_error(f"Cluster bus stopped: {e}")
+        if self.on_close is not None:
+            self.on_close()
+
+    def _handle(self, kind: int, fields: List[str]):
+        if kind == OP:
+            origin, number, op = fields[:3]
+            try:
+                self.handlers[op](*fields[3:])
+            except Exception as e:
+                # Every worker applies the same op to the same replica and fails the same way,
+                # so skipping it keeps them in step; the op stream must carry on
+                print_error(f"Error applying cluster op '{op}': {e}")
+            finally:
+                if origin == self.worker_id:
+                    with self._applied_lock:
+                        self._applied = int(number)
+                        done = [f for target, f in self._sync_waiters if target <= self._applied]
+                        if done:
+                            self._sync_waiters = [(t, f) for t, f in self._sync_waiters if t > self._applied]
+                    for future in done:
+                        future.set_result(None)
+        elif kind == REPLY:
+            with self._pending_lock:
+                future = self._pending.pop(fields[0], None)
+            if future is not None:
+                future.set_result(fields[1])
+        elif kind == USER:
+            self.known.add(fields[0])
+        elif kind == ONLINE:
+            self.presence[fields[0]] = fields[1]
+            if self.on_presence is not None:
+                self.on_presence(fields[0], True)
+        elif kind == OFFLINE:
+            self.presence.pop(fields[0], None)
+            if self.on_presence is not None:
+                self.on_presence(fields[0], False)
+        elif kind == READY:
+            self.ready.set()
+
+
+class ClusterRegistry:
+    """
+    UserRegistry for a worker: the same methods, but names are claimed at the hub
+    and /list sees everyone logged in on any worker. Only writers for users
+    connected to this worker are kept here.
+    """
+
+    def __init__(self, bus: ClusterBus):
+        self.bus = bus
+        self._lock = threading.Lock()
+        self._writers: Dict[str, Any] = {}
+        # Called with the username after a logout stops deliveries here but before
+        # the hub hears of it, so ops it publishes are ordered before any new login
+        self.before_release: Optional[Callable[[str], None]] = None
+
+    def register(self, username: str) -> bool:
+        if self.bus.request(CLAIM, username, "register") != REGISTERED:
+            return False
+        self.bus.known.add(username)
+        return True
+
+    def is_known(self, username: str) -> bool:
+        return username in self.bus.known
+
+    def is_connected(self, username: str) -> bool:
+        return username in self.bus.presence
+
+    def claim(self, username: str, writer: Any, new: bool) -> Future:
+        """
+        register_and_connect() (new) or connect() without waiting for the hub:
+        the Future comes back True once username is logged in here.
+        """
+        mode, success = ("new", REGISTERED) if new else ("existing", CONNECTED)
+        claimed = Future()
+
+        def answered(reply: Future):
+            if reply.result() != success:
+                claimed.set_result(False)
+                return
+            with self._lock:
+                self._writers[username] = writer
+            # The hub broadcasts these too; recording them now means this worker
+            # sees its own login straight away
+            self.bus.known.add(username)
+            self.bus.presence[username] = self.bus.worker_id
+            claimed.set_result(True)
+
+        self.bus.request_future(CLAIM, username, mode).add_done_callback(answered)
+        return claimed
+
+    def _wait(self, claimed: Future) -> bool:
+        try:
+            return claimed.result(CLAIM_TIMEOUT)
+        except TimeoutError:
+            return False
+
+    def connect(self, username: str, writer: Any) -> bool:
+        return self._wait(self.claim(username, writer, False))
+
+    def register_and_connect(self, username: str, writer: Any) -> bool:
+        return self._wait(self.claim(username, writer, True))
+
+    def disconnect(self, username: str, writer: Any) -> bool:
+        with self._lock:
+            if self._writers.get(username) is not writer:
+                return False
+            del self._writers[username]
+        if self.before_release is not None:
+            self.before_release(username)
+        self.bus.release(username)
+        return True
+
+    def get_writer(self, username: str) -> Optional[Any]:
+        return self._writers.get(username)
+
+    def lookup(self, username: str):
+        return username in self.bus.known, self._writers.get(username)
+
+    def connected_writers(self) -> List[Any]:
+        with self._lock:
+            return list(self._writers.values())
+
+    def connected_users(self) -> List[str]:
+        return list(self.bus.presence.copy())
+
+    def known_users(self) -> List[str]:
+        return list(self.bus.known.copy())
@@ -1,10 +1,17 @@
 """
 A simple color utility module for adding ANSI colors to terminal output.
 Uses 24-bit "true color" escape codes for a modern look.
-NOTE: Assumes the terminal running this supports ANSI color codes.
+Colors are left out automatically when stdout isn't a terminal.
+
+By default everything is printed straight away, which is what the client wants.
+A server can call configure_logging() to filter by level and hand lines to a
+background writer instead, so logging never blocks a thread on stdout.
 """
 
+import atexit
 import sys
+import threading
+from collections import deque
 
 # 24-bit "True Color" (RGB) escape codes
 # \33[38;2;R;G;Bm  <- Foreground
@@ -44,6 +51,31 @@ COLORS = {
     "WHITE": "\33[38;2;255;255;255m",
 }
 
+# Log levels. The print_* shortcuts each log at one of these.
+DEBUG = 10      # print_received: one line per routed message
+INFO = 20       # print_info, print_success
+WARNING = 30    # print_warning
+ERROR = 40      # print_error
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+# Most lines the background writer holds before new ones are dropped
+DEFAULT_QUEUE_SIZE = 10000
+
+# Escape codes by upper-cased key, built once so cstr() doesn't look up COLORS on every call
+_PREFIXES = {key.upper(): code for key, code in COLORS.items()}
+_END = COLORS["ENDC"]
+
+def _stdout_is_tty() -> bool:
+    try:
+        return sys.stdout.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+# Current settings; see configure_logging()
+_level = DEBUG
+_use_color = _stdout_is_tty()
+_sink = None
+
 def cstr(text: str, color_key: str = "SYSTEM") -> str:
     """
     Returns a text string wrapped in the specified color codes.
@@ -56,10 +88,11 @@ def cstr(text: str, color_key: str = "SYSTEM") -> str:
     Returns:
         str: The color-wrapped string.
     """
+    if not _use_color:
+        return text
     # Get the color code, default to empty string if key is invalid
-    color_code = COLORS.get(color_key.upper(), "")
-    end_code = COLORS['ENDC']
-    return f"{color_code}{text}{end_code}"
+    color_code = _PREFIXES.get(color_key) or _PREFIXES.get(color_key.upper(), "")
+    return f"{color_code}{text}{_END}"
 
 def cprint(text: str, color_key: str = "SYSTEM", **kwargs):
     """
@@ -71,29 +104,127 @@ def cprint(text: str, color_key: str = "SYSTEM", **kwargs):
         color_key (str): The key from the COLORS dictionary (e.g., "ERROR").
         **kwargs: Additional args for the built-in print() function.
     """
-    print(cstr(text, color_key), **kwargs)
+    sink = _sink
+    if sink is not None and set(kwargs) <= {"end", "flush"}:
+        # Queue it for the background writer instead of writing here
+        sink.write(cstr(text, color_key) + kwargs.get("end", "\n"))
+    else:
+        print(cstr(text, color_key), **kwargs)
+
+def log_enabled(level: int) -> bool:
+    """Whether lines at this level are printed. Check it before building expensive log lines."""
+    return level >= _level
 
 #Convenience Functions cause my ass is not using all those parameters
 
 def print_error(text: str, **kwargs):
     """Shortcut for cprint(text, "ERROR")"""
-    cprint(text, "ERROR", **kwargs)
+    if ERROR >= _level:
+        cprint(text, "ERROR", **kwargs)
 
 def print_warning(text: str, **kwargs):
     """Shortcut for cprint(text, "WARNING")"""
-    cprint(text, "WARNING", **kwargs)
+    if WARNING >= _level:
+        cprint(text, "WARNING", **kwargs)
 
 def print_success(text: str, **kwargs):
     """Shortcut for cprint(text, "SUCCESS")"""
-    cprint(text, "SUCCESS", **kwargs)
+    if INFO >= _level:
+        cprint(text, "SUCCESS", **kwargs)
 
 def print_info(text: str, **kwargs):
     """Shortcut for cprint(text, "INFO")"""
-    cprint(text, "INFO", **kwargs)
+    if INFO >= _level:
+        cprint(text, "INFO", **kwargs)
 
 def print_received(text: str, **kwargs):
     """Shortcut for cprint(text, "RECEIVED")"""
-    cprint(text, "RECEIVED", **kwargs)
+    if DEBUG >= _level:
+        cprint(text, "RECEIVED", **kwargs)
+
+class LogSink:
+    """
+    Background writer for log lines. write() only appends to a bounded queue;
+    a daemon thread writes whatever has piled up in one go and flushes once per batch.
+    When the queue is full new lines are dropped (and counted) rather than blocking.
+    """
+    
+    def __init__(self, stream=None, max_queue: int = DEFAULT_QUEUE_SIZE):
+        self.stream = stream if stream is not None else sys.stdout
+        self.max_queue = max_queue
+        self.lines = deque()
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def write(self, line: str):
+        with self.cond:
+            if self.closed or len(self.lines) >= self.max_queue:
+                self.dropped += 1
+                return
+            self.lines.append(line)
+            if len(self.lines) == 1:
+                self.cond.notify()
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.lines and not self.closed:
+                    self.cond.wait()
+                if not self.lines:
+                    return
+                batch = list(self.lines)
+                self.lines.clear()
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                batch.append(cstr(f"({dropped} log lines dropped, the log couldn't keep up)", "WARNING") + "\n")
+            try:
+                self.stream.write("".join(batch))
+                self.stream.flush()
+            except (OSError, ValueError):
+                # Nowhere left to log to; keep draining so writers never back up
+                pass
+    
+    def close(self, timeout: float = 2.0):
+        """Writes out what's queued and stops the thread."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join(timeout)
+
+def configure_logging(level=None, background: bool = None, color: bool = None,
+                      max_queue: int = DEFAULT_QUEUE_SIZE):
+    """
+    Change how the print_* functions behave. Arguments left as None keep their setting.
+    
+    Args:
+        level: Lowest level to print, as a number or a name from LEVELS ("info" hides print_received).
+        background (bool): Hand lines to a LogSink thread instead of writing them in the caller.
+        color (bool): Force ANSI colors on or off (they default to on only when stdout is a TTY).
+        max_queue (int): How many lines the background writer may hold.
+    """
+    global _level, _use_color, _sink
+    if level is not None:
+        _level = LEVELS[level.lower()] if isinstance(level, str) else int(level)
+    if color is not None:
+        _use_color = color
+    if background is not None:
+        if background and _sink is None:
+            _sink = LogSink(max_queue=max_queue)
+        elif not background and _sink is not None:
+            shutdown_logging()
+
+def shutdown_logging():
+    """Flush and stop the background writer, if there is one."""
+    global _sink
+    sink, _sink = _sink, None
+    if sink is not None:
+        sink.close()
+
+# Don't lose queued lines when the process exits normally
+atexit.register(shutdown_logging)
 
 def get_prompt(text: str) -> str:
     """
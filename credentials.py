@@ -0,0 +1,164 @@
+"""
+Password hashes and session tokens for Lucia logins.
+
+Every user's password is kept as a salted scrypt (or PBKDF2) record that
+carries its own parameters, so records made with other settings keep working.
+Users who haven't set a password of their own log in with the server's shared
+one, which is hashed the same way.
+
+Checking a password costs tens of milliseconds of CPU on purpose, so it never
+runs on a connection's own thread or the event loop: verify() and hash() hand it
+to a small pool and return a Future. hashlib releases the GIL while the KDF
+runs, so the pool's threads don't hold up message routing, and a cap on queued
+checks turns a reconnect storm into quick "busy" replies instead of a backlog.
+
+After logging in, a client gets a session token: an expiry time and an HMAC of
+it, the username and the user's current password record. Presenting the token
+instead of the password skips the KDF entirely. Tokens need no server-side
+state, and changing the password invalidates every token issued before.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+SCRYPT = "scrypt"
+PBKDF2 = "pbkdf2"
+KDFS = (SCRYPT, PBKDF2) if hasattr(hashlib, "scrypt") else (PBKDF2,)
+DEFAULT_KDF = KDFS[0]
+# scrypt with N=2**14, r=8 takes 16 MiB and roughly 50-100 ms; PBKDF2 is tuned to about the same time
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 200_000
+SALT_BYTES = 16
+
+# Every token starts with this, and no password may
+TOKEN_PREFIX = "lt1."
+DEFAULT_TOKEN_TTL = 15 * 60
+# Password checks allowed to wait for (or run on) the pool at once
+DEFAULT_MAX_QUEUE = 256
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def hash_password(password: str, kdf: str = DEFAULT_KDF, salt: Optional[bytes] = None) -> str:
+    """A record for password, like "scrypt$16384$8$1$<salt>$<hash>"."""
+    salt = salt or os.urandom(SALT_BYTES)
+    if kdf == SCRYPT:
+        params = [str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P)]
+    elif kdf == PBKDF2:
+        params = ["sha256", str(PBKDF2_ITERATIONS)]
+    else:
+        raise ValueError(f"Unknown KDF '{kdf}'")
+    return "$".join([kdf] + params + [_b64(salt), _b64(_derive(password, kdf, params, salt))])
+
+
+def _derive(password: str, kdf: str, params, salt: bytes) -> bytes:
+    if kdf == SCRYPT:
+        n, r, p = map(int, params)
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=128 * r * n * 2, dklen=32)
+    digest, iterations = params
+    return hashlib.pbkdf2_hmac(digest, password.encode(), salt, int(iterations))
+
+
+def verify_password(password: str, record: str) -> bool:
+    try:
+        kdf, *params, salt, expected = record.split("$")
+        derived = _derive(password, kdf, params, _unb64(salt))
+    except (ValueError, TypeError):
+        return False
+    return hmac.compare_digest(derived, _unb64(expected))
+
+
+class Busy(Exception):
+    """Too many password checks are already waiting."""
+
+
+class Credentials:
+    """
+    Password records by username, the pool that checks them, and session tokens.
+    Safe to call from any thread.
+    """
+
+    def __init__(self, default_password: str, key: Optional[bytes] = None, kdf: str = DEFAULT_KDF,
+                 workers: int = 1, max_queue: int = DEFAULT_MAX_QUEUE, token_ttl: float = DEFAULT_TOKEN_TTL):
+        self.key = key or os.urandom(32)
+        self.kdf = kdf
+        self.token_ttl = token_ttl
+        self.max_queue = max_queue
+        self._records: Dict[str, str] = {}
+        # Salted from the key, so workers and restarts sharing the key agree on it (and on its tokens)
+        salt = hmac.new(self.key, b"default password", hashlib.sha256).digest()[:SALT_BYTES]
+        self._default_record = hash_password(default_password, kdf, salt)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="lucia-kdf")
+        self._lock = threading.Lock()
+        self.queued = 0
+        # Checks turned away because the queue was full
+        self.rejected = 0
+
+    def record(self, username: str) -> str:
+        return self._records.get(username, self._default_record)
+
+    def has_password(self, username: str) -> bool:
+        return username in self._records
+
+    def set_record(self, username: str, record: str):
+        self._records[username] = record
+
+    def records(self) -> Dict[str, str]:
+        """Every password set with /password, by username."""
+        return dict(self._records)
+
+    def _submit(self, fn, *args) -> Future:
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise Busy()
+            self.queued += 1
+        future = self._pool.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self.queued -= 1
+
+    def verify(self, username: str, password: str) -> Future:
+        """Check password on the pool; the Future's result is True if it's right. Raises Busy."""
+        return self._submit(verify_password, password, self.record(username))
+
+    def hash(self, password: str) -> Future:
+        """Hash a new password on the pool; the Future's result is its record. Raises Busy."""
+        return self._submit(hash_password, password, self.kdf)
+
+    def _sign(self, username: str, expires: int) -> str:
+        message = b"\0".join([username.encode(), str(expires).encode(), self.record(username).encode()])
+        return _b64(hmac.new(self.key, message, hashlib.sha256).digest())
+
+    def issue_token(self, username: str, now: Optional[float] = None) -> Tuple[str, int]:
+        """A session token for username and the unix time it expires."""
+        expires = int((time.time() if now is None else now) + self.token_ttl)
+        return f"{TOKEN_PREFIX}{expires}.{self._sign(username, expires)}", expires
+
+    def check_token(self, username: str, token: str, now: Optional[float] = None) -> bool:
+        """True if token was issued to username, hasn't expired and predates no password change."""
+        try:
+            expires, signature = token[len(TOKEN_PREFIX):].split(".", 1)
+            expires = int(expires)
+        except ValueError:
+            return False
+        if expires < (time.time() if now is None else now):
+            return False
+        return hmac.compare_digest(signature, self._sign(username, expires))
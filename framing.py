@@ -0,0 +1,100 @@
+"""
+Buffered line framing shared by the Lucia server and client.
+Reads from a socket in large chunks, splits on newlines and keeps any
+leftover bytes around for the next call. read_exact() reads from the same
+buffer, for the length-prefixed frames of protocol v2 (see protocol.py).
+"""
+
+import select
+import socket
+from typing import Optional
+
+# How many bytes we ask the kernel for on each recv
+RECV_SIZE = 64 * 1024
+# Longest line (not counting the \n) we accept before dropping the peer
+MAX_LINE_LENGTH = 1024 * 1024
+
+
+class LineTooLong(ValueError):
+    """Raised when the peer sends a line longer than the allowed maximum."""
+
+
+class FrameTooLong(LineTooLong):
+    """Raised when the peer announces a protocol v2 frame longer than the allowed maximum."""
+
+
+class LineReader:
+    """Reads newline terminated lines from a socket through a single buffer."""
+
+    def __init__(self, sock, max_line: int = MAX_LINE_LENGTH, recv_size: int = RECV_SIZE):
+        self.sock = sock
+        self.max_line = max_line
+        self.buffer = bytearray()
+        # Scratch space the kernel writes into, reused for every recv
+        self._chunk = memoryview(bytearray(recv_size))
+        # Bytes already searched for a newline, so we never rescan them
+        self._scanned = 0
+
+    def read_line(self) -> Optional[bytes]:
+        """
+        Returns the next line without the \\n, or None once the peer has closed.
+        A partial line left over at EOF is dropped, same as the old byte-by-byte reader.
+        """
+        while True:
+            index = self.buffer.find(b"\n", self._scanned)
+            if index >= 0:
+                if index > self.max_line:
+                    raise LineTooLong(f"Line exceeds {self.max_line} bytes")
+                line = bytes(self.buffer[:index])
+                # Deleting from the front of a bytearray is cheap in CPython
+                del self.buffer[:index + 1]
+                self._scanned = 0
+                return line
+
+            self._scanned = len(self.buffer)
+            if self._scanned > self.max_line:
+                raise LineTooLong(f"Line exceeds {self.max_line} bytes")
+
+            received = self.sock.recv_into(self._chunk)
+            if not received:
+                return None
+            self.buffer += self._chunk[:received]
+
+    def read_exact(self, size: int) -> Optional[bytes]:
+        """Returns the next size bytes, or None once the peer has closed before sending them all."""
+        while len(self.buffer) < size:
+            received = self.sock.recv_into(self._chunk)
+            if not received:
+                return None
+            self.buffer += self._chunk[:received]
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self._scanned = 0
+        return data
+
+    def pending(self) -> bytes:
+        """Returns any bytes that have been read but not yet handed out as a line."""
+        return bytes(self.buffer)
+
+    def feed(self, data: bytes):
+        """Put bytes another reader already took off the socket in front of what's still to come."""
+        self.buffer[:0] = data
+        self._scanned = 0
+
+    def wait(self, wakeup: int, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until there's something to read, or until the file descriptor wakeup
+        becomes readable, in which case it returns False. Raises socket.timeout if
+        neither happens within timeout seconds.
+        """
+        # A TLS socket may hold decrypted bytes that poll() can't see (see tls.TLSSocket)
+        pending = getattr(self.sock, "pending", None)
+        if self.buffer or (pending is not None and pending()):
+            return True
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        poller.register(wakeup, select.POLLIN)
+        events = poller.poll(None if timeout is None else timeout * 1000)
+        if not events:
+            raise socket.timeout("timed out")
+        return any(fd == self.sock.fileno() for fd, _ in events)
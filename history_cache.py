@@ -0,0 +1,187 @@
+"""
+The client's local copy of message history, one SQLite file per account.
+
+For each contact (or group) it keeps the messages seen so far and a cursor: the
+highest sequence number up to which the cache has every message the server
+still had when it was fetched. Opening a conversation then only has to ask the
+server for what came after the cursor (/history <contact> since=<cursor>) and
+can show the rest from disk.
+
+Messages pushed live are cached as they arrive, but only move the cursor when
+they follow on from it; our own messages come back with the next fetch. When
+the file grows past its cap, the contacts opened longest ago are dropped.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Rough per-message overhead on top of the sender and body, for the size cap
+ROW_OVERHEAD = 48
+# How far under the cap to trim once it's hit, so we don't trim on every message
+TRIM_TO = 0.9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    contact TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (contact, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS contacts (
+    contact TEXT PRIMARY KEY,
+    cursor INTEGER,
+    used REAL NOT NULL
+);
+"""
+
+Message = Tuple[int, str, datetime, str]
+
+
+def _size(sender: str, body: str) -> int:
+    return len(sender) + len(body.encode()) + ROW_OVERHEAD
+
+
+class HistoryCache:
+    """
+    Cached messages and cursors for one account. Safe to call from any thread
+    (the receive thread fills it while the input loop reads from it).
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # Only we should be able to read our messages
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self.bytes = self._db.execute(
+            f"SELECT COALESCE(SUM(LENGTH(sender) + LENGTH(CAST(body AS BLOB)) + {ROW_OVERHEAD}), 0) FROM messages"
+        ).fetchone()[0]
+
+    def cursor(self, contact: str) -> Optional[int]:
+        """Sequence number of the newest message we have everything up to, or None (-1 for an empty conversation)."""
+        with self._lock:
+            return self._cursor(contact)
+
+    def _cursor(self, contact: str) -> Optional[int]:
+        row = self._db.execute("SELECT cursor FROM contacts WHERE contact = ?", (contact,)).fetchone()
+        return row[0] if row else None
+
+    def recent(self, contact: str, limit: int) -> List[Message]:
+        """The newest limit cached messages up to the cursor, oldest first; marks contact as just used."""
+        with self._lock, self._db:
+            cursor = self._cursor(contact)
+            if cursor is None:
+                return []
+            self._db.execute("UPDATE contacts SET used = ? WHERE contact = ?", (time.time(), contact))
+            rows = self._db.execute(
+                "SELECT seq, sender, timestamp, body FROM messages WHERE contact = ? AND seq <= ? "
+                "ORDER BY seq DESC LIMIT ?", (contact, cursor, limit)).fetchall()
+        return [(seq, sender, datetime.fromtimestamp(ts), body) for seq, sender, ts, body in reversed(rows)]
+
+    def add_page(self, contact: str, messages: List[Message], start: int, end: int, total: int, delta: bool):
+        """
+        Cache a page of history covering messages [start, end) of total. Pages that
+        answer a delta fetch, or that reach the newest message and join up with what
+        we had, move the cursor to the page's end.
+        """
+        with self._lock, self._db:
+            self._insert(contact, messages)
+            cursor = self._cursor(contact)
+            if delta or (end == total and (cursor is None or start <= cursor + 1)):
+                self._set_cursor(contact, end - 1 if cursor is None else max(cursor, end - 1))
+            self._advance(contact)
+        self._trim()
+
+    def add_messages(self, contact: str, messages: List[Message]):
+        """Cache messages pushed as they were sent, or on login."""
+        with self._lock, self._db:
+            self._insert(contact, messages)
+            self._advance(contact)
+        self._trim()
+
+    def forget(self, contact: str):
+        """Drop everything cached for contact, e.g. after the conversation was deleted."""
+        with self._lock, self._db:
+            self._forget(contact)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _insert(self, contact: str, messages: List[Message]):
+        for seq, sender, timestamp, body in messages:
+            added = self._db.execute(
+                "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)",
+                (contact, seq, sender, timestamp.timestamp(), body)).rowcount
+            if added:
+                self.bytes += _size(sender, body)
+
+    def _set_cursor(self, contact: str, cursor: int):
+        self._db.execute("INSERT OR IGNORE INTO contacts VALUES (?, ?, ?)", (contact, cursor, time.time()))
+        self._db.execute("UPDATE contacts SET cursor = ? WHERE contact = ?", (cursor, contact))
+
+    def _advance(self, contact: str):
+        # Move the cursor over any messages that arrived live right after it
+        cursor = self._cursor(contact)
+        if cursor is None:
+            return
+        following = self._db.execute("SELECT seq FROM messages WHERE contact = ? AND seq > ? ORDER BY seq",
+                                     (contact, cursor))
+        advanced = cursor
+        for (seq,) in following:
+            if seq != advanced + 1:
+                break
+            advanced = seq
+        if advanced != cursor:
+            self._set_cursor(contact, advanced)
+
+    def _forget(self, contact: str):
+        self.bytes -= self._db.execute(
+            f"SELECT COALESCE(SUM(LENGTH(sender) + LENGTH(CAST(body AS BLOB)) + {ROW_OVERHEAD}), 0) "
+            "FROM messages WHERE contact = ?", (contact,)).fetchone()[0]
+        self._db.execute("DELETE FROM messages WHERE contact = ?", (contact,))
+        self._db.execute("DELETE FROM contacts WHERE contact = ?", (contact,))
+
+    def _trim(self):
+        if self.bytes <= self.max_bytes:
+            return
+        target = self.max_bytes * TRIM_TO
+        with self._lock, self._db:
+            # Whole contacts first, least recently opened first, keeping the latest one.
+            # Live messages from contacts we've never opened have no row there, so they go first.
+            unopened = self._db.execute("SELECT DISTINCT contact FROM messages "
+                                        "WHERE contact NOT IN (SELECT contact FROM contacts)").fetchall()
+            opened = self._db.execute("SELECT contact FROM contacts ORDER BY used").fetchall()[:-1]
+            for (contact,) in unopened + opened:
+                if self.bytes <= target:
+                    return
+                self._forget(contact)
+            # Then the oldest messages of whatever is left. Seqs are per contact, so
+            # "oldest" goes by timestamp; each contact is still cut from its own oldest
+            # seq up, which keeps the cursor valid since it only promises everything
+            # from the oldest cached message on
+            rows = self._db.execute("SELECT contact, seq, sender, body FROM messages ORDER BY timestamp, seq")
+            freed = 0
+            cut: Dict[str, int] = {}
+            for contact, seq, sender, body in rows:
+                if self.bytes - freed <= target:
+                    break
+                freed += _size(sender, body)
+                cut[contact] = max(cut.get(contact, seq), seq)
+            for contact, seq in cut.items():
+                self.bytes -= self._db.execute(
+                    f"SELECT COALESCE(SUM(LENGTH(sender) + LENGTH(CAST(body AS BLOB)) + {ROW_OVERHEAD}), 0) "
+                    "FROM messages WHERE contact = ? AND seq <= ?", (contact, seq)).fetchone()[0]
+                self._db.execute("DELETE FROM messages WHERE contact = ? AND seq <= ?", (contact, seq))
@@ -0,0 +1,227 @@
+"""
+Zero-downtime restarts for a single Lucia server process.
+
+On SIGUSR2 the server starts a fresh copy of itself (new code, same arguments)
+and, once that copy is up, hands it everything it needs over a Unix socket pair:
+the listening socket and every client's socket, passed as file descriptors with
+SCM_RIGHTS, each client's login state and whatever it sent that wasn't handled
+yet, and a snapshot of the message store. Clients stay connected throughout, and
+the kernel queues new connections on the listening socket while the handover
+runs. If the new copy doesn't come up, the old one just carries on.
+
+Before handing over, the old process stops every connection at a request
+boundary (see Restart) and flushes their outbound queues, so nothing is handled
+twice or lost in between. Connections that don't get there within the timeout
+are dropped.
+
+The handover itself, old to new after the new process says it's ready:
+    HANDOFF_HEADER      length of the state, number of descriptors
+    1 byte per batch    carrying up to FDS_PER_MESSAGE descriptors each
+    state               pickled plain data (dicts, lists, bytes); no objects,
+                        so the two processes may run different versions of the code
+The listening socket is the first descriptor, then the clients in the order of state["clients"].
+"""
+
+import os
+import pickle
+import socket
+import struct
+import subprocess
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Environment variable telling a successor which descriptor its predecessor talks on
+RESTART_FD_ENV = "LUCIA_RESTART_FD"
+# How long the old process waits for its successor to start, in seconds
+DEFAULT_START_TIMEOUT = 30.0
+# How long connections get to reach a request boundary and flush their replies
+DEFAULT_TIMEOUT = 5.0
+# The kernel takes at most 253 descriptors per message (SCM_MAX_FD)
+FDS_PER_MESSAGE = 250
+HANDOFF_HEADER = struct.Struct("<QI")
+READY = b"R"
+HANDOFF_VERSION = 1
+
+
+def supported() -> bool:
+    """Whether this platform can pass sockets between processes."""
+    return hasattr(socket, "send_fds") and hasattr(socket, "AF_UNIX")
+
+
+class Restart:
+    """
+    Where a hot restart is up to, shared by every connection. Safe to use from any thread.
+
+    requested: connections park at their next request boundary (park(), or the
+        asyncio engine's own equivalent) instead of reading another request.
+    frozen: the handover has been taken; nothing may handle a request or change
+        the store any more, and whoever tries waits for the process to exit.
+    wakeup: a descriptor that turns readable once a restart is requested, for
+        threads waiting on their client (see framing.LineReader.wait()).
+    """
+
+    def __init__(self):
+        self.signalled = False
+        self.requested = False
+        self.frozen = False
+        self.wakeup, self._wakeup_write = os.pipe()
+        self._cond = threading.Condition()
+        # (socket, outbound writer, session state) of the parked connections
+        self.parked: List[Tuple[Any, Any, Dict[str, Any]]] = []
+
+    def begin(self):
+        with self._cond:
+            self.requested = True
+            self.parked = []
+        os.write(self._wakeup_write, b"x")
+
+    def park(self, sock, writer, state: Dict[str, Any]):
+        """
+        Called by a connection's thread at a request boundary once a restart is
+        requested. Returns if the restart is called off; otherwise the process
+        exits with the thread still in here.
+        """
+        if self.frozen:
+            self.hang()
+        with self._cond:
+            self.parked.append((sock, writer, state))
+            self._cond.notify_all()
+            while self.requested:
+                self._cond.wait()
+
+    def wait_parked(self, count, timeout: float) -> bool:
+        """Wait until count() connections have parked; False if they didn't within timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self.parked) < count():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                # Connections that close instead of parking change count() without notifying
+                self._cond.wait(min(remaining, 0.05))
+            return True
+
+    def freeze(self) -> List[Tuple[Any, Any, Dict[str, Any]]]:
+        """Take the handover: returns the connections that parked in time."""
+        with self._cond:
+            self.frozen = True
+            return list(self.parked)
+
+    def abort(self):
+        """Call the restart off; parked connections carry on."""
+        with self._cond:
+            began = self.requested
+            self.signalled = self.requested = self.frozen = False
+            self.parked = []
+            self._cond.notify_all()
+        if began:
+            os.read(self.wakeup, 1)
+
+    def hang(self):
+        """For a thread that finds the handover taken: wait for the process to exit."""
+        threading.Event().wait()
+
+
+class Successor:
+    """A new server process started to take over from this one."""
+
+    def __init__(self, args: List[str], env: Dict[str, str]):
+        self.sock, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            env = dict(env, **{RESTART_FD_ENV: str(theirs.fileno())})
+            self.proc = subprocess.Popen(args, env=env, pass_fds=(theirs.fileno(),))
+        except Exception:
+            self.sock.close()
+            raise
+        finally:
+            theirs.close()
+
+    def wait_ready(self, timeout: float = DEFAULT_START_TIMEOUT) -> bool:
+        """Wait for the successor to start up and ask for the handover; False if it died or took too long."""
+        self.sock.settimeout(timeout)
+        try:
+            return self.sock.recv(1) == READY
+        except OSError:
+            return False
+        finally:
+            self.sock.settimeout(None)
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def hand_over(self, listener, clients: List[Tuple[Any, Dict[str, Any]]], state: Dict[str, Any]):
+        """Send the listening socket, the clients' sockets and state, and the rest of state."""
+        fds = [listener.fileno()] + [sock.fileno() for sock, _ in clients]
+        state = dict(state, version=HANDOFF_VERSION, clients=[client for _, client in clients])
+        data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        self.sock.sendall(HANDOFF_HEADER.pack(len(data), len(fds)))
+        for start in range(0, len(fds), FDS_PER_MESSAGE):
+            socket.send_fds(self.sock, [b"F"], fds[start:start + FDS_PER_MESSAGE])
+        self.sock.sendall(data)
+
+    def kill(self):
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Handoff:
+    """What a successor got from its predecessor."""
+
+    def __init__(self, sock, listener, clients: List[Tuple[socket.socket, Dict[str, Any]]], state: Dict[str, Any]):
+        self.sock = sock
+        self.listener = listener
+        self.clients = clients
+        self.state = state
+
+    def wait_for_predecessor(self, timeout: float = DEFAULT_START_TIMEOUT):
+        """Wait for the old process to exit, so ports it held (metrics) are free."""
+        self.sock.settimeout(timeout)
+        try:
+            while self.sock.recv(1):
+                pass
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def _recv_exact(sock, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1024 * 1024))
+        if not chunk:
+            raise ConnectionError("predecessor closed the handover early")
+        data += chunk
+    return bytes(data)
+
+
+def receive(fd: int) -> Handoff:
+    """
+    In a successor: tell the predecessor we're ready, and take over what it hands us.
+    Blocks until the old process has stopped its clients and flushed everything.
+    """
+    sock = socket.socket(fileno=fd)
+    sock.sendall(READY)
+    length, count = HANDOFF_HEADER.unpack(_recv_exact(sock, HANDOFF_HEADER.size))
+    fds = []
+    while len(fds) < count:
+        _, received, _, _ = socket.recv_fds(sock, 1, FDS_PER_MESSAGE)
+        if not received:
+            raise ConnectionError("predecessor closed the handover early")
+        fds.extend(received)
+    state = pickle.loads(_recv_exact(sock, length))
+    if state.get("version") != HANDOFF_VERSION:
+        raise ValueError(f"Unknown handover version {state.get('version')}")
+    listener = socket.socket(fileno=fds[0])
+    clients = [(socket.socket(fileno=client_fd), client) for client_fd, client in zip(fds[1:], state.pop("clients"))]
+    return Handoff(sock, listener, clients, state)
+
+
+def restart_fd() -> Optional[int]:
+    """In a successor, the descriptor to receive() from; None in a server started normally."""
+    value = os.environ.pop(RESTART_FD_ENV, None)
+    return int(value) if value else None
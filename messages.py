@@ -1,40 +1,314 @@
 """
 Message and conversation management for Lucia.
 Handles storage and retrieval of conversations between users.
+
+Thread safety: writes to a conversation happen under one of the store's
+striped locks (picked by conversation key). Histories are append-only, so
+readers never lock; they take a snapshot of however many messages exist
+when they start reading.
 """
 
+import os
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
 from datetime import datetime
-from typing import Dict, List, Optional
+from functools import partial
+from operator import itemgetter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Number of lock stripes shared out between conversations
+DEFAULT_STRIPES = 64
+
+# What happens to a conversation evicted for the memory budget when there's no backend
+SPILL_EVICTION = "spill"   # Written to a local file and read back on the next /open
+DROP_EVICTION = "drop"     # History is forgotten
+# Seconds between sweeps that enforce max_age and the memory budget
+DEFAULT_SWEEP_INTERVAL = 1.0
+# Eviction stops once usage is back under this fraction of the budget
+EVICTION_WATERMARK = 0.8
+# Spill file header: first seq, message count, content length
+SPILL_HEADER = struct.Struct("<QQQ")
+# Group conversations' names start with this, so they can't be mistaken for usernames
+GROUP_PREFIX = "#"
+# Group fan-out takes the stripe lock for this many members at a time,
+# so a huge group doesn't hold up other conversations on the same stripe
+FANOUT_BATCH = 256
+# search_messages() indexes at most this many of a conversation's newest messages,
+# this many at a time
+SEARCH_BACKFILL = 10000
+SEARCH_INDEX_BATCH = 1000
+
 
 class Message:
     """Represents a single message in a conversation."""
     
-    def __init__(self, sender: str, content: str, timestamp: Optional[datetime] = None):
+    # No per-instance __dict__; messages are built on demand from Conversation's columns
+    __slots__ = ("sender", "content", "timestamp", "seq")
+    
+    def __init__(self, sender: str, content: str, timestamp: Optional[datetime] = None, seq: Optional[int] = None):
         self.sender = sender
         self.content = content
         self.timestamp = timestamp or datetime.now()
+        # Position in the conversation, used as the cursor for paging through history
+        self.seq = seq
     
     def __repr__(self):
         return f"[{self.timestamp.strftime('%H:%M:%S')}] {self.sender}: {self.content}"
 
 
+class Columns:
+    """
+    One conversation's messages stored column by column.
+    Row i holds message number first_seq + i.
+    """
+    
+    __slots__ = ("timestamps", "senders", "content", "offsets", "first_seq")
+    
+    def __init__(self, timestamps=None, senders=None, content=None, offsets=None, first_seq: int = 0):
+        self.timestamps = timestamps if timestamps is not None else array("d")
+        self.senders = senders if senders is not None else bytearray()
+        self.content = content if content is not None else bytearray()
+        # Row i is content[offsets[i]:offsets[i + 1]]
+        self.offsets = offsets if offsets is not None else array("Q", [0])
+        self.first_seq = first_seq
+    
+    def count(self) -> int:
+        return len(self.offsets) - 1
+    
+    def count_sender(self, sender_index: int, start: int, end: int) -> int:
+        """How many of rows [start, end) were sent by sender_index."""
+        if isinstance(self.senders, bytearray):
+            return self.senders.count(sender_index, start, end)
+        return self.senders[start:end].count(sender_index)
+    
+    def memory_estimate(self) -> int:
+        """Rough bytes used: the content plus 8 + 1 + 8 bytes of columns per message."""
+        return len(self.content) + 17 * self.count()
+    
+    def retention_cut(self, max_messages: Optional[int], max_age: Optional[float]) -> int:
+        """How many of the oldest rows fall outside the retention limits."""
+        cut = 0
+        if max_messages is not None:
+            cut = max(cut, self.count() - max_messages)
+        if max_age is not None:
+            cut = max(cut, bisect_left(self.timestamps, time.time() - max_age))
+        return cut
+    
+    def tail(self, index: int) -> "Columns":
+        """A copy holding rows index onwards, used to drop old messages."""
+        base = self.offsets[index]
+        return Columns(
+            self.timestamps[index:],
+            self.senders[index:],
+            self.content[base:],
+            array("Q", (offset - base for offset in self.offsets[index:])),
+            self.first_seq + index,
+        )
+
+
 class Conversation:
-    """Represents a conversation between two users."""
+    """
+    Represents a conversation between two users.
+    Messages are stored column by column instead of as Message objects:
+    timestamps as epoch floats, the sender as a 0/1 index into participants,
+    and all content in one UTF-8 buffer sliced by offsets. Message objects
+    are only built when someone reads the history.
+    
+    Every message keeps its sequence number for good; retention only moves
+    first_seq() forward. Readers stop at retained_from as soon as a message is
+    past the limits, but the columns are trimmed in batches: old messages are
+    dropped by swapping in a new Columns object, so a reader that already grabbed
+    the old one still sees a consistent (if slightly stale) history.
+    
+    A conversation restored from a storage backend, or evicted from memory by
+    the store, is unloaded: columns is None, and loader brings it back on first use.
+    """
+    
+    # Bytes per entry of the senders column: a bytearray for two participants
+    sender_width = 1
     
     def __init__(self, participant1: str, participant2: str):
         # Store participants in sorted order for consistency
         self.participants = tuple(sorted([participant1, participant2]))
-        self.messages: List[Message] = []
+        self._init_history()
+    
+    def _init_history(self):
+        self.columns: Optional[Columns] = Columns(senders=self.new_senders())
+        # Id the storage backend knows this conversation by, if there is a backend
+        self.storage_id: Optional[int] = None
+        # File the store spilled this history to while it's evicted, if any
+        self.spill_path: Optional[str] = None
+        # While unloaded: a callable returning the Columns, and the seq range it holds
+        self.loader: Optional[Callable[[], Columns]] = None
+        self.stored_first_seq = 0
+        self.stored_next_seq = 0
+        # Retention has dropped everything below this seq, even if the columns still hold it
+        self.retained_from = 0
+        # time.monotonic() of the last read or write, for least-recently-used eviction
+        self.last_used = time.monotonic()
+        self._load_lock = threading.Lock()
+        # Delivery cursor per participant (same order as participants): the first seq
+        # they haven't been sent yet. saved_delivered is what the backend last recorded.
+        self.delivered = [0] * len(self.participants)
+        self.saved_delivered = [0] * len(self.participants)
+    
+    def new_senders(self, data: bytes = b""):
+        """An empty (or, given raw bytes, filled) senders column of the right width."""
+        return bytearray(data)
+    
+    def _get_columns(self) -> Columns:
+        columns = self.columns
+        if columns is not None:
+            return columns
+        with self._load_lock:
+            if self.columns is None:
+                self.columns = self.loader()
+                self.loader = None
+            return self.columns
     
-    def add_message(self, sender: str, content: str):
-        """Add a message to the conversation."""
+    def is_loaded(self) -> bool:
+        """Whether the history is in memory right now."""
+        return self.columns is not None
+    
+    def unload(self, loader: Callable[[], Columns]):
+        """
+        Drop the in-memory history; loader will bring it back when it's next needed.
+        Writers must be serialized by the caller, same as add_message().
+        """
+        columns = self.columns
+        if columns is None:
+            return
+        self.stored_first_seq = columns.first_seq
+        self.stored_next_seq = columns.first_seq + columns.count()
+        self.loader = loader
+        # Clearing columns last means nobody sees it unloaded without a loader
+        self.columns = None
+    
+    def sender_index(self, sender: str) -> int:
+        """Index of sender in participants, which is what the senders column stores."""
         if sender not in self.participants:
             raise ValueError(f"{sender} is not a participant in this conversation")
-        self.messages.append(Message(sender, content))
+        return self.participants.index(sender)
+    
+    def add_message(self, sender: str, content: str, timestamp: Optional[float] = None) -> int:
+        """
+        Add a message to the conversation and return its sequence number.
+        Writers must be serialized by the caller (MessageStore holds the conversation's stripe lock).
+        """
+        return self.append_encoded(self.sender_index(sender), content.encode(),
+                                   time.time() if timestamp is None else timestamp)
+    
+    def append_encoded(self, sender_index: int, body: bytes, timestamp: float) -> int:
+        """add_message() for a sender index and already UTF-8 encoded content."""
+        columns = self._get_columns()
+        columns.timestamps.append(timestamp)
+        columns.senders.append(sender_index)
+        columns.content += body
+        # Appending the end offset last is what publishes the message to readers
+        columns.offsets.append(len(columns.content))
+        return columns.first_seq + columns.count() - 1
+    
+    def apply_retention(self, max_messages: Optional[int] = None, max_age: Optional[float] = None,
+                        slack: int = 0) -> int:
+        """
+        Drop messages beyond the newest max_messages or older than max_age seconds.
+        Readers stop seeing them straight away. Trimming copies the columns, so it only
+        happens once at least `slack` messages are due to go; that keeps the cost per
+        message constant, like a ring buffer.
+        Returns how many messages were dropped. Writers must be serialized by the caller.
+        """
+        columns = self.columns
+        if columns is None:
+            return 0
+        cut = columns.retention_cut(max_messages, max_age)
+        if cut <= 0:
+            return 0
+        visible = self.first_seq()
+        self.retained_from = max(self.retained_from, columns.first_seq + cut)
+        if cut >= slack or cut >= columns.count():
+            self.columns = columns.tail(cut)
+        return self.first_seq() - visible
+    
+    def pending_for(self, reader: str, limit: int) -> Tuple[int, List[Message]]:
+        """
+        Messages from anyone but reader at or after reader's delivery cursor:
+        how many there are, and the newest `limit` of them, oldest first.
+        """
+        reader_index = self.sender_index(reader)
+        if self.delivered[reader_index] >= self.next_seq():
+            return 0, []
+        columns = self._get_columns()
+        start = max(max(self.delivered[reader_index], self.retained_from) - columns.first_seq, 0)
+        end = columns.count()
+        unread = end - start - columns.count_sender(reader_index, start, end)
+        messages = []
+        index = end - 1
+        while index >= start and len(messages) < limit:
+            if columns.senders[index] != reader_index:
+                messages.append(self._build_message(columns, index))
+            index -= 1
+        messages.reverse()
+        return unread, messages
+    
+    def message_count(self) -> int:
+        """Number of messages still stored (retention may have dropped older ones)."""
+        return self.next_seq() - self.first_seq()
+    
+    def first_seq(self) -> int:
+        """Sequence number of the oldest message still stored."""
+        columns = self.columns
+        if columns is None:
+            return max(self.stored_first_seq, self.retained_from)
+        return max(columns.first_seq, self.retained_from)
+    
+    def next_seq(self) -> int:
+        """Sequence number the next message will get; every stored message has a lower one."""
+        columns = self.columns
+        if columns is None:
+            return self.stored_next_seq
+        return columns.first_seq + columns.count()
+    
+    def memory_estimate(self) -> int:
+        """Rough bytes of history held in memory (0 while unloaded)."""
+        columns = self.columns
+        return columns.memory_estimate() if columns is not None else 0
     
-    def get_messages(self) -> List[Message]:
-        """Get all messages in this conversation."""
-        return self.messages
+    def _build_message(self, columns: Columns, index: int) -> Message:
+        # Slicing copies out of the buffers, so the writer is free to grow them meanwhile
+        body = bytes(columns.content[columns.offsets[index]:columns.offsets[index + 1]])
+        return Message(
+            self.participants[columns.senders[index]],
+            body.decode(),
+            datetime.fromtimestamp(columns.timestamps[index]),
+            columns.first_seq + index,
+        )
+    
+    def get_messages(self, start: int = 0, end: Optional[int] = None) -> List[Message]:
+        """
+        Get a snapshot of the messages with sequence numbers in [start, end) without locking.
+        Messages appended while the caller reads the snapshot are not included, and
+        sequence numbers retention has already dropped are skipped.
+        """
+        self.last_used = time.monotonic()
+        columns = self._get_columns()
+        count = columns.count()
+        first = max(max(start, self.retained_from) - columns.first_seq, 0)
+        last = count if end is None else min(max(end - columns.first_seq, 0), count)
+        return [self._build_message(columns, i) for i in range(first, last)]
+    
+    def __iter__(self) -> Iterator[Message]:
+        # Same snapshot rule as get_messages(), but builds one message at a time
+        columns = self._get_columns()
+        for i in range(max(self.retained_from - columns.first_seq, 0), columns.count()):
+            yield self._build_message(columns, i)
+    
+    def is_member(self, username: str) -> bool:
+        """Whether username may read this conversation."""
+        return username in self.participants
     
     def get_other_participant(self, username: str) -> Optional[str]:
         """Get the other participant's username."""
@@ -45,51 +319,664 @@ class Conversation:
         return None
     
     def __repr__(self):
-        return f"Conversation({self.participants[0]} <-> {self.participants[1]}, {len(self.messages)} messages)"
+        return f"Conversation({self.participants[0]} <-> {self.participants[1]}, {self.message_count()} messages)"
+
+
+class GroupConversation(Conversation):
+    """
+    A conversation between any number of members, stored once however many there are.
+    participants only ever grows: someone who leaves keeps their index, so the
+    senders column (4 bytes per message here) never has to be rewritten, and
+    members holds who is in the group right now.
+    """
+    
+    sender_width = 4
+    
+    def __init__(self, name: str, creator: str):
+        self.name = name
+        self.creator = creator
+        self.participants = [creator]
+        self.members = {creator}
+        self._indexes = {creator: 0}
+        # Timestamp of the last message, for /contacts recent; kept here rather than
+        # in every member's contact entry so sending doesn't touch them all
+        self.last_timestamp: Optional[float] = None
+        self._init_history()
+    
+    def new_senders(self, data: bytes = b""):
+        return array("I", data)
+    
+    def sender_index(self, sender: str) -> int:
+        if sender not in self.members:
+            raise ValueError(f"{sender} is not a member of {self.name}")
+        return self._indexes[sender]
+    
+    def is_member(self, username: str) -> bool:
+        return username in self.members
+    
+    def add_member(self, username: str) -> bool:
+        """
+        Add username from the next message on; returns False if they're already in.
+        Writers must be serialized by the caller.
+        """
+        if username in self.members:
+            return False
+        index = self._indexes.get(username)
+        if index is None:
+            index = self._indexes[username] = len(self.participants)
+            self.participants.append(username)
+            self.delivered.append(0)
+            self.saved_delivered.append(0)
+        # Joining doesn't count as having missed the history
+        self.delivered[index] = self.next_seq()
+        self.members.add(username)
+        return True
+    
+    def remove_member(self, username: str) -> bool:
+        """Returns False if username wasn't a member. Writers must be serialized by the caller."""
+        if username not in self.members:
+            return False
+        self.members.discard(username)
+        return True
+    
+    def get_other_participant(self, username: str) -> Optional[str]:
+        return None
+    
+    def __repr__(self):
+        return f"GroupConversation({self.name}, {len(self.members)} members, {self.message_count()} messages)"
 
 
 class MessageStore:
-    """Manages all conversations across the server."""
+    """
+    Manages all conversations across the server.
+    Everything lives in memory unless a storage backend (see storage.py) is given,
+    in which case every change is also written to it and the store starts out with
+    whatever the backend already holds.
+    
+    Memory can be bounded two ways. Retention (max_messages / max_age) drops the
+    oldest messages of each conversation. A memory budget evicts the least recently
+    used conversations out of RAM: with a backend they're simply reloaded from it,
+    otherwise they're spilled to a local file (or dropped, with eviction="drop") and
+    reloaded on the next /open.
+    
+    Given a search.SearchIndex, search_messages() keeps it up to date and looks things up in it.
+    """
     
-    def __init__(self):
+    def __init__(self, stripes: int = DEFAULT_STRIPES, backend=None,
+                 max_messages: Optional[int] = None, max_age: Optional[float] = None,
+                 memory_budget: Optional[int] = None, eviction: str = SPILL_EVICTION,
+                 spill_dir: Optional[str] = None, sweep_interval: float = DEFAULT_SWEEP_INTERVAL,
+                 search=None):
         # Store conversations by key (tuple of sorted usernames)
         self.conversations: Dict[tuple, Conversation] = {}
+        # Writers to a conversation take the stripe its key hashes to
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        # Contact index: username -> {contact: timestamp of last message, or None}
+        # Kept up to date on create/add/delete so /contacts never scans every conversation
+        self.contacts: Dict[str, Dict[str, Optional[float]]] = {}
+        self.backend = backend
+        self.search = search
+        
+        # Retention and memory budget settings (None means unlimited)
+        if eviction not in (SPILL_EVICTION, DROP_EVICTION):
+            raise ValueError(f"Unknown eviction mode '{eviction}'")
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.memory_budget = memory_budget
+        self.eviction = eviction
+        self.spill_dir = spill_dir
+        # Trim in batches so retention costs O(1) per message on average
+        self._retention_slack = max(16, (max_messages or 0) // 4)
+        # Counters for sizing the budget; see memory_stats()
+        self._stats_lock = threading.Lock()
+        self.evictions = 0
+        self.reloads = 0
+        self.trimmed = 0
+        
+        if backend is not None:
+            self._restore()
+        if memory_budget is not None or max_age is not None:
+            # Age limits and the memory budget are enforced by a background sweep
+            janitor = threading.Thread(target=self._janitor, args=(sweep_interval,), daemon=True)
+            janitor.start()
+    
+    def _restore(self):
+        # Rebuild conversations and the contact index from the backend's summaries.
+        # History stays on disk until each conversation is first used.
+        cursors = self.backend.delivery_cursors()
+        expired = None if self.max_age is None else time.time() - self.max_age
+        for storage_id, key, count, last_timestamp in self.backend.conversations():
+            conversation = Conversation(key[0], key[1])
+            conversation.storage_id = storage_id
+            if storage_id in cursors:
+                conversation.delivered = list(cursors[storage_id])
+                conversation.saved_delivered = list(cursors[storage_id])
+            if count:
+                conversation.stored_next_seq = count
+                if expired is not None and last_timestamp is not None and last_timestamp < expired:
+                    # Even the newest message is past max_age
+                    conversation.retained_from = count
+                elif self.max_messages is not None:
+                    conversation.retained_from = max(0, count - self.max_messages)
+                # The summaries carry no older timestamps, so a conversation only partly past
+                # max_age is cut exactly when it's loaded (see _load_from_backend)
+                conversation.stored_first_seq = conversation.retained_from
+                conversation.loader = partial(self._load_from_backend, conversation)
+                conversation.columns = None
+            self.conversations[key] = conversation
+            self._index_contacts(key, last_timestamp)
+    
+    def _count(self, counter: str, amount: int = 1):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+    
+    def _load_from_backend(self, conversation: Conversation) -> Columns:
+        columns = Columns(*self.backend.load_history(conversation.storage_id))
+        cut = columns.retention_cut(self.max_messages, self.max_age)
+        if cut > 0:
+            columns = columns.tail(cut)
+        self._count("reloads")
+        return columns
+    
+    def _load_from_spill(self, conversation: Conversation) -> Columns:
+        path = conversation.spill_path
+        with open(path, "rb") as f:
+            first_seq, count, content_length = SPILL_HEADER.unpack(f.read(SPILL_HEADER.size))
+            timestamps = array("d")
+            timestamps.frombytes(f.read(8 * count))
+            senders = conversation.new_senders(f.read(conversation.sender_width * count))
+            offsets = array("Q")
+            offsets.frombytes(f.read(8 * (count + 1)))
+            content = bytearray(f.read(content_length))
+        conversation.spill_path = None
+        os.remove(path)
+        self._count("reloads")
+        return Columns(timestamps, senders, content, offsets, first_seq)
+    
+    def _spill(self, conversation: Conversation) -> str:
+        columns = conversation.columns
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="lucia-spill-")
+        os.makedirs(self.spill_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=".spill", dir=self.spill_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(SPILL_HEADER.pack(columns.first_seq, columns.count(), len(columns.content)))
+            f.write(columns.timestamps.tobytes())
+            f.write(columns.senders)
+            f.write(columns.offsets.tobytes())
+            f.write(columns.content)
+        return path
+    
+    def _evict_locked(self, conversation: Conversation):
+        # Caller holds the conversation's stripe lock
+        if conversation.storage_id is not None:
+            # Everything is already in the log, so there's nothing to write out
+            conversation.unload(partial(self._load_from_backend, conversation))
+        elif self.eviction == SPILL_EVICTION:
+            conversation.spill_path = self._spill(conversation)
+            conversation.unload(partial(self._load_from_spill, conversation))
+        else:
+            # Forget the history; the conversation carries on from the same seq
+            next_seq = conversation.next_seq()
+            conversation.unload(lambda: Columns(senders=conversation.new_senders(), first_seq=next_seq))
+            conversation.stored_first_seq = next_seq
+        self._count("evictions")
+    
+    def enforce_limits(self):
+        """Apply age-based retention and evict cold conversations until under the memory budget."""
+        conversations = list(self.conversations.items())
+        if self.max_age is not None:
+            for key, conversation in conversations:
+                if conversation.is_loaded():
+                    with self._lock_for(key):
+                        self._count("trimmed", conversation.apply_retention(self.max_messages, self.max_age))
+        
+        if self.memory_budget is None:
+            return
+        loaded = [(c.last_used, key, c) for key, c in conversations if c.is_loaded()]
+        used = sum(c.memory_estimate() for _, _, c in loaded)
+        if used <= self.memory_budget:
+            return
+        # Evict down to a low watermark so we aren't back here after a few messages
+        target = self.memory_budget * EVICTION_WATERMARK
+        loaded.sort(key=itemgetter(0))
+        for _, key, conversation in loaded:
+            if used <= target:
+                break
+            with self._lock_for(key):
+                if self.conversations.get(key) is not conversation or not conversation.is_loaded():
+                    continue
+                freed = conversation.memory_estimate()
+                self._evict_locked(conversation)
+            used -= freed
+    
+    def _janitor(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.enforce_limits()
+            except Exception:
+                # Never let one bad sweep stop the next ones
+                pass
+    
+    def memory_stats(self) -> Dict[str, Optional[int]]:
+        """Sizes and counters for the memory budget. Walks every conversation, so don't call it per message."""
+        conversations = list(self.conversations.values())
+        loaded = [c for c in conversations if c.is_loaded()]
+        with self._stats_lock:
+            return {
+                "conversations": len(conversations),
+                "messages": sum(c.message_count() for c in conversations),
+                "loaded": len(loaded),
+                "memory_estimate": sum(c.memory_estimate() for c in loaded),
+                "memory_budget": self.memory_budget,
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+                "trimmed": self.trimmed,
+            }
+    
+    def _lock_for(self, key: tuple) -> threading.Lock:
+        return self._locks[hash(key) % len(self._locks)]
     
     def get_conversation_key(self, user1: str, user2: str) -> tuple:
-        """Generate a consistent key for a conversation between two users."""
+        """
+        Generate a consistent key for a conversation between two users.
+        If either is a group name, it's the group's key, (name,).
+        """
+        if user2.startswith(GROUP_PREFIX):
+            return (user2,)
+        if user1.startswith(GROUP_PREFIX):
+            return (user1,)
         return tuple(sorted([user1, user2]))
     
     def get_or_create_conversation(self, user1: str, user2: str) -> Conversation:
         """Get an existing conversation or create a new one."""
         key = self.get_conversation_key(user1, user2)
-        if key not in self.conversations:
-            self.conversations[key] = Conversation(user1, user2)
-        return self.conversations[key]
+        # Fast path without locking for conversations that already exist
+        conversation = self.conversations.get(key)
+        if conversation is not None:
+            return conversation
+        with self._lock_for(key):
+            return self._get_or_create_locked(key)
     
-    def add_message(self, sender: str, recipient: str, content: str):
-        """Add a message to a conversation."""
-        conversation = self.get_or_create_conversation(sender, recipient)
-        conversation.add_message(sender, content)
+    def _get_or_create_locked(self, key: tuple) -> Conversation:
+        # Caller holds the stripe lock for key, so check-then-insert can't race
+        conversation = self.conversations.get(key)
+        if conversation is None:
+            if len(key) == 1:
+                # Groups are only made by create_group()
+                raise ValueError(f"No group named {key[0]}")
+            conversation = Conversation(key[0], key[1])
+            if self.backend is not None:
+                conversation.storage_id = self.backend.create_conversation(key)
+            self.conversations[key] = conversation
+            self._index_contacts(key, None)
+        return conversation
+    
+    def _index_contacts(self, key: tuple, timestamp: Optional[float]):
+        if len(key) == 1:
+            # Members' entries for a group stay None; see get_user_contact_activity()
+            if timestamp is not None:
+                self.conversations[key].last_timestamp = timestamp
+            return
+        # Record both participants as each other's contact
+        user1, user2 = key
+        self.contacts.setdefault(user1, {})[user2] = timestamp
+        self.contacts.setdefault(user2, {})[user1] = timestamp
+    
+    def add_message(self, sender: str, recipient: str, content: str, timestamp: Optional[float] = None) -> int:
+        """Add a message to a conversation and return its sequence number."""
+        key = self.get_conversation_key(sender, recipient)
+        # Holding the stripe lock keeps appends ordered and stops a concurrent
+        # delete from dropping the conversation halfway through
+        with self._lock_for(key):
+            conversation = self._get_or_create_locked(key)
+            sender_index = conversation.sender_index(sender)
+            body = content.encode()
+            if timestamp is None:
+                timestamp = time.time()
+            seq = conversation.append_encoded(sender_index, body, timestamp)
+            conversation.last_used = time.monotonic()
+            # The sender has obviously seen their own message
+            if conversation.delivered[sender_index] == seq:
+                conversation.delivered[sender_index] = seq + 1
+            if self.max_messages is not None:
+                trimmed = conversation.apply_retention(self.max_messages, None, self._retention_slack)
+                if trimmed:
+                    self._count("trimmed", trimmed)
+            if conversation.storage_id is not None:
+                # Buffered by the backend; it fsyncs in batches (group commit)
+                self.backend.append(conversation.storage_id, timestamp, sender_index, body)
+            self._index_contacts(key, timestamp)
+        return seq
+    
+    def deliver_pending(self, username: str, contact: str,
+                        deliver: Callable[[int, List[Message]], bool], limit: int) -> bool:
+        """
+        Pass username's undelivered messages from contact to deliver(unread, newest `limit`)
+        and move the delivery cursor past them if it accepts. deliver() runs under the
+        stripe lock, which keeps deliveries in order, so it must not block.
+        Returns False if deliver() refused; the messages then wait for the next login.
+        """
+        key = self.get_conversation_key(username, contact)
+        with self._lock_for(key):
+            conversation = self.conversations.get(key)
+            if conversation is None:
+                return True
+            end = conversation.next_seq()
+            unread, messages = conversation.pending_for(username, limit)
+            if unread and not deliver(unread, messages):
+                return False
+            conversation.delivered[conversation.sender_index(username)] = end
+            return True
+    
+    def claim_undelivered(self, username: str, limit: int) -> List[Tuple[str, int, List[Message], int]]:
+        """
+        Take everything waiting for username, for the catch-up burst after login.
+        Returns (contact, unread count, newest `limit` messages, previous cursor) per contact
+        with unread messages, most recently active first. Cursors move past the claimed
+        messages straight away; use release_undelivered() if they couldn't be sent.
+        """
+        claims = []
+        for contact, _ in self.get_user_contact_activity(username):
+            key = self.get_conversation_key(username, contact)
+            with self._lock_for(key):
+                conversation = self.conversations.get(key)
+                if conversation is None:
+                    continue
+                reader_index = conversation.sender_index(username)
+                previous = conversation.delivered[reader_index]
+                end = conversation.next_seq()
+                if previous >= end:
+                    continue
+                unread, messages = conversation.pending_for(username, limit)
+                conversation.delivered[reader_index] = end
+                if unread:
+                    claims.append((contact, unread, messages, previous))
+        return claims
+    
+    def release_undelivered(self, username: str, claims: List[Tuple[str, int, List[Message], int]]):
+        """Put claimed messages back in username's undelivered queue."""
+        for contact, _, _, previous in claims:
+            key = self.get_conversation_key(username, contact)
+            with self._lock_for(key):
+                conversation = self.conversations.get(key)
+                if conversation is not None:
+                    reader_index = conversation.sender_index(username)
+                    conversation.delivered[reader_index] = min(conversation.delivered[reader_index], previous)
+    
+    def delivery_cursors(self, username: str) -> Dict[str, int]:
+        """username's delivery cursor in each of their conversations, by contact."""
+        cursors = {}
+        for contact in self.get_user_contacts(username):
+            conversation = self.conversations.get(self.get_conversation_key(username, contact))
+            if conversation is not None:
+                cursors[contact] = conversation.delivered[conversation.sender_index(username)]
+        return cursors
+    
+    def set_delivery_cursor(self, username: str, contact: str, cursor: int):
+        """Move username's delivery cursor for contact, e.g. to match another worker's replica."""
+        key = self.get_conversation_key(username, contact)
+        with self._lock_for(key):
+            conversation = self.conversations.get(key)
+            # They may have left the group since
+            if conversation is not None and conversation.is_member(username):
+                conversation.delivered[conversation.sender_index(username)] = cursor
+    
+    def save_delivery_cursors(self, username: str):
+        """
+        Write username's delivery cursors that moved since the last save to the backend.
+        Cursors only reach disk at logout, so a crash can redeliver, but never lose, messages.
+        """
+        if self.backend is None:
+            return
+        for contact in self.get_user_contacts(username):
+            key = self.get_conversation_key(username, contact)
+            with self._lock_for(key):
+                conversation = self.conversations.get(key)
+                # Groups aren't kept by the backend
+                if conversation is None or conversation.storage_id is None:
+                    continue
+                reader_index = conversation.sender_index(username)
+                cursor = conversation.delivered[reader_index]
+                if cursor != conversation.saved_delivered[reader_index]:
+                    self.backend.set_delivery_cursor(conversation.storage_id, reader_index, cursor)
+                    conversation.saved_delivered[reader_index] = cursor
     
     def get_conversation(self, user1: str, user2: str) -> Optional[Conversation]:
         """Get a conversation between two users if it exists."""
         key = self.get_conversation_key(user1, user2)
-        return self.conversations.get(key)
+        conversation = self.conversations.get(key)
+        if conversation is not None:
+            conversation.last_used = time.monotonic()
+        return conversation
     
     def get_user_contacts(self, username: str) -> List[str]:
         """Get list of users that the specified user has conversations with."""
-        contacts = []
-        for key in self.conversations.keys():
-            if username in key:
-                # Get the other participant
-                other = key[0] if key[1] == username else key[1]
-                contacts.append(other)
-        return sorted(contacts)
+        # copy() is a single C call, so it can't see the dict change underneath it
+        return sorted(self.contacts.get(username, {}).copy())
+    
+    def get_user_contact_activity(self, username: str) -> List[Tuple[str, Optional[float]]]:
+        """
+        Get (contact, last message timestamp) pairs for a user, most recently active first.
+        Contacts with no messages yet come last, in name order.
+        """
+        activity = self.contacts.get(username, {}).copy()
+        for contact in activity:
+            if contact.startswith(GROUP_PREFIX):
+                group = self.conversations.get((contact,))
+                activity[contact] = group.last_timestamp if group is not None else None
+        return sorted(activity.items(), key=lambda item: (item[1] is None, -(item[1] or 0), item[0]))
     
     def delete_conversation(self, user1: str, user2: str) -> bool:
         """Delete a conversation between two users."""
         key = self.get_conversation_key(user1, user2)
-        if key in self.conversations:
-            del self.conversations[key]
+        with self._lock_for(key):
+            # Readers holding the Conversation keep their snapshot; it's just unlinked here
+            conversation = self.conversations.pop(key, None)
+            if conversation is None:
+                return False
+            if conversation.storage_id is not None:
+                self.backend.delete_conversation(conversation.storage_id)
+            if conversation.spill_path is not None:
+                try:
+                    os.remove(conversation.spill_path)
+                except FileNotFoundError:
+                    pass
+                conversation.spill_path = None
+            if self.search is not None:
+                self.search.remove(key)
+            if len(key) == 1:
+                pairs = [(member, key[0]) for member in conversation.members]
+            else:
+                pairs = [key, key[::-1]]
+            for user, other in pairs:
+                contacts = self.contacts.get(user)
+                if contacts is not None:
+                    contacts.pop(other, None)
             return True
-        return False
+    
+    def search_messages(self, username: str, contact: Optional[str], query: List[Tuple[str, bool]], limit: int,
+                        since: Optional[float] = None, until: Optional[float] = None) -> List[Tuple[str, Message]]:
+        """
+        The newest (contact, message) pairs, at most limit, matching query (see
+        search.parse_query) in username's conversation with contact, or in all their
+        conversations if contact is None. Only sent in [since, until) if given.
+        """
+        contacts = self.get_user_contacts(username) if contact is None else [contact]
+        hits = []
+        for other in contacts:
+            key = self.get_conversation_key(username, other)
+            conversation = self.conversations.get(key)
+            if conversation is None or not conversation.is_member(username):
+                continue
+            self._index_for_search(key, conversation)
+            for seq, timestamp in self.search.search(key, query, limit, conversation.first_seq(), since, until):
+                hits.append((timestamp, seq, other, conversation))
+        hits.sort(key=itemgetter(0, 1), reverse=True)
+        results = []
+        for _, seq, other, conversation in hits[:limit]:
+            messages = conversation.get_messages(seq, seq + 1)
+            if messages:
+                results.append((other, messages[0]))
+        return results
+    
+    def _index_for_search(self, key: tuple, conversation: Conversation):
+        # Index what's been added since the last search. Reads are lock-free snapshots,
+        # and indexing the same message twice is harmless, so writers aren't held up.
+        end = conversation.next_seq()
+        start = max(self.search.next_seq(key), conversation.first_seq(), end - SEARCH_BACKFILL)
+        for batch_start in range(start, end, SEARCH_INDEX_BATCH):
+            self.search.index(key, conversation.get_messages(batch_start, min(end, batch_start + SEARCH_INDEX_BATCH)))
+        if start < end and self.conversations.get(key) is not conversation:
+            # Deleted while we were at it
+            self.search.remove(key)
+    
+    def get_group(self, name: str) -> Optional[GroupConversation]:
+        """The group called name (including its leading #), if there is one."""
+        return self.conversations.get((name,))
+    
+    def create_group(self, name: str, creator: str, members: List[str] = ()) -> Optional[GroupConversation]:
+        """Create a group with creator and members in it. Returns None if the name is taken."""
+        key = (name,)
+        with self._lock_for(key):
+            if key in self.conversations:
+                return None
+            group = GroupConversation(name, creator)
+            for member in members:
+                group.add_member(member)
+            self.conversations[key] = group
+            for member in group.members:
+                self.contacts.setdefault(member, {})[name] = None
+        return group
+    
+    def add_group_members(self, name: str, usernames: List[str]) -> List[str]:
+        """Add users to a group; returns the ones who weren't in it already."""
+        key = (name,)
+        added = []
+        with self._lock_for(key):
+            group = self.conversations.get(key)
+            if group is None:
+                return added
+            for username in usernames:
+                if group.add_member(username):
+                    self.contacts.setdefault(username, {})[name] = None
+                    added.append(username)
+        return added
+    
+    def leave_group(self, name: str, username: str) -> bool:
+        """Take username out of a group. The last member out deletes it."""
+        key = (name,)
+        with self._lock_for(key):
+            group = self.conversations.get(key)
+            if group is None or not group.remove_member(username):
+                return False
+            contacts = self.contacts.get(username)
+            if contacts is not None:
+                contacts.pop(name, None)
+            empty = not group.members
+        if empty:
+            self.delete_conversation(name, name)
+        return True
+    
+    def deliver_group(self, name: str, seq: int, recipients: List[Tuple[str, object]],
+                      deliver: Callable[[object, int, Optional[List[Message]]], bool], limit: int) -> Tuple[int, int]:
+        """
+        deliver_pending() for many members of a group at once. recipients is (member, target)
+        pairs; deliver(target, unread, messages) gets messages=None when all the member is
+        missing is message seq itself, so the caller can hand everyone the same encoded frame.
+        Returns how many members were delivered to and how many refused.
+        """
+        key = (name,)
+        delivered = refused = 0
+        for batch_start in range(0, len(recipients), FANOUT_BATCH):
+            with self._lock_for(key):
+                group = self.conversations.get(key)
+                if group is None:
+                    break
+                end = group.next_seq()
+                for member, target in recipients[batch_start:batch_start + FANOUT_BATCH]:
+                    if not group.is_member(member):
+                        continue
+                    index = group.sender_index(member)
+                    cursor = group.delivered[index]
+                    if cursor >= end:
+                        continue
+                    if cursor == seq and end == seq + 1:
+                        accepted = deliver(target, 1, None)
+                    else:
+                        unread, messages = group.pending_for(member, limit)
+                        accepted = not unread or deliver(target, unread, messages)
+                    if accepted:
+                        group.delivered[index] = end
+                        delivered += 1
+                    else:
+                        refused += 1
+        return delivered, refused
+    
+    def snapshot(self) -> List[dict]:
+        """
+        What a fresh store needs to carry on exactly where this one is, as plain data
+        for a hot restart (see hotrestart.py): every conversation the backend doesn't
+        keep, history and all, and the delivery cursors of the ones it does.
+        Routing should be stopped first.
+        """
+        records = []
+        for key, conversation in list(self.conversations.items()):
+            with self._lock_for(key):
+                if self.conversations.get(key) is not conversation:
+                    continue
+                record = {"key": key, "delivered": list(conversation.delivered)}
+                if conversation.storage_id is None:
+                    record.update(participants=list(conversation.participants),
+                                  retained_from=conversation.retained_from)
+                    if isinstance(conversation, GroupConversation):
+                        record.update(creator=conversation.creator, members=sorted(conversation.members),
+                                      last_timestamp=conversation.last_timestamp)
+                    else:
+                        record["last_timestamp"] = self.contacts.get(key[0], {}).get(key[1])
+                    if conversation.spill_path is not None:
+                        # Spilled history stays in its file; the new store reads it from there
+                        record.update(spill_path=conversation.spill_path,
+                                      stored=(conversation.stored_first_seq, conversation.stored_next_seq))
+                    else:
+                        columns = conversation._get_columns()
+                        record["columns"] = (columns.timestamps.tobytes(), bytes(columns.senders),
+                                             bytes(columns.content), columns.offsets.tobytes(), columns.first_seq)
+                records.append(record)
+        return records
+    
+    def load_snapshot(self, records: List[dict]):
+        """Take over the conversations and cursors of another store's snapshot()."""
+        for record in records:
+            key = tuple(record["key"])
+            if "participants" not in record:
+                conversation = self.conversations.get(key)
+                if conversation is not None:
+                    conversation.delivered = list(record["delivered"])
+                continue
+            participants = record["participants"]
+            if len(key) == 1:
+                conversation = GroupConversation(key[0], record["creator"])
+                conversation.participants = list(participants)
+                conversation._indexes = {name: index for index, name in enumerate(participants)}
+                conversation.members = set(record["members"])
+            else:
+                conversation = Conversation(key[0], key[1])
+            conversation.delivered = list(record["delivered"])
+            conversation.saved_delivered = [0] * len(participants)
+            conversation.retained_from = record.get("retained_from", 0)
+            if "spill_path" in record:
+                conversation.spill_path = record["spill_path"]
+                conversation.unload(partial(self._load_from_spill, conversation))
+                conversation.stored_first_seq, conversation.stored_next_seq = record["stored"]
+            else:
+                timestamps, senders, content, offsets, first_seq = record["columns"]
+                conversation.columns = Columns(array("d", timestamps), conversation.new_senders(senders),
+                                               bytearray(content), array("Q", offsets), first_seq)
+            with self._lock_for(key):
+                self.conversations[key] = conversation
+                if len(key) == 1:
+                    for member in conversation.members:
+                        self.contacts.setdefault(member, {})[key[0]] = None
+                self._index_contacts(key, record["last_timestamp"])
@@ -0,0 +1,277 @@
+"""
+Runtime metrics for Lucia: counters, gauges and fixed-bucket histograms.
+
+Recording is cheap enough for the hot path. Every thread gets its own cell per
+metric, so inc() and observe() never take a lock and never contend; the cells
+are only added up when someone reads the metrics (/stats or the Prometheus
+endpoint). In asyncio mode everything runs on one thread and has a single cell.
+"""
+
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Histogram bucket upper bounds in seconds, from 50us to 10s
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class _CellOwner:
+    # Lives in a thread's threading.local; when the thread exits it's freed,
+    # and its finalizer folds the thread's cell into the metric's total
+    __slots__ = ("cell", "__weakref__")
+
+    def __init__(self, cell):
+        self.cell = cell
+
+
+class _PerThread(ABC):
+    """Base for metrics that keep one mutable cell per recording thread."""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[Tuple[str, str], ...]):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._local = threading.local()
+        # Reentrant in case a thread's cell gets retired while we hold it
+        self._lock = threading.RLock()
+        self._cells: List[list] = []
+        # What exited threads had recorded
+        self._retired = self._new_cell()
+
+    @abstractmethod
+    def _new_cell(self) -> list:
+        """A zeroed cell for one thread's recordings."""
+
+    def _cell(self) -> list:
+        owner = getattr(self._local, "owner", None)
+        if owner is None:
+            # First record from this thread: the only time a lock is taken
+            owner = _CellOwner(self._new_cell())
+            with self._lock:
+                self._cells.append(owner.cell)
+            weakref.finalize(owner, self._retire, owner.cell)
+            self._local.owner = owner
+        return owner.cell
+
+    def _retire(self, cell: list):
+        with self._lock:
+            self._cells.remove(cell)
+            for i, value in enumerate(cell):
+                self._retired[i] += value
+
+    def _totals(self) -> list:
+        with self._lock:
+            totals = list(self._retired)
+            for cell in self._cells:
+                for i, value in enumerate(cell):
+                    totals[i] += value
+        return totals
+
+
+class Counter(_PerThread):
+    """A value that only goes up, like bytes sent or messages routed."""
+
+    kind = "counter"
+
+    def _new_cell(self) -> list:
+        return [0]
+
+    def inc(self, amount: float = 1):
+        self._cell()[0] += amount
+
+    def value(self) -> float:
+        return self._totals()[0]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, like open connections."""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1):
+        self._cell()[0] -= amount
+
+
+class CallbackGauge:
+    """A value worked out when the metrics are read, for things we can already look up."""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[Tuple[str, str], ...],
+                 callback: Callable[[], float], kind: str = "gauge"):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.callback = callback
+        self.kind = kind
+
+    def value(self) -> float:
+        return self.callback()
+
+
+class Histogram(_PerThread):
+    """Counts observations into fixed buckets, plus their sum. Used for latencies."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[Tuple[str, str], ...],
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_text, labels)
+
+    def _new_cell(self) -> list:
+        # One count per bucket, one for values above the last bucket, then the sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value: float):
+        cell = self._cell()
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def time(self) -> "_Timer":
+        """Context manager that observes how long its body took."""
+        return _Timer(self)
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        """(count per bucket, sum of observations)."""
+        totals = self._totals()
+        return totals[:-1], totals[-1]
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th quantile, or None with no observations."""
+        counts, _ = self.snapshot()
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Registry:
+    """All metrics by name and labels. Asking for the same metric twice returns the same object."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[Tuple[str, tuple], object] = {}
+        self.started = time.time()
+
+    def _get(self, cls, name: str, help_text: str, labels: Dict[str, str], **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = cls(name, help_text, key[1], **kwargs)
+                    self._metrics[key] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str = "", **labels) -> Counter:
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str = "", **labels) -> Gauge:
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name: str, help_text: str = "", buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                  **labels) -> Histogram:
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def callback(self, name: str, help_text: str, callback: Callable[[], float],
+                 kind: str = "gauge", **labels) -> CallbackGauge:
+        return self._get(CallbackGauge, name, help_text, labels, callback=callback, kind=kind)
+
+    def metrics(self) -> list:
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda m: (m.name, m.labels))
+
+    def render_prometheus(self) -> str:
+        """Everything in the Prometheus text exposition format."""
+        lines = []
+        last_name = None
+        for metric in self.metrics():
+            if metric.name != last_name:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                last_name = metric.name
+            if isinstance(metric, Histogram):
+                counts, total = metric.snapshot()
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    bucket_labels = _format_labels(metric.labels, f'le="{le}"')
+                    lines.append(f"{metric.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{metric.name}_sum{_format_labels(metric.labels)} {total}")
+                lines.append(f"{metric.name}_count{_format_labels(metric.labels)} {cumulative}")
+            else:
+                try:
+                    value = metric.value()
+                except Exception:
+                    # A broken callback shouldn't take the whole scrape down with it
+                    continue
+                lines.append(f"{metric.name}{_format_labels(metric.labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# The registry the server records into
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would drown out the chat log
+        pass
+
+
+def serve_metrics(port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """Serve registry as Prometheus text on http://host:port/metrics from a background thread."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
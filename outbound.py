@@ -0,0 +1,298 @@
+"""
+Per-connection outbound queues for Lucia.
+Every connected user gets a writer that owns their socket. Other users'
+threads only append frames to the queue, and the writer drains it in large
+coalesced writes, so a slow recipient never blocks the sender and frames from
+different senders can't interleave on the wire.
+"""
+
+import asyncio
+import socket
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Deque, List
+
+from metrics import REGISTRY
+
+# What to do with a delivery when the recipient's queue is full
+DROP_OLDEST = "drop_oldest"   # Throw away the oldest queued frames to make room
+DISCONNECT = "disconnect"     # Cut off the slow consumer
+SPILL = "spill"               # Skip live delivery; the message stays in the store for later
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT, SPILL)
+
+# Default number of queued bytes before a recipient counts as falling behind
+DEFAULT_LIMIT = 1024 * 1024
+# Upper bound on how many bytes get joined into a single write
+MAX_BATCH_BYTES = 256 * 1024
+# How long close() waits for queued frames to reach the client
+CLOSE_TIMEOUT = 5.0
+
+BYTES_OUT = REGISTRY.counter("lucia_bytes_out_total", "Bytes written to client sockets")
+FRAMES_DROPPED = REGISTRY.counter("lucia_outbound_dropped_total",
+                                  "Queued frames thrown away to make room (drop_oldest)")
+FRAMES_SPILLED = REGISTRY.counter("lucia_outbound_spilled_total",
+                                  "Deliveries skipped because the recipient's queue was full (spill)")
+SLOW_DISCONNECTS = REGISTRY.counter("lucia_outbound_disconnects_total",
+                                    "Recipients cut off for falling behind (disconnect)")
+
+
+class OutboundQueue(ABC):
+    """
+    Bounded frame queue shared by the threaded and asyncio writers.
+    send() is for replies to this connection's own client; deliver() is for frames
+    coming from other users and applies the overflow policy when the queue is full.
+    """
+
+    def __init__(self, limit: int = DEFAULT_LIMIT, policy: str = SPILL):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{policy}'")
+        self.limit = limit
+        self.policy = policy
+        self.frames: Deque[bytes] = deque()
+        self.queued_bytes = 0
+        self.closed = False
+        # Counters so we can see how often recipients fall behind
+        self.dropped = 0
+        self.spilled = 0
+        # How frames for this client are encoded (a protocol.TextCodec or BinaryCodec),
+        # set by its session so other users' sessions can deliver to it
+        self.codec = None
+
+    def _append(self, data: bytes):
+        self.frames.append(data)
+        self.queued_bytes += len(data)
+
+    def _make_room(self, size: int) -> bool:
+        """Applies the overflow policy. Returns True if the frame may be queued."""
+        if self.queued_bytes + size <= self.limit or not self.frames:
+            return True
+        if self.policy == DROP_OLDEST:
+            while self.frames and self.queued_bytes + size > self.limit:
+                self.queued_bytes -= len(self.frames.popleft())
+                self.dropped += 1
+                FRAMES_DROPPED.inc()
+            return True
+        if self.policy == DISCONNECT:
+            SLOW_DISCONNECTS.inc()
+            self._abort()
+            return False
+        self.spilled += 1
+        FRAMES_SPILLED.inc()
+        return False
+
+    def _take_batch(self) -> List[bytes]:
+        """Removes and returns queued frames, up to MAX_BATCH_BYTES (always at least one)."""
+        batch = [self.frames.popleft()]
+        size = len(batch[0])
+        while self.frames and size + len(self.frames[0]) <= MAX_BATCH_BYTES:
+            frame = self.frames.popleft()
+            batch.append(frame)
+            size += len(frame)
+        self.queued_bytes -= size
+        return batch
+
+    @abstractmethod
+    def _abort(self):
+        """Drops the queue and cuts the connection."""
+
+
+class ThreadedWriter(OutboundQueue):
+    """Outbound queue drained by its own thread, for the thread-per-client server."""
+
+    def __init__(self, sock, limit: int = DEFAULT_LIMIT, policy: str = SPILL):
+        super().__init__(limit, policy)
+        self.sock = sock
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def send(self, data: bytes) -> bool:
+        """Queues a reply, waiting while our own client is too far behind."""
+        with self.cond:
+            while self.queued_bytes >= self.limit and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return False
+            self._append(data)
+            self.cond.notify_all()
+            return True
+
+    def deliver(self, data: bytes) -> bool:
+        """Queues a frame from another user without ever blocking the caller."""
+        with self.cond:
+            if self.closed or not self._make_room(len(data)):
+                return False
+            self._append(data)
+            self.cond.notify_all()
+            return True
+
+    # deliver() already takes the lock, so any thread may call it
+    deliver_threadsafe = deliver
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.frames and not self.closed:
+                    self.cond.wait()
+                if not self.frames:
+                    return
+                batch = self._take_batch()
+                # Wake up a send() waiting for space
+                self.cond.notify_all()
+            data = b"".join(batch)
+            try:
+                self.sock.sendall(data)
+                BYTES_OUT.inc(len(data))
+            except OSError:
+                with self.cond:
+                    self.closed = True
+                    self.frames.clear()
+                    self.queued_bytes = 0
+                    self.cond.notify_all()
+                return
+
+    def _abort(self):
+        # Called with self.cond held
+        self.closed = True
+        self.frames.clear()
+        self.queued_bytes = 0
+        self.cond.notify_all()
+        try:
+            # Wakes the reader thread so the session ends
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self, timeout: float = CLOSE_TIMEOUT):
+        """Stops accepting frames and waits for what's queued to be written."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+
+
+class AsyncWriter(OutboundQueue):
+    """
+    Outbound queue drained by a task on the event loop, for the asyncio server.
+    Only call it from the loop's thread.
+    """
+
+    def __init__(self, stream_writer, limit: int = DEFAULT_LIMIT, policy: str = SPILL):
+        super().__init__(limit, policy)
+        self.stream_writer = stream_writer
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self.loop = asyncio.get_running_loop()
+        # Frames from deliver_threadsafe() waiting to be picked up on the loop, their
+        # total size, and whether the loop has been asked to pick them up
+        self._handoff_lock = threading.Lock()
+        self._handoff: Deque[bytes] = deque()
+        self._handoff_bytes = 0
+        self._handoff_scheduled = False
+        self.task = self.loop.create_task(self._run())
+
+    def send(self, data: bytes) -> bool:
+        """Queues a reply. The engine awaits drain() before reading more from this client."""
+        if self.closed:
+            return False
+        self._append(data)
+        self._wakeup.set()
+        return True
+
+    def deliver(self, data: bytes) -> bool:
+        """Queues a frame from another user without ever blocking the caller."""
+        if self.closed or not self._make_room(len(data)):
+            return False
+        self._append(data)
+        self._wakeup.set()
+        return True
+
+    def deliver_threadsafe(self, data: bytes) -> bool:
+        """
+        deliver() from a thread other than the loop's. The overflow policy is applied
+        here, against what's queued plus what's still being handed over, so a frame
+        reported as accepted always gets queued: callers move delivery cursors on that.
+        """
+        with self._handoff_lock:
+            if self.closed:
+                return False
+            # queued_bytes only changes on the loop; a slightly stale value is good enough
+            pending = self.queued_bytes + self._handoff_bytes
+            if pending and pending + len(data) > self.limit and self.policy != DROP_OLDEST:
+                if self.policy == DISCONNECT:
+                    SLOW_DISCONNECTS.inc()
+                    self.closed = True
+                    self.loop.call_soon_threadsafe(self._abort)
+                else:
+                    self.spilled += 1
+                    FRAMES_SPILLED.inc()
+                return False
+            self._handoff.append(data)
+            self._handoff_bytes += len(data)
+            # Only the first frame of a burst wakes the loop
+            if not self._handoff_scheduled:
+                self._handoff_scheduled = True
+                self.loop.call_soon_threadsafe(self._take_handoff)
+        return True
+
+    def _take_handoff(self):
+        with self._handoff_lock:
+            frames = list(self._handoff)
+            self._handoff.clear()
+            self._handoff_bytes = 0
+            self._handoff_scheduled = False
+        if self.closed:
+            return
+        for data in frames:
+            # Already accepted; drop_oldest still makes room by throwing out older frames
+            if self.policy == DROP_OLDEST:
+                self._make_room(len(data))
+            self._append(data)
+        self._wakeup.set()
+
+    async def drain(self):
+        """Waits until our own client has caught up below the queue limit."""
+        while self.queued_bytes >= self.limit and not self.closed:
+            self._space.clear()
+            await self._space.wait()
+
+    async def _run(self):
+        try:
+            while True:
+                while not self.frames:
+                    if self.closed:
+                        return
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                batch = self._take_batch()
+                self._space.set()
+                data = b"".join(batch)
+                self.stream_writer.write(data)
+                await self.stream_writer.drain()
+                BYTES_OUT.inc(len(data))
+        except (OSError, RuntimeError):
+            self.closed = True
+            self.frames.clear()
+            self.queued_bytes = 0
+        finally:
+            self._space.set()
+
+    def _abort(self):
+        self.closed = True
+        self.frames.clear()
+        self.queued_bytes = 0
+        self._wakeup.set()
+        self._space.set()
+        self.stream_writer.transport.abort()
+
+    async def close(self, timeout: float = CLOSE_TIMEOUT):
+        """Stops accepting frames and waits for what's queued to be written."""
+        self.closed = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self.task), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self.task.cancel()
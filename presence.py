@@ -0,0 +1,132 @@
+"""
+Pushed presence for Lucia: who comes online and goes offline, for clients that
+asked with /presence subscribe instead of polling /list.
+
+Logins and logouts only note the change and return; a single fan-out thread
+collects changes for a short window, drops the ones that cancel out (a quick
+reconnect), and sends each subscriber one frame with what changed in its scope:
+the people it has conversations with, or everyone. A subscriber that isn't
+keeping up loses presence frames under its outbound queue's usual policy; it
+never holds up anyone else.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+from colors import print_error
+
+CONTACTS = "contacts"
+ALL = "all"
+SCOPES = (CONTACTS, ALL)
+# How long changes are collected before they go out, in seconds
+DEFAULT_WINDOW = 0.25
+
+
+class PresenceHub:
+    """
+    Presence subscriptions and the thread that fans changes out to them.
+    contacts_of(username) lists who has a conversation with username.
+    Safe to call from any thread.
+    """
+
+    def __init__(self, contacts_of: Callable[[str], Iterable[str]], window: float = DEFAULT_WINDOW):
+        self.contacts_of = contacts_of
+        self.window = window
+        self._lock = threading.Lock()
+        # Subscribers by scope: username -> writer
+        self._subscribers: Dict[str, Dict[str, Any]] = {scope: {} for scope in SCOPES}
+        self._cond = threading.Condition()
+        # username -> [online before the window, online now]
+        self._pending: Dict[str, List[bool]] = {}
+        # Batches sent, and frames queued for subscribers
+        self.batches = 0
+        self.deliveries = 0
+        self._thread = threading.Thread(target=self._run, daemon=True, name="lucia-presence")
+        self._thread.start()
+
+    def subscribe(self, username: str, writer: Any, scope: str):
+        if scope not in SCOPES:
+            raise ValueError(f"Unknown presence scope '{scope}'")
+        with self._lock:
+            for subscribers in self._subscribers.values():
+                subscribers.pop(username, None)
+            self._subscribers[scope][username] = writer
+
+    def unsubscribe(self, username: str, writer: Any) -> bool:
+        """Drop username's subscription if writer still owns it; returns whether there was one."""
+        with self._lock:
+            for subscribers in self._subscribers.values():
+                if subscribers.get(username) is writer:
+                    del subscribers[username]
+                    return True
+        return False
+
+    def scope(self, username: str):
+        """The scope username is subscribed to, or None."""
+        with self._lock:
+            for scope, subscribers in self._subscribers.items():
+                if username in subscribers:
+                    return scope
+        return None
+
+    def subscribers(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def changed(self, username: str, online: bool):
+        """Note that username came online or went offline. Never blocks on I/O."""
+        with self._cond:
+            change = self._pending.get(username)
+            if change is None:
+                self._pending[username] = [not online, online]
+                if len(self._pending) == 1:
+                    self._cond.notify()
+            else:
+                change[1] = online
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            # Let the window's worth of changes pile up, then take them all
+            time.sleep(self.window)
+            with self._cond:
+                pending, self._pending = self._pending, {}
+            changes = [(username, after) for username, (before, after) in pending.items() if before != after]
+            if changes:
+                try:
+                    self._fan_out(changes)
+                except Exception as e:
+                    # A bad batch mustn't stop presence for good
+                    print_error(f"Error sending presence updates: {e}")
+
+    def _fan_out(self, changes: List[Tuple[str, bool]]):
+        with self._lock:
+            everyone = list(self._subscribers[ALL].items())
+            by_contact = dict(self._subscribers[CONTACTS])
+        batches: Dict[str, Tuple[Any, List[Tuple[str, bool]]]] = {}
+        if by_contact:
+            for username, online in changes:
+                for contact in self.contacts_of(username):
+                    writer = by_contact.get(contact)
+                    if writer is not None:
+                        batches.setdefault(contact, (writer, []))[1].append((username, online))
+        # Everyone-subscribers all get the same frame, encoded once per kind of codec
+        frames = {}
+        changed = {username for username, _ in changes}
+        for username, writer in everyone:
+            codec = writer.codec
+            if username in changed:
+                # Nobody needs telling about themselves
+                others = [change for change in changes if change[0] != username]
+                if others:
+                    self.deliveries += writer.deliver_threadsafe(codec.presence(others))
+                continue
+            frame = frames.get(codec.frame_key)
+            if frame is None:
+                frame = frames[codec.frame_key] = codec.presence(changes)
+            self.deliveries += writer.deliver_threadsafe(frame)
+        for writer, batch in batches.values():
+            self.deliveries += writer.deliver_threadsafe(writer.codec.presence(batch))
+        self.batches += 1
@@ -0,0 +1,493 @@
+"""
+Wire protocols spoken between the Lucia server and its clients.
+
+Version 1 is the original text protocol: newline terminated lines, with
+multi-line replies joined by |||. Version 2 is binary: a client asks for it by
+sending GREETING as its first line, the server answers GREETING_OK, and from
+then on both sides send frames:
+
+    HEADER (payload length, opcode, flags, request id) followed by fields,
+    each a FIELD length and raw bytes
+
+Requests carry a request id chosen by the client and every reply to one echoes
+it; frames the server pushes on its own (incoming messages, the catch-up after
+login) use request id 0. Text fields are UTF-8, numbers are ASCII decimal and
+message bodies are passed through untouched, so nothing in a message can be
+mistaken for protocol.
+
+The greeting may list options after the version, and GREETING_OK lists the
+ones the server accepted. The options are "zlib", meaning frame payloads may be
+compressed, and "zdict", meaning compression starts from PRESET_DICT. A
+compressed frame has FLAG_DEFLATE set. Its payload is the start of a new zlib
+stream, usually a whole one. When the stream isn't finished, it carries on in
+the following FLAG_DEFLATE | FLAG_CONTINUE frames. A multi-page history reply
+is sent this way, so each page compresses against the ones before it. Frames
+pushed in between are always whole streams, so they never disturb one in
+progress.
+
+The server renders every reply through a codec, TextCodec or BinaryCodec, so
+command handling doesn't care which protocol a client speaks.
+"""
+
+import struct
+import zlib
+from datetime import datetime
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from framing import FrameTooLong, MAX_LINE_LENGTH
+
+PROTOCOL_VERSION = 2
+# First line a v2 client sends instead of its username, and the server's answer
+GREETING = b"LUCIA-PROTO 2"
+GREETING_OK = b"LUCIA-PROTO 2 OK"
+
+HEADER = struct.Struct("<IBBI")
+FIELD = struct.Struct("<I")
+# Largest payload we accept, the same bound as a text line
+MAX_FRAME_LENGTH = MAX_LINE_LENGTH
+
+# Frame flags
+FLAG_DEFLATE = 0x01     # payload is zlib compressed
+FLAG_CONTINUE = 0x02    # ...and continues the zlib stream of the previous such frame
+
+# Greeting options
+ZLIB = "zlib"
+ZDICT = "zdict"
+# Payloads smaller than this aren't worth compressing; most chat lines are
+COMPRESS_THRESHOLD = 512
+COMPRESS_LEVEL = 6
+# A single frame gets a compressor with an 8 KiB window (wbits 13) and less memory
+# than zlib's default, which roughly halves the cost of setting one up; streams
+# spanning many frames get the full 32 KiB window
+FRAME_WBITS = 13
+FRAME_MEMLEVEL = 7
+
+# Preset dictionary for "zdict": the strings our frames are made of, so even a
+# single short frame has something to match against. zlib looks hardest at the
+# end, so the most common strings come last. Changing it breaks compatibility.
+PRESET_DICT = b"".join([
+    b"-----BEGIN PGP MESSAGE-----\n\n",
+    b"\n-----END PGP MESSAGE-----\n",
+    b"You have no contacts yet.Your contacts: Connected users: ",
+    b"=== While you were away: new message(s) from contact(s) ===",
+    b"=== Conversation with (older messages: /open before=(newer messages: /history since=",
+    b"=== End of conversation ===",
+    b" the be to of and a in that have I it for not on with he as you do at this but his by from",
+    b" they we say her she or an will my one all would there their what so up out if about who get",
+    b" which go me when make can like time no just him know take people into year your good some",
+    b" could them see other than then now look only come its over think also back after use two how",
+    b" our work first well way even new want because any these give day most us is are was ok yes",
+    b" thanks hey hi hello lol sure tomorrow today tonight later sorry please meeting ",
+    # Field lengths of short fields, and the start of this era's timestamps
+    b"".join(FIELD.pack(n) for n in range(24, 0, -1)),
+    b"\x11\x00\x00\x001.\x12\x00\x00\x001",
+    b"\x11\x00\x00\x0017",
+])
+
+# Client -> server
+LOGIN = 1               # username
+PASSWORD = 2            # password
+SEND = 3                # recipient, body
+COMMAND = 4             # command name ("/open"), arguments...
+
+# Server -> client
+PASSWORD_REQUIRED = 32  # (no fields)
+WELCOME = 33            # username, "registered" or "authenticated"
+ERROR = 34              # text
+INFO = 35               # text
+SENT = 36               # recipient
+USERS = 37              # usernames...
+CONTACTS = 38           # (contact, timestamp of last message or "") pairs
+TEXT = 39               # lines...
+MESSAGE = 40            # seq, sender, timestamp, body
+MISSED = 41             # sender, count of earlier messages not pushed
+HISTORY = 42            # contact, start, end, total, older (before= cursor or ""),
+                        # newer (since= cursor or ""), "1" on the last page, then
+                        # (seq, sender, timestamp, body) per message
+UNREAD = 43             # contact, unread count, older (before= cursor or ""),
+                        # then (seq, sender, timestamp, body) per message shown
+GROUP_MESSAGE = 44      # group, seq, sender, timestamp, body
+SEARCH_RESULTS = 45     # query, page, command for the next page or "", then
+                        # (contact, seq, sender, timestamp, body) per result
+SESSION_TOKEN = 46      # token, unix time it expires; sent after WELCOME, and the
+                        # token works in place of the password until then
+PRESENCE = 47           # (username, "1" if they came online or "" if they left) pairs,
+                        # pushed to /presence subscribers
+
+
+def encode_frame(opcode: int, request_id: int, *fields, flags: int = 0) -> bytes:
+    """One frame. Fields may be str (sent as UTF-8) or bytes."""
+    body = bytearray()
+    for field in fields:
+        data = field.encode() if isinstance(field, str) else field
+        body += FIELD.pack(len(data))
+        body += data
+    return HEADER.pack(len(body), opcode, flags, request_id) + body
+
+
+def decode_fields(payload) -> List[bytes]:
+    fields = []
+    offset = 0
+    end = len(payload)
+    while offset < end:
+        (length,) = FIELD.unpack_from(payload, offset)
+        offset += FIELD.size
+        fields.append(bytes(payload[offset:offset + length]))
+        offset += length
+    return fields
+
+
+def check_length(length: int, limit: int = MAX_FRAME_LENGTH):
+    if length > limit:
+        raise FrameTooLong(f"Frame exceeds {limit} bytes")
+
+
+def decode_payload(flags: int, payload, inflate: Optional["Inflate"] = None) -> List[bytes]:
+    """The fields of a frame's payload, decompressing it first if need be."""
+    if flags & FLAG_DEFLATE:
+        if inflate is None:
+            raise ValueError("Compressed frame, but compression wasn't negotiated")
+        payload = inflate.payload(flags, payload)
+    return decode_fields(payload)
+
+
+def read_frame(reader, inflate: Optional["Inflate"] = None) -> Optional[Tuple[int, int, int, List[bytes]]]:
+    """
+    Read one frame through a framing.LineReader.
+    Returns (opcode, flags, request id, fields), or None once the peer has closed.
+    """
+    header = reader.read_exact(HEADER.size)
+    if header is None:
+        return None
+    length, opcode, flags, request_id = HEADER.unpack(header)
+    check_length(length)
+    payload = reader.read_exact(length) if length else b""
+    if payload is None:
+        return None
+    return opcode, flags, request_id, decode_payload(flags, payload, inflate)
+
+
+def greeting_options(line: bytes, greeting: bytes) -> Optional[List[str]]:
+    """The options listed after greeting on a greeting line, or None if line isn't one."""
+    if line == greeting:
+        return []
+    if line.startswith(greeting + b" "):
+        return line[len(greeting):].decode(errors="replace").split()
+    return None
+
+
+class Deflate:
+    """Compresses the frames sent on one connection that negotiated "zlib"."""
+
+    def __init__(self, zdict: bool = False, threshold: int = COMPRESS_THRESHOLD, level: int = COMPRESS_LEVEL):
+        self.zdict = zdict
+        self.threshold = threshold
+        self.level = level
+        # Connections with the same key compress a frame to the same bytes
+        self.key = (zdict, threshold, level)
+        # The reply stream in progress, if any
+        self._stream = None
+
+    def _compressor(self, wbits: int = zlib.MAX_WBITS, memlevel: int = zlib.DEF_MEM_LEVEL):
+        if self.zdict:
+            return zlib.compressobj(self.level, zlib.DEFLATED, wbits, memlevel, zdict=PRESET_DICT)
+        return zlib.compressobj(self.level, zlib.DEFLATED, wbits, memlevel)
+
+    def pack(self, frame: bytes) -> bytes:
+        """frame as a whole compressed stream, if it's big enough to be worth it and shrinks."""
+        length, opcode, flags, request_id = HEADER.unpack_from(frame)
+        if length < self.threshold:
+            return frame
+        compressor = self._compressor(FRAME_WBITS, FRAME_MEMLEVEL)
+        data = compressor.compress(memoryview(frame)[HEADER.size:]) + compressor.flush()
+        if len(data) >= length:
+            return frame
+        return HEADER.pack(len(data), opcode, flags | FLAG_DEFLATE, request_id) + data
+
+    def pack_stream(self, frame: bytes, first: bool, last: bool) -> bytes:
+        """
+        frame as part of one compressed stream spanning several frames, first to last.
+        Later frames compress against everything before them, which is what makes
+        paging through a long history cheap.
+        """
+        if first and last:
+            return self.pack(frame)
+        length, opcode, flags, request_id = HEADER.unpack_from(frame)
+        if first or self._stream is None:
+            self._stream = self._compressor()
+            flags |= FLAG_DEFLATE
+        else:
+            flags |= FLAG_DEFLATE | FLAG_CONTINUE
+        data = self._stream.compress(memoryview(frame)[HEADER.size:])
+        data += self._stream.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+        if last:
+            self._stream = None
+        return HEADER.pack(len(data), opcode, flags, request_id) + data
+
+
+class Inflate:
+    """Decompresses the frames received on one connection that negotiated "zlib"."""
+
+    def __init__(self, zdict: bool = False, limit: int = MAX_FRAME_LENGTH):
+        self.zdict = zdict
+        self.limit = limit
+        # An unfinished stream that FLAG_CONTINUE frames carry on
+        self._stream = None
+
+    def _decompressor(self):
+        return zlib.decompressobj(zdict=PRESET_DICT) if self.zdict else zlib.decompressobj()
+
+    def payload(self, flags: int, payload) -> bytes:
+        if flags & FLAG_CONTINUE:
+            decompressor = self._stream
+            if decompressor is None or decompressor.eof:
+                raise ValueError("Compressed frame continues a stream that isn't open")
+        else:
+            decompressor = self._decompressor()
+        # Bounded like any other frame, so a tiny payload can't inflate without limit
+        data = decompressor.decompress(payload, self.limit)
+        if decompressor.unconsumed_tail:
+            raise FrameTooLong(f"Frame exceeds {self.limit} bytes uncompressed")
+        if not decompressor.eof:
+            self._stream = decompressor
+        return data
+
+
+def message_fields(message) -> List:
+    """The (seq, sender, timestamp, body) fields for a messages.Message."""
+    return [str(message.seq), message.sender, repr(message.timestamp.timestamp()), message.content.encode()]
+
+
+def split_messages(fields: Sequence[bytes]) -> List[Tuple[int, str, datetime, str]]:
+    """(seq, sender, time, body) tuples from the message fields at the end of a HISTORY or UNREAD frame."""
+    return [(int(fields[i]), fields[i + 1].decode(), datetime.fromtimestamp(float(fields[i + 2])),
+             fields[i + 3].decode(errors="replace"))
+            for i in range(0, len(fields) - 3, 4)]
+
+
+def _one_line(text: str) -> str:
+    # A v2 client can send bodies with newlines, which would end a text line early
+    return text.replace("\n", " ") if "\n" in text else text
+
+
+class TextCodec:
+    """Protocol 1: replies as lines of text, exactly as the server has always sent them."""
+
+    version = 1
+    # Codecs with the same frame_key encode a pushed message to the same bytes
+    frame_key = 1
+
+    def __init__(self):
+        # Unused in text mode; kept so sessions can set it regardless of protocol
+        self.request_id = 0
+
+    def password_required(self) -> bytes:
+        return b"Enter password:\n"
+
+    def welcome(self, username: str, registered: bool) -> bytes:
+        if registered:
+            return f"Welcome, {username}! You are now registered.\n".encode()
+        return b"Authenticated successfully.\n"
+
+    def error(self, text: str) -> bytes:
+        return f"ERROR: {text}\n".encode()
+
+    def info(self, text: str) -> bytes:
+        return f"{text}\n".encode()
+
+    def sent(self, recipient: str) -> bytes:
+        return f"Message sent to {recipient}.\n".encode()
+
+    def users(self, usernames: Iterable[str]) -> bytes:
+        return f"Connected users: {', '.join(usernames)}\n".encode()
+
+    def contacts(self, activity: List[Tuple[str, Optional[float]]], with_times: bool) -> bytes:
+        if not activity:
+            return b"You have no contacts yet.\n"
+        if with_times:
+            entries = [f"{contact} ({datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')})" if ts else contact
+                       for contact, ts in activity]
+        else:
+            entries = [contact for contact, _ in activity]
+        return f"Your contacts: {', '.join(entries)}\n".encode()
+
+    def lines(self, lines: List[str]) -> bytes:
+        return "|||".join(lines).encode() + b"\n"
+
+    def messages(self, sender: str, unread: int, messages: List) -> bytes:
+        """A live delivery: the newest messages from sender, noting any earlier ones left out."""
+        frame = "".join(f"[from {sender}]: {_one_line(msg.content)}\n" for msg in messages)
+        if unread > len(messages):
+            frame = f"({unread - len(messages)} earlier messages from {sender}, see /open {sender})\n" + frame
+        return frame.encode()
+
+    def group_messages(self, group: str, unread: int, messages: List) -> bytes:
+        """messages() for a group; each line names the group as well as the sender."""
+        frame = "".join(f"[from {msg.sender} in {group}]: {_one_line(msg.content)}\n" for msg in messages)
+        if unread > len(messages):
+            frame = f"({unread - len(messages)} earlier messages in {group}, see /open {group})\n" + frame
+        return frame.encode()
+
+    def history_page(self, contact: str, messages: List, start: int, end: int, total: int, limit: int,
+                     older: Optional[int], newer: Optional[int], first: bool, last: bool) -> bytes:
+        lines = []
+        if first:
+            if end > start:
+                lines.append(f"=== Conversation with {contact} (messages {start}-{end - 1} of {total}) ===")
+            else:
+                lines.append(f"=== Conversation with {contact} ===")
+            if older is not None:
+                lines.append(f"(older messages: /open {contact} {limit} before={older})")
+            if end <= start:
+                lines.append("(No messages yet)")
+        lines.extend(_one_line(f"#{msg.seq} {msg}") for msg in messages)
+        if last:
+            if newer is not None:
+                lines.append(f"(newer messages: /history {contact} since={newer})")
+            lines.append("=== End of conversation ===")
+        return self.lines(lines)
+
+    def presence(self, changes: List[Tuple[str, bool]]) -> bytes:
+        online = [username for username, now_online in changes if now_online]
+        offline = [username for username, now_online in changes if not now_online]
+        parts = []
+        if online:
+            parts.append(f"online {', '.join(online)}")
+        if offline:
+            parts.append(f"offline {', '.join(offline)}")
+        return f"Presence: {'; '.join(parts)}\n".encode()
+
+    def session_token(self, token: str, expires: int) -> bytes:
+        until = datetime.fromtimestamp(expires).strftime("%H:%M:%S")
+        return f"Session token, valid until {until}: {token} (send it instead of your password to log back in)\n".encode()
+
+    def search_results(self, query: str, page: int, results: List[Tuple[str, object]],
+                       next_page: Optional[str]) -> bytes:
+        """results: (contact, message) pairs; next_page is the command for the next page, if any."""
+        if not results and page == 1:
+            return self.info(f"No messages found matching '{query}'.")
+        lines = [f"=== Search results for '{query}' (page {page}) ==="]
+        lines.extend(_one_line(f"{contact} #{msg.seq} [{msg.timestamp.strftime('%Y-%m-%d %H:%M:%S')}] "
+                               f"{msg.sender}: {msg.content}") for contact, msg in results)
+        if next_page:
+            lines.append(f"(more results: {next_page})")
+        if results:
+            lines.append("(to see one in context: /open <contact> 20 before=<number + 10>)")
+        lines.append("=== End of search results ===")
+        return self.lines(lines)
+
+    def catch_up(self, total: int, entries: List[Tuple[str, int, List, Optional[Tuple[int, int]]]]) -> bytes:
+        """entries: (contact, unread, messages shown, (count, before cursor) of older unread or None)."""
+        lines = [f"=== While you were away: {total} new message(s) from {len(entries)} contact(s) ==="]
+        for contact, unread, shown, older in entries:
+            lines.append(f"--- {contact}: {unread} unread ---")
+            if older is not None:
+                lines.append(f"(older unread: /open {contact} {older[0]} before={older[1]})")
+            lines.extend(_one_line(f"#{msg.seq} {msg}") for msg in shown)
+        lines.append("=== End of missed messages ===")
+        return self.lines(lines)
+
+
+class BinaryCodec:
+    """Protocol 2: replies as typed frames."""
+
+    version = 2
+
+    def __init__(self, deflate: Optional[Deflate] = None):
+        # Id of the request being handled; its replies carry it. Pushed frames use 0.
+        self.request_id = 0
+        # Set when the client negotiated compression
+        self.deflate = deflate
+        self.frame_key = (2, deflate.key if deflate else None)
+
+    def _pack(self, frame: bytes) -> bytes:
+        return self.deflate.pack(frame) if self.deflate else frame
+
+    def _pack_all(self, frames: List[bytes]) -> bytes:
+        # Frames sent together share one compressed stream
+        if self.deflate:
+            last = len(frames) - 1
+            frames = [self.deflate.pack_stream(frame, i == 0, i == last) for i, frame in enumerate(frames)]
+        return b"".join(frames)
+
+    def _reply(self, opcode: int, *fields) -> bytes:
+        return self._pack(encode_frame(opcode, self.request_id, *fields))
+
+    def password_required(self) -> bytes:
+        return self._reply(PASSWORD_REQUIRED)
+
+    def welcome(self, username: str, registered: bool) -> bytes:
+        return self._reply(WELCOME, username, "registered" if registered else "authenticated")
+
+    def error(self, text: str) -> bytes:
+        return self._reply(ERROR, text)
+
+    def info(self, text: str) -> bytes:
+        return self._reply(INFO, text)
+
+    def sent(self, recipient: str) -> bytes:
+        return self._reply(SENT, recipient)
+
+    def users(self, usernames: Iterable[str]) -> bytes:
+        return self._reply(USERS, *usernames)
+
+    def contacts(self, activity: List[Tuple[str, Optional[float]]], with_times: bool) -> bytes:
+        fields = []
+        for contact, ts in activity:
+            fields += [contact, repr(ts) if with_times and ts else ""]
+        return self._reply(CONTACTS, *fields)
+
+    def lines(self, lines: List[str]) -> bytes:
+        return self._reply(TEXT, *lines)
+
+    def messages(self, sender: str, unread: int, messages: List) -> bytes:
+        # Called from other users' sessions, so never stamped with our request id
+        frames = []
+        if unread > len(messages):
+            frames.append(encode_frame(MISSED, 0, sender, str(unread - len(messages))))
+        frames += [encode_frame(MESSAGE, 0, *message_fields(msg)) for msg in messages]
+        return b"".join(map(self._pack, frames))
+
+    def group_messages(self, group: str, unread: int, messages: List) -> bytes:
+        frames = []
+        if unread > len(messages):
+            frames.append(encode_frame(MISSED, 0, group, str(unread - len(messages))))
+        frames += [encode_frame(GROUP_MESSAGE, 0, group, *message_fields(msg)) for msg in messages]
+        return b"".join(map(self._pack, frames))
+
+    def history_page(self, contact: str, messages: List, start: int, end: int, total: int, limit: int,
+                     older: Optional[int], newer: Optional[int], first: bool, last: bool) -> bytes:
+        fields = [contact, str(start), str(end), str(total),
+                  "" if older is None else str(older), "" if newer is None else str(newer), "1" if last else ""]
+        for msg in messages:
+            fields += message_fields(msg)
+        frame = encode_frame(HISTORY, self.request_id, *fields)
+        # The pages of one reply go out as one compressed stream
+        return self.deflate.pack_stream(frame, first, last) if self.deflate else frame
+
+    def search_results(self, query: str, page: int, results: List[Tuple[str, object]],
+                       next_page: Optional[str]) -> bytes:
+        fields = [query, str(page), next_page or ""]
+        for contact, msg in results:
+            fields.append(contact)
+            fields += message_fields(msg)
+        return self._reply(SEARCH_RESULTS, *fields)
+
+    def session_token(self, token: str, expires: int) -> bytes:
+        return self._reply(SESSION_TOKEN, token, str(expires))
+
+    def presence(self, changes: List[Tuple[str, bool]]) -> bytes:
+        # Pushed, so never stamped with a request id
+        fields = []
+        for username, online in changes:
+            fields += [username, "1" if online else ""]
+        return self._pack(encode_frame(PRESENCE, 0, *fields))
+
+    def catch_up(self, total: int, entries: List[Tuple[str, int, List, Optional[Tuple[int, int]]]]) -> bytes:
+        frames = []
+        for contact, unread, shown, older in entries:
+            fields = [contact, str(unread), "" if older is None else str(older[1])]
+            for msg in shown:
+                fields += message_fields(msg)
+            frames.append(encode_frame(UNREAD, 0, *fields))
+        return self._pack_all(frames)
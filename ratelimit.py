@@ -0,0 +1,168 @@
+"""
+Token buckets and admission control for Lucia.
+
+Every user, and optionally every client IP, gets a token bucket per category of
+request: chat messages, commands, and the expensive commands that walk a whole
+history or contact list. A request takes a token; when the bucket is empty the
+token is borrowed instead and the caller is told how long to wait before acting
+on it. The server waits before reading anything more from that connection, so a
+flooder is slowed to the configured rate by TCP backpressure, at no cost to
+anyone else and without losing what it sent.
+
+Admission caps the number of open connections and of connections still in the
+login handshake, so new connections can be turned away before any thread or
+buffer is spent on them.
+"""
+
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+MESSAGE = "message"
+COMMAND = "command"
+EXPENSIVE = "expensive"
+CATEGORIES = (MESSAGE, COMMAND, EXPENSIVE)
+# Commands that walk a whole conversation, contact or user list, or run the password KDF
+EXPENSIVE_COMMANDS = ("/open", "/contacts", "/list", "/presence", "/password")
+
+# Buckets kept before idle ones are pruned
+PRUNE_AT = 4096
+
+
+class Limit(NamedTuple):
+    rate: float   # Tokens added per second
+    burst: float  # Most tokens a bucket holds
+
+
+def parse_limit(spec: Optional[str]) -> Optional[Limit]:
+    """
+    A limit from "rate/burst" or just "rate" (the burst is then twice the rate).
+    None for an empty spec, "0" or "off". Raises ValueError for anything else.
+    """
+    if spec is None or spec.strip().lower() in ("", "0", "off"):
+        return None
+    rate, _, burst = spec.partition("/")
+    limit = Limit(float(rate), float(burst) if burst else 2 * float(rate))
+    if limit.rate <= 0 or limit.burst < 1:
+        raise ValueError(f"Bad rate limit '{spec}': need a positive rate and a burst of at least 1")
+    return limit
+
+
+def command_category(command: str) -> str:
+    return EXPENSIVE if command.lower() in EXPENSIVE_COMMANDS else COMMAND
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, limit: Limit, now: float):
+        self.tokens = limit.burst
+        self.updated = now
+
+    def take(self, limit: Limit, now: float) -> float:
+        """
+        Take a token; returns 0 if there was one, or else how long until the one
+        borrowed would have been there. Borrowing puts the bucket in debt, so
+        concurrent takers line up instead of all waking at once.
+        """
+        tokens = min(limit.burst, self.tokens + (now - self.updated) * limit.rate) - 1
+        self.tokens = tokens
+        self.updated = now
+        return 0.0 if tokens >= 0 else -tokens / limit.rate
+
+    def full(self, limit: Limit, now: float) -> bool:
+        return self.tokens + (now - self.updated) * limit.rate >= limit.burst
+
+
+class RateLimiter:
+    """
+    One bucket per (category, key), for keys of one kind (usernames or IPs).
+    Categories without a limit are never limited. Safe to call from any thread.
+    """
+
+    def __init__(self, limits: Dict[str, Optional[Limit]]):
+        self.limits = {category: limit for category, limit in limits.items() if limit is not None}
+        self._lock = threading.Lock()
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._prune_at = PRUNE_AT
+        # Requests that had to wait, per category
+        self.limited = {category: 0 for category in CATEGORIES}
+
+    def __bool__(self):
+        return bool(self.limits)
+
+    def take(self, category: str, key: str, now: Optional[float] = None) -> float:
+        """Take a token from key's bucket for category; returns how long to wait first."""
+        limit = self.limits.get(category)
+        if limit is None:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get((category, key))
+            if bucket is None:
+                if len(self._buckets) >= self._prune_at:
+                    self._prune_locked(now)
+                bucket = self._buckets[(category, key)] = TokenBucket(limit, now)
+            delay = bucket.take(limit, now)
+            if delay:
+                self.limited[category] += 1
+        return delay
+
+    def _prune_locked(self, now: float):
+        # A full bucket is the same as no bucket, so forget those
+        self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                         if not bucket.full(self.limits[key[0]], now)}
+        self._prune_at = max(PRUNE_AT, 2 * len(self._buckets))
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class Admission:
+    """
+    Counts open connections and the ones still logging in, and turns new ones away
+    once either passes its cap (None for no cap). Safe to call from any thread.
+    """
+
+    def __init__(self, max_connections: Optional[int] = None, max_handshakes: Optional[int] = None):
+        self.max_connections = max_connections
+        self.max_handshakes = max_handshakes
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.handshakes = 0
+        # Connections turned away, by the cap they hit
+        self.rejected = {"connections": 0, "handshakes": 0}
+
+    def admit(self) -> Optional[str]:
+        """Count a new connection in; returns None, or the cap it hit if it has to be turned away."""
+        with self._lock:
+            if self.max_connections is not None and self.connections >= self.max_connections:
+                reason = "connections"
+            elif self.max_handshakes is not None and self.handshakes >= self.max_handshakes:
+                reason = "handshakes"
+            else:
+                self.connections += 1
+                self.handshakes += 1
+                return None
+            self.rejected[reason] += 1
+            return reason
+
+    def adopt(self, handshaking: bool):
+        """Count in a connection handed over by a hot restart, whatever the caps."""
+        with self._lock:
+            self.connections += 1
+            if handshaking:
+                self.handshakes += 1
+
+    def logged_in(self):
+        """An admitted connection finished its handshake."""
+        with self._lock:
+            self.handshakes -= 1
+
+    def release(self, handshaking: bool):
+        """An admitted connection closed; handshaking if it never finished logging in."""
+        with self._lock:
+            self.connections -= 1
+            if handshaking:
+                self.handshakes -= 1
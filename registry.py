@@ -0,0 +1,116 @@
+"""
+Concurrent registry of known and connected users for Lucia.
+Usernames are spread over a fixed set of lock stripes, so logins and lookups
+for different users don't wait on each other. Every operation is a short
+in-memory check-and-set; callers must never do network I/O while a stripe is held.
+"""
+
+import threading
+from typing import Any, List, Optional
+
+# Number of lock stripes; a power of two keeps the modulo cheap
+DEFAULT_STRIPES = 64
+
+
+class UserRegistry:
+    """Tracks registered users and which writer each connected user is using."""
+
+    def __init__(self, stripes: int = DEFAULT_STRIPES):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        # One known-user set and one connected-user dict per stripe
+        self._known = [set() for _ in range(stripes)]
+        self._connected = [dict() for _ in range(stripes)]
+
+    def _stripe(self, username: str) -> int:
+        return hash(username) % len(self._locks)
+
+    def register(self, username: str) -> bool:
+        """Adds a new user. Returns False if the username was already taken."""
+        i = self._stripe(username)
+        with self._locks[i]:
+            if username in self._known[i]:
+                return False
+            self._known[i].add(username)
+            return True
+
+    def is_known(self, username: str) -> bool:
+        """Checks whether a username has been registered."""
+        i = self._stripe(username)
+        with self._locks[i]:
+            return username in self._known[i]
+
+    def is_connected(self, username: str) -> bool:
+        """Checks whether a user currently has a live session."""
+        i = self._stripe(username)
+        with self._locks[i]:
+            return username in self._connected[i]
+
+    def connect(self, username: str, writer: Any) -> bool:
+        """
+        Marks a user as connected through writer, unless they already are.
+        Returns False if another session already holds the username.
+        """
+        i = self._stripe(username)
+        with self._locks[i]:
+            if username in self._connected[i]:
+                return False
+            self._connected[i][username] = writer
+            return True
+
+    def register_and_connect(self, username: str, writer: Any) -> bool:
+        """
+        Registers a brand new user and connects them in one step.
+        Returns False if the username already exists.
+        """
+        i = self._stripe(username)
+        with self._locks[i]:
+            if username in self._known[i]:
+                return False
+            self._known[i].add(username)
+            self._connected[i][username] = writer
+            return True
+
+    def disconnect(self, username: str, writer: Any) -> bool:
+        """Removes a user's session, but only if writer is still the one registered."""
+        i = self._stripe(username)
+        with self._locks[i]:
+            if self._connected[i].get(username) is writer:
+                del self._connected[i][username]
+                return True
+            return False
+
+    def get_writer(self, username: str) -> Optional[Any]:
+        """Returns the connected user's writer, or None if they're offline."""
+        i = self._stripe(username)
+        with self._locks[i]:
+            return self._connected[i].get(username)
+
+    def lookup(self, username: str):
+        """Returns (is_known, writer) in one step, for message routing."""
+        i = self._stripe(username)
+        with self._locks[i]:
+            return username in self._known[i], self._connected[i].get(username)
+
+    def connected_writers(self) -> List[Any]:
+        """Returns a snapshot of every connected user's writer, taking one stripe at a time."""
+        writers = []
+        for lock, connected in zip(self._locks, self._connected):
+            with lock:
+                writers.extend(connected.values())
+        return writers
+
+    def connected_users(self) -> List[str]:
+        """Returns a snapshot of connected usernames, taking one stripe at a time."""
+        users = []
+        for lock, connected in zip(self._locks, self._connected):
+            with lock:
+                users.extend(connected.keys())
+        return users
+
+    def known_users(self) -> List[str]:
+        """Returns a snapshot of every registered username."""
+        users = []
+        for lock, known in zip(self._locks, self._known):
+            with lock:
+                users.extend(known)
+        return users
@@ -0,0 +1,272 @@
+"""
+Full-text search over conversation history for /search.
+
+SearchIndex is an inverted index kept per conversation: each conversation's
+messages are indexed in blocks of BLOCK_SIZE, a block mapping every term to the
+sequence numbers of the messages containing it. Blocks only ever grow at the
+end, so postings stay sorted without any work, and the index is bounded by
+dropping whole blocks, the oldest first, once it outgrows its memory budget.
+
+The index is brought up to date lazily: before MessageStore.search_messages()
+looks in a conversation, it indexes whatever was added since the last time.
+Tokenizing every message as it arrived would roughly double the server's CPU
+time per message, for conversations nobody may ever search. The store also
+drops a conversation's entries in delete_conversation(). Who may search what is
+up to the store, which only ever looks up the caller's own conversations.
+
+Bodies that are PGP armored are never indexed: once messages are end-to-end
+encrypted the server can't read them, and search only covers what's stored in
+plaintext.
+"""
+
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Messages per block
+BLOCK_SIZE = 1024
+# Default memory budget, in (estimated) bytes
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+# Words longer than MAX_TERM_LENGTH are indexed as several terms, and only the first
+# MAX_TERMS distinct terms of a message are indexed, so one huge message can't take
+# over the budget
+MAX_TERM_LENGTH = 32
+MAX_TERMS = 256
+# Rough cost of a posting, of a term's dict entry and array, and of a message's row
+POSTING_BYTES = 4
+TERM_BYTES = 160
+ROW_BYTES = 12
+# Shortest prefix a "term*" query may use
+MIN_PREFIX = 2
+# Bodies starting with this are encrypted and skipped
+ARMOR_HEADER = "-----BEGIN PGP"
+
+WORD = re.compile(r"\w{1,%d}" % MAX_TERM_LENGTH)
+
+
+def terms_of(text: str) -> Optional[List[str]]:
+    """The distinct terms of a message body, or None if it's encrypted and can't be indexed."""
+    if text.lstrip().startswith(ARMOR_HEADER):
+        return None
+    terms = list(dict.fromkeys(WORD.findall(text.lower())))
+    del terms[MAX_TERMS:]
+    return terms
+
+
+def parse_query(words: Iterable[str]) -> List[Tuple[str, bool]]:
+    """
+    (term, is_prefix) pairs for a query; every one must match. "term*" matches any
+    term starting with "term". Raises ValueError if nothing searchable is left.
+    """
+    query = []
+    for word in words:
+        prefix = word.endswith("*")
+        for term in WORD.findall(word.lower()):
+            query.append((term, False))
+        if prefix and query:
+            # Only the last piece of "foo-ba*" is a prefix
+            term = query[-1][0]
+            if len(term) < MIN_PREFIX:
+                raise ValueError(f"Prefixes need at least {MIN_PREFIX} characters")
+            query[-1] = (term, True)
+    if not query:
+        raise ValueError("Nothing to search for")
+    return query
+
+
+class _Block:
+    """Up to BLOCK_SIZE consecutive indexed messages of one conversation."""
+
+    __slots__ = ("seqs", "timestamps", "postings", "memory", "_sorted_terms")
+
+    def __init__(self):
+        # Parallel and in seq order: which messages are in here, and when they were sent
+        self.seqs = array("I")
+        self.timestamps = array("d")
+        self.postings: Dict[str, array] = {}
+        self.memory = 0
+        self._sorted_terms: Optional[List[str]] = None
+
+    def add(self, seq: int, timestamp: float, terms: List[str]) -> int:
+        """Index one message; returns the memory it added."""
+        self.seqs.append(seq)
+        self.timestamps.append(timestamp)
+        added = ROW_BYTES + POSTING_BYTES * len(terms)
+        block_postings = self.postings
+        for term in terms:
+            postings = block_postings.get(term)
+            if postings is None:
+                postings = block_postings[term] = array("I")
+                added += TERM_BYTES
+                self._sorted_terms = None
+            postings.append(seq)
+        self.memory += added
+        return added
+
+    def terms_with_prefix(self, prefix: str) -> List[str]:
+        terms = self._sorted_terms
+        if terms is None:
+            terms = self._sorted_terms = sorted(self.postings)
+        start = bisect_left(terms, prefix)
+        end = start
+        while end < len(terms) and terms[end].startswith(prefix):
+            end += 1
+        return terms[start:end]
+
+    def matches(self, query: List[Tuple[str, bool]]) -> List[int]:
+        """Seqs of the messages in this block containing every query term, ascending."""
+        found = None
+        for term, prefix in query:
+            if prefix:
+                seqs = set()
+                for match in self.terms_with_prefix(term):
+                    seqs.update(self.postings[match])
+            else:
+                seqs = set(self.postings.get(term, ()))
+            found = seqs if found is None else found & seqs
+            if not found:
+                return []
+        return sorted(found)
+
+    def clear(self):
+        self.seqs = array("I")
+        self.timestamps = array("d")
+        self.postings = {}
+        self.memory = 0
+        self._sorted_terms = None
+
+    def timestamp_of(self, seq: int) -> float:
+        return self.timestamps[bisect_left(self.seqs, seq)]
+
+
+class _ConversationIndex:
+    __slots__ = ("blocks", "next_seq")
+
+    def __init__(self):
+        self.blocks: deque = deque()
+        # Messages below this have been seen (indexed or skipped)
+        self.next_seq = 0
+
+
+class SearchIndex:
+    """
+    Inverted index over every conversation's messages, bounded to memory_budget bytes.
+    Safe to call from any thread.
+    """
+
+    def __init__(self, memory_budget: int = DEFAULT_MEMORY_BUDGET, block_size: int = BLOCK_SIZE):
+        self.memory_budget = memory_budget
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._conversations: Dict[tuple, _ConversationIndex] = {}
+        # Every block, oldest first, for dropping when over budget. Blocks of removed
+        # conversations linger (emptied) until there are enough to be worth compacting.
+        self._blocks: deque = deque()
+        self._removed_blocks = 0
+        self.memory = 0
+        self.indexed = 0
+        self.skipped = 0
+        self.dropped_blocks = 0
+
+    def next_seq(self, key: tuple) -> int:
+        """Messages of conversation key below this have been indexed (or skipped)."""
+        conversation = self._conversations.get(key)
+        return conversation.next_seq if conversation is not None else 0
+
+    def _add_locked(self, key: tuple, conversation: _ConversationIndex, seq: int, timestamp: float,
+                    terms: Optional[List[str]]):
+        if seq < conversation.next_seq:
+            return
+        conversation.next_seq = seq + 1
+        if terms is None:
+            self.skipped += 1
+            return
+        blocks = conversation.blocks
+        if not blocks or len(blocks[-1].seqs) >= self.block_size:
+            block = _Block()
+            blocks.append(block)
+            self._blocks.append((key, block))
+        self.memory += blocks[-1].add(seq, timestamp, terms)
+        self.indexed += 1
+
+    def _enforce_budget_locked(self):
+        while self.memory > self.memory_budget and self._blocks:
+            key, block = self._blocks.popleft()
+            if block.memory == 0:
+                # Its conversation was removed
+                self._removed_blocks = max(0, self._removed_blocks - 1)
+                continue
+            self.memory -= block.memory
+            self.dropped_blocks += 1
+            conversation = self._conversations.get(key)
+            # Blocks of a conversation are created in order, so it's always their oldest
+            if conversation is not None and conversation.blocks and conversation.blocks[0] is block:
+                conversation.blocks.popleft()
+
+    def index(self, key: tuple, messages: Iterable):
+        """Index messages of conversation key (oldest first); ones already seen are ignored."""
+        batch = [(msg.seq, msg.timestamp.timestamp(), terms_of(msg.content)) for msg in messages]
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                conversation = self._conversations[key] = _ConversationIndex()
+            for seq, timestamp, terms in batch:
+                self._add_locked(key, conversation, seq, timestamp, terms)
+            self._enforce_budget_locked()
+
+    def remove(self, key: tuple):
+        """Forget conversation key; its blocks are freed now and skipped in _blocks later."""
+        with self._lock:
+            conversation = self._conversations.pop(key, None)
+            if conversation is None:
+                return
+            for block in conversation.blocks:
+                self.memory -= block.memory
+                block.clear()
+            self._removed_blocks += len(conversation.blocks)
+            if self._removed_blocks > len(self._blocks) // 2:
+                self._blocks = deque(entry for entry in self._blocks if entry[0] in self._conversations)
+                self._removed_blocks = 0
+
+    def search(self, key: tuple, query: List[Tuple[str, bool]], limit: int, first_seq: int = 0,
+               since: Optional[float] = None, until: Optional[float] = None) -> List[Tuple[int, float]]:
+        """
+        Up to limit (seq, timestamp) pairs of messages in conversation key matching query,
+        newest first. Messages below first_seq (dropped by retention) and outside
+        [since, until) are left out.
+        """
+        results = []
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                return results
+            for block in reversed(conversation.blocks):
+                timestamps = block.timestamps
+                if (since is not None and timestamps[-1] < since) or (until is not None and timestamps[0] >= until):
+                    continue
+                if block.seqs[-1] < first_seq:
+                    break
+                for seq in reversed(block.matches(query)):
+                    if seq < first_seq:
+                        break
+                    timestamp = block.timestamp_of(seq)
+                    if (since is not None and timestamp < since) or (until is not None and timestamp >= until):
+                        continue
+                    results.append((seq, timestamp))
+                    if len(results) >= limit:
+                        return results
+        return results
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "conversations": len(self._conversations),
+                "blocks": sum(len(c.blocks) for c in self._conversations.values()),
+                "memory": self.memory,
+                "indexed": self.indexed,
+                "skipped": self.skipped,
+                "dropped_blocks": self.dropped_blocks,
+            }
@@ -1,300 +1,1908 @@
+import asyncio
+import re
+from datetime import datetime, timedelta
+from functools import partial
 import socket
+import subprocess
+import tempfile
 import threading
 import os
+import signal
+import ssl
 import sys
+import time
 from colors import cprint, print_error, print_info, print_success, print_warning, print_received, get_prompt, cstr
-from messages import MessageStore
+from colors import configure_logging, shutdown_logging, log_enabled, DEBUG, LEVELS
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from messages import MessageStore, SPILL_EVICTION, DROP_EVICTION, GROUP_PREFIX
+from search import SearchIndex, DEFAULT_MEMORY_BUDGET as DEFAULT_SEARCH_MEMORY, parse_query
+from framing import LineReader, LineTooLong, MAX_LINE_LENGTH
+from protocol import TextCodec, BinaryCodec, GREETING, GREETING_OK, HEADER, LOGIN, PASSWORD, SEND, COMMAND
+from protocol import read_frame, decode_payload, check_length, greeting_options
+from protocol import Deflate, Inflate, ZLIB, ZDICT, COMPRESS_THRESHOLD, COMPRESS_LEVEL as DEFAULT_COMPRESS_LEVEL
+from registry import UserRegistry
+from credentials import Credentials, Busy, KDFS, DEFAULT_KDF, DEFAULT_MAX_QUEUE, DEFAULT_TOKEN_TTL, TOKEN_PREFIX
+from storage import LogBackend, DEFAULT_FSYNC_INTERVAL
+import ratelimit
+from ratelimit import RateLimiter, Admission, parse_limit, command_category
+from presence import PresenceHub, SCOPES as PRESENCE_SCOPES, CONTACTS as PRESENCE_CONTACTS, DEFAULT_WINDOW
+from outbound import ThreadedWriter, AsyncWriter, DEFAULT_LIMIT, OVERFLOW_POLICIES, SPILL, BYTES_OUT
+from metrics import REGISTRY, serve_metrics
+import hotrestart
+import tls
+from cluster import Hub, ClusterBus, ClusterRegistry
 
 HOST = "127.0.0.1"
 # Allow overriding the port via env var LUCIA_PORT or first CLI arg
 DEFAULT_PORT = int(os.environ.get("LUCIA_PORT", "1337"))
 PORT = DEFAULT_PORT
-if len(sys.argv) > 1:
+# Server engine: "threaded" (one thread per client) or "asyncio" (one event loop for everyone)
+# Set with env var LUCIA_MODE or the --asyncio / --threaded flags
+MODE = os.environ.get("LUCIA_MODE", "threaded").lower()
+# Worker processes sharing the port (env var LUCIA_WORKERS or --workers=N); see cluster.py
+WORKERS = int(os.environ.get("LUCIA_WORKERS", "1"))
+for arg in sys.argv[1:]:
+    if arg == "--asyncio":
+        MODE = "asyncio"
+    elif arg == "--threaded":
+        MODE = "threaded"
+    elif arg.startswith("--workers="):
+        WORKERS = int(arg.split("=", 1)[1])
+    else:
+        try:
+            PORT = int(arg)
+        except Exception:
+            pass
+if MODE not in ("threaded", "asyncio"):
+    MODE = "threaded"
+WORKERS = max(1, WORKERS)
+# Set by the supervisor for the worker processes it starts: the hub's socket and our id
+HUB_PATH = os.environ.get("LUCIA_HUB")
+WORKER_ID = os.environ.get("LUCIA_WORKER_ID", "0")
+# TLS (see tls.py): set env vars LUCIA_TLS_CERT and LUCIA_TLS_KEY to PEM files (the key may
+# be in the certificate file) and every connection has to use it. LUCIA_TLS_TICKETS is how
+# many session tickets each client gets for resuming; LUCIA_KTLS=0 keeps encryption out of the kernel.
+TLS_CERT = os.environ.get("LUCIA_TLS_CERT")
+TLS_KEY = os.environ.get("LUCIA_TLS_KEY")
+TLS_TICKETS = int(os.environ.get("LUCIA_TLS_TICKETS", str(tls.DEFAULT_TICKETS)))
+KTLS = os.environ.get("LUCIA_KTLS", "1") != "0"
+tls_context = None
+if TLS_CERT:
     try:
-        PORT = int(sys.argv[1])
-    except Exception:
-        pass
+        tls_context = tls.server_context(TLS_CERT, TLS_KEY, tickets=TLS_TICKETS, ktls=KTLS)
+    except (OSError, ValueError) as e:
+        print_error(f"Couldn't load the TLS certificate {TLS_CERT}: {e}")
+        sys.exit(1)
+# SIGUSR2 hands everything over to a fresh copy of the server without dropping anyone
+# (see hotrestart.py). Only for a single process, on platforms that can pass sockets,
+# and without TLS, whose connection state can't leave the process;
+# LUCIA_HOT_RESTART=0 turns it off. Connections get LUCIA_RESTART_TIMEOUT seconds to
+# finish the request they're in and flush their replies, or they're dropped.
+HOT_RESTART = (os.environ.get("LUCIA_HOT_RESTART", "1") != "0" and hotrestart.supported()
+               and hasattr(signal, "SIGUSR2") and WORKERS == 1 and not HUB_PATH and tls_context is None)
+RESTART_TIMEOUT = float(os.environ.get("LUCIA_RESTART_TIMEOUT", str(hotrestart.DEFAULT_TIMEOUT)))
+restart = hotrestart.Restart()
+# Where to write our process id (env var LUCIA_PID_FILE), which a hot restart changes
+PID_FILE = os.environ.get("LUCIA_PID_FILE")
+
+# Logging: lowest level printed (debug, info, warning, error) via env var LUCIA_LOG_LEVEL;
+# "info" turns off the line per routed message. Lines are written by a background
+# thread unless LUCIA_LOG_BACKGROUND=0, so a slow stdout never stalls message routing.
+LOG_LEVEL = os.environ.get("LUCIA_LOG_LEVEL", "debug").lower()
+if LOG_LEVEL not in LEVELS:
+    LOG_LEVEL = "debug"
+LOG_BACKGROUND = os.environ.get("LUCIA_LOG_BACKGROUND", "1") != "0"
+configure_logging(level=LOG_LEVEL, background=LOG_BACKGROUND)
+
+# Per-user outbound queue size in bytes, and what to do once a recipient fills it up
+# (drop_oldest, disconnect or spill), via env vars LUCIA_OUTBOUND_LIMIT and LUCIA_OVERFLOW_POLICY
+OUTBOUND_LIMIT = int(os.environ.get("LUCIA_OUTBOUND_LIMIT", str(DEFAULT_LIMIT)))
+OVERFLOW_POLICY = os.environ.get("LUCIA_OVERFLOW_POLICY", SPILL).lower()
+if OVERFLOW_POLICY not in OVERFLOW_POLICIES:
+    OVERFLOW_POLICY = SPILL
+
+# Compression offered to protocol v2 clients, via env var LUCIA_COMPRESSION: "off", "zlib",
+# or "zdict" (zlib starting from protocol.PRESET_DICT, the default). Frames with payloads
+# under LUCIA_COMPRESS_MIN bytes are sent as they are; LUCIA_COMPRESS_LEVEL trades CPU
+# for bytes (1-9).
+COMPRESSION = os.environ.get("LUCIA_COMPRESSION", ZDICT).lower()
+if COMPRESSION not in ("off", ZLIB, ZDICT):
+    COMPRESSION = ZDICT
+COMPRESS_MIN = int(os.environ.get("LUCIA_COMPRESS_MIN", str(COMPRESS_THRESHOLD)))
+COMPRESS_LEVEL = min(9, max(1, int(os.environ.get("LUCIA_COMPRESS_LEVEL", str(DEFAULT_COMPRESS_LEVEL)))))
+
+# /search results per page by default and at most
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+# /list names per page by default and at most
+LIST_PAGE_SIZE = 100
+LIST_MAX_PAGE_SIZE = 1000
 
-# We use a set here so we don't have to worry about duplicate usernames
-knownUsers = set()
-# dict to map connected usernames to their conn object
-connectedUsers = {}
-# lock to synchronize access to user lists
-user_lock = threading.Lock()
+# History paging: /open shows this many recent messages by default, no request may
+# ask for more than OPEN_MAX_LIMIT, and history goes out HISTORY_PAGE_SIZE messages per line
+OPEN_DEFAULT_LIMIT = 50
+OPEN_MAX_LIMIT = 1000
+HISTORY_PAGE_SIZE = 100
+
+# Catch-up after login: at most this many of the newest unread messages per contact,
+# and this many in total; older unread messages are left for /open
+CATCHUP_PER_CONTACT = 20
+CATCHUP_MAX_MESSAGES = 500
+# Live delivery catches up on at most this many messages a recipient missed earlier
+LIVE_BACKLOG_LIMIT = 20
+
+# Group names: # and then up to 32 letters, digits, _ or -
+GROUP_NAME = re.compile(r"#[A-Za-z0-9_-]{1,32}$")
+# Groups with more members than this fan out on GROUP_FANOUT's thread instead of the
+# sender's, so a huge group doesn't hold up the sender's reply
+GROUP_INLINE_FANOUT = 32
+GROUP_FANOUT = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lucia-fanout")
+
+# How many pending connections the kernel queues for us
+LISTEN_BACKLOG = 1024
+
+# Where to keep users and messages on disk (env var LUCIA_DATA_DIR).
+# Unset means everything lives in memory and is gone on restart.
+DATA_DIR = os.environ.get("LUCIA_DATA_DIR")
+# How often buffered writes get fsynced to the data dir, in seconds
+FSYNC_INTERVAL = float(os.environ.get("LUCIA_FSYNC_INTERVAL", str(DEFAULT_FSYNC_INTERVAL)))
+if DATA_DIR and (WORKERS > 1 or HUB_PATH):
+    # Every worker would append to the same log files
+    print_error("Multi-process mode keeps everything in memory; unset LUCIA_DATA_DIR or use one worker")
+    sys.exit(1)
+# Started by a hot restart: wait here, before opening the data dir, for the old process
+# to stop its clients and hand them over with the listening socket and the message store
+RESTART_FD = hotrestart.restart_fd()
+handoff = hotrestart.receive(RESTART_FD) if RESTART_FD is not None else None
+storage = LogBackend(DATA_DIR, fsync_interval=FSYNC_INTERVAL) if DATA_DIR else None
+
+# Known users and the outbound writer of everyone connected.
+# Lock-striped, and never holds a lock across network I/O.
+# In a worker process, names and presence live at the hub instead.
+bus = ClusterBus(HUB_PATH, WORKER_ID) if HUB_PATH else None
+users = ClusterRegistry(bus) if bus else UserRegistry()
+if storage:
+    for name in storage.load_users():
+        users.register(name)
+if handoff:
+    for name in handoff.state["users"]:
+        users.register(name)
+# Memory bounds for the message store (unset means unlimited):
+#   LUCIA_MAX_MESSAGES   keep only the newest N messages of each conversation
+#   LUCIA_MAX_AGE        drop messages older than this many seconds
+#   LUCIA_MEMORY_BUDGET  bytes of history to hold in RAM before evicting idle conversations
+#   LUCIA_EVICTION       without a data dir, "spill" evicted history to LUCIA_SPILL_DIR or "drop" it
+def _env_number(name, kind):
+    value = os.environ.get(name)
+    return kind(value) if value else None
+
+MAX_MESSAGES = _env_number("LUCIA_MAX_MESSAGES", int)
+MAX_AGE = _env_number("LUCIA_MAX_AGE", float)
+MEMORY_BUDGET = _env_number("LUCIA_MEMORY_BUDGET", int)
+EVICTION = os.environ.get("LUCIA_EVICTION", SPILL_EVICTION).lower()
+if EVICTION not in (SPILL_EVICTION, DROP_EVICTION):
+    EVICTION = SPILL_EVICTION
+SPILL_DIR = os.environ.get("LUCIA_SPILL_DIR")
+# /search indexes message bodies, so it only makes sense while they're stored in plaintext:
+# LUCIA_SEARCH=0 turns it off, and LUCIA_SEARCH_MEMORY bounds the index in bytes
+SEARCH_ENABLED = os.environ.get("LUCIA_SEARCH", "1") != "0"
+SEARCH_MEMORY = _env_number("LUCIA_SEARCH_MEMORY", int) or DEFAULT_SEARCH_MEMORY
 # Message store for conversations
-message_store = MessageStore()
+message_store = MessageStore(backend=storage, max_messages=MAX_MESSAGES, max_age=MAX_AGE,
+                             memory_budget=MEMORY_BUDGET, eviction=EVICTION, spill_dir=SPILL_DIR,
+                             search=SearchIndex(SEARCH_MEMORY) if SEARCH_ENABLED else None)
+if handoff:
+    message_store.load_snapshot(handoff.state["store"])
+
+# Logins and logouts pushed to /presence subscribers, batched over LUCIA_PRESENCE_WINDOW seconds
+PRESENCE_WINDOW = float(os.environ.get("LUCIA_PRESENCE_WINDOW", str(DEFAULT_WINDOW)))
+presence = PresenceHub(message_store.get_user_contacts, PRESENCE_WINDOW)
 
-# Hardcoded password (temporary)
+# Rate limits as "rate/burst" in requests per second (or just "rate", for a burst of twice
+# that), for chat messages, commands, and the expensive commands (/open, /contacts, /list):
+# per user via LUCIA_USER_RATE_MESSAGES, LUCIA_USER_RATE_COMMANDS and LUCIA_USER_RATE_EXPENSIVE,
+# and per client IP via the same LUCIA_IP_RATE_* variables, which are off unless set.
+# "0" turns one off and LUCIA_RATE_LIMITS=0 all of them. A client over a limit isn't cut
+# off; we stop reading from it until it's back under (see ratelimit.py).
+RATE_LIMITS = os.environ.get("LUCIA_RATE_LIMITS", "1") != "0"
+# (ratelimit's categories are used by module, since protocol has a MESSAGE and COMMAND too)
+USER_RATE_DEFAULTS = {ratelimit.MESSAGE: "50/200", ratelimit.COMMAND: "20/50", ratelimit.EXPENSIVE: "5/20"}
+RATE_ENV_NAMES = {ratelimit.MESSAGE: "MESSAGES", ratelimit.COMMAND: "COMMANDS", ratelimit.EXPENSIVE: "EXPENSIVE"}
+def _rate_limiter(scope, defaults):
+    if not RATE_LIMITS:
+        return RateLimiter({})
+    return RateLimiter({category: parse_limit(os.environ.get(f"LUCIA_{scope}_RATE_{RATE_ENV_NAMES[category]}",
+                                                             defaults.get(category)))
+                        for category in ratelimit.CATEGORIES})
+
+user_limits = _rate_limiter("USER", USER_RATE_DEFAULTS)
+ip_limits = _rate_limiter("IP", {})
+
+# Admission control: at most LUCIA_MAX_CONNECTIONS open connections (0 = no cap but the
+# file descriptor limit) and LUCIA_MAX_HANDSHAKES of them still logging in. Connections
+# past either cap get an error and are closed as soon as they're accepted. Logging in
+# has to finish within LUCIA_HANDSHAKE_TIMEOUT seconds, so idle connections can't sit
+# on the handshake slots.
+MAX_CONNECTIONS = int(os.environ.get("LUCIA_MAX_CONNECTIONS", "0")) or None
+MAX_HANDSHAKES = int(os.environ.get("LUCIA_MAX_HANDSHAKES", "1024")) or None
+HANDSHAKE_TIMEOUT = float(os.environ.get("LUCIA_HANDSHAKE_TIMEOUT", "60")) or None
+admission = Admission(MAX_CONNECTIONS, MAX_HANDSHAKES)
+SERVER_BUSY = TextCodec().error("Server busy, try again later.")
+
+# Usernames allowed to run /stats (env var LUCIA_ADMINS, comma separated)
+ADMINS = {name.strip() for name in os.environ.get("LUCIA_ADMINS", "").split(",") if name.strip()}
+# Serve metrics as Prometheus text on this loopback port (env var LUCIA_METRICS_PORT, unset = off)
+METRICS_PORT = _env_number("LUCIA_METRICS_PORT", int)
+
+# Metrics recorded on the hot paths; see metrics.py
+BYTES_IN = REGISTRY.counter("lucia_bytes_in_total", "Bytes read from client sockets")
+MESSAGES_ROUTED = REGISTRY.counter("lucia_messages_routed_total", "Chat messages accepted and stored")
+MESSAGES_DELIVERED = REGISTRY.counter("lucia_messages_delivered_total",
+                                      "Messages queued straight to a connected recipient")
+MESSAGES_OFFLINE = REGISTRY.counter("lucia_messages_offline_total",
+                                    "Messages left for a recipient who wasn't connected")
+DELIVERY_FAILURES = REGISTRY.counter("lucia_delivery_failures_total",
+                                     "Live deliveries refused by a recipient's outbound queue")
+GROUP_FANOUT_LATENCY = REGISTRY.histogram("lucia_group_fanout_seconds",
+                                          "Time spent queueing a group message for every online member")
+CONNECTIONS_ACCEPTED = REGISTRY.counter("lucia_connections_accepted_total", "Client connections accepted")
+CONNECTIONS_OPEN = REGISTRY.gauge("lucia_connections_open", "Client connections currently open")
+LOGINS = {result: REGISTRY.counter("lucia_logins_total", "Handshakes by outcome", result=result)
+          for result in ("registered", "authenticated", "token", "bad_password", "already_connected", "busy")}
+TLS_HANDSHAKES = {result: REGISTRY.counter("lucia_tls_handshakes_total", "TLS handshakes by outcome", result=result)
+                  for result in ("full", "resumed", "failed")}
+PASSWORD_CHECK_LATENCY = REGISTRY.histogram("lucia_password_check_seconds",
+                                            "Time from submitting a password check to its result, queueing included")
+COMMANDS = ("/list", "/presence", "/contacts", "/new", "/open", "/history", "/delete", "/group", "/search",
+            "/password", "/token", "/help", "/stats", "other")
+COMMAND_LATENCY = {cmd: REGISTRY.histogram("lucia_command_seconds", "Time spent handling a command", command=cmd)
+                   for cmd in COMMANDS}
+
+_store_stats = [0.0, None]
+def store_stat(name):
+    """One of message_store.memory_stats(), recomputed at most once a second since it walks the store."""
+    now = time.monotonic()
+    if _store_stats[1] is None or now - _store_stats[0] > 1.0:
+        _store_stats[:] = [now, message_store.memory_stats()]
+    return _store_stats[1][name] or 0
+
+REGISTRY.callback("lucia_uptime_seconds", "Seconds since the server started", lambda: time.time() - REGISTRY.started)
+REGISTRY.callback("lucia_users_connected", "Users logged in right now", lambda: len(users.connected_users()))
+REGISTRY.callback("lucia_users_known", "Registered users", lambda: len(users.known_users()))
+REGISTRY.callback("lucia_outbound_queued_bytes", "Bytes waiting in every outbound queue",
+                  lambda: sum(writer.queued_bytes for writer in users.connected_writers()))
+REGISTRY.callback("lucia_store_conversations", "Conversations in the message store",
+                  lambda: len(message_store.conversations))
+REGISTRY.callback("lucia_store_messages", "Messages held by the message store", lambda: store_stat("messages"))
+REGISTRY.callback("lucia_store_memory_bytes", "Rough bytes of history held in memory",
+                  lambda: store_stat("memory_estimate"))
+REGISTRY.callback("lucia_store_loaded_conversations", "Conversations with their history in memory",
+                  lambda: store_stat("loaded"))
+if message_store.search is not None:
+    REGISTRY.callback("lucia_search_memory_bytes", "Rough bytes held by the search index",
+                      lambda: message_store.search.memory)
+    REGISTRY.callback("lucia_search_indexed_total", "Messages added to the search index",
+                      lambda: message_store.search.indexed, kind="counter")
+for _scope, _limiter in (("user", user_limits), ("ip", ip_limits)):
+    for _category in _limiter.limits:
+        REGISTRY.callback("lucia_rate_limited_total", "Requests held back by a rate limit",
+                          lambda limiter=_limiter, category=_category: limiter.limited[category],
+                          kind="counter", scope=_scope, category=_category)
+for _reason in admission.rejected:
+    REGISTRY.callback("lucia_connections_rejected_total", "Connections turned away by admission control",
+                      lambda reason=_reason: admission.rejected[reason], kind="counter", reason=_reason)
+REGISTRY.callback("lucia_handshakes_open", "Connections still logging in", lambda: admission.handshakes)
+REGISTRY.callback("lucia_presence_subscribers", "Clients subscribed to presence", presence.subscribers)
+REGISTRY.callback("lucia_presence_batches_total", "Batches of presence changes fanned out",
+                  lambda: presence.batches, kind="counter")
+REGISTRY.callback("lucia_presence_deliveries_total", "Presence frames queued for subscribers",
+                  lambda: presence.deliveries, kind="counter")
+for _name in ("evictions", "reloads", "trimmed"):
+    REGISTRY.callback(f"lucia_store_{_name}_total", f"Message store {_name} (see MessageStore.memory_stats)",
+                      lambda name=_name: store_stat(name), kind="counter")
+
+def command_latency(name):
+    """The latency histogram for a command name like "/open"."""
+    return COMMAND_LATENCY.get(name.lower(), COMMAND_LATENCY["other"])
+
+def format_stats():
+    """Human readable summary of the metrics, for /stats."""
+    lines = [
+        "=== Server stats ===",
+        f"Uptime: {int(time.time() - REGISTRY.started)}s",
+        f"Connections: {int(CONNECTIONS_OPEN.value())} open, {int(CONNECTIONS_ACCEPTED.value())} accepted, "
+        f"{len(users.connected_users())} users online of {len(users.known_users())}, "
+        f"{admission.handshakes} logging in, "
+        f"turned away: " + ", ".join(f"{reason} {count}" for reason, count in admission.rejected.items()),
+        "Logins: " + ", ".join(f"{result} {int(counter.value())}" for result, counter in LOGINS.items()),
+        f"Presence: {presence.subscribers()} subscribers, {presence.batches} batches, "
+        f"{presence.deliveries} frames queued",
+        f"Password checks: {credentials.queued} queued, {credentials.rejected} turned away, "
+        f"p50 <= {(PASSWORD_CHECK_LATENCY.quantile(0.5) or 0) * 1000:g} ms",
+        f"Traffic: {int(BYTES_IN.value())} bytes in, {int(BYTES_OUT.value())} bytes out, "
+        f"{sum(w.queued_bytes for w in users.connected_writers())} bytes queued",
+        f"Messages: {int(MESSAGES_ROUTED.value())} routed, {int(MESSAGES_DELIVERED.value())} delivered live, "
+        f"{int(MESSAGES_OFFLINE.value())} left for offline users, {int(DELIVERY_FAILURES.value())} delivery failures",
+        f"Store: {store_stat('conversations')} conversations, {store_stat('messages')} messages, "
+        f"~{store_stat('memory_estimate') // 1024} KiB in memory, {store_stat('evictions')} evictions, "
+        f"{store_stat('reloads')} reloads",
+    ]
+    limited = [f"{scope} {category} {limiter.limited[category]}"
+               for scope, limiter in (("user", user_limits), ("ip", ip_limits)) for category in limiter.limits]
+    if limited:
+        lines.append("Rate limited: " + ", ".join(limited))
+    if message_store.search is not None:
+        search = message_store.search.stats()
+        lines.append(f"Search: {search['indexed']} messages indexed, {search['skipped']} encrypted skipped, "
+                     f"~{search['memory'] // 1024} KiB in {search['blocks']} blocks, "
+                     f"{search['dropped_blocks']} blocks dropped")
+    for cmd, histogram in COMMAND_LATENCY.items():
+        counts, total = histogram.snapshot()
+        calls = sum(counts)
+        if calls:
+            lines.append(f"  {cmd:<9} {calls} calls, mean {total / calls * 1000:.2f} ms, "
+                         f"p50 <= {histogram.quantile(0.5) * 1000:g} ms, p99 <= {histogram.quantile(0.99) * 1000:g} ms")
+    lines.append("=== End of stats ===")
+    return lines
+
+# Password of users who haven't set their own with /password
 SECRET_PASSWORD = "a"
+
+# Password records are made with LUCIA_KDF (scrypt, or pbkdf2) and checked on
+# LUCIA_KDF_WORKERS threads; once LUCIA_KDF_QUEUE checks are waiting, further logins
+# are told the server is busy. Session tokens last LUCIA_TOKEN_TTL seconds and are
+# signed with LUCIA_TOKEN_KEY (hex). Without a key a random one is made at startup, so
+# tokens don't outlive the process; the supervisor gives all its workers the same one.
+KDF = os.environ.get("LUCIA_KDF", DEFAULT_KDF).lower()
+if KDF not in KDFS:
+    KDF = DEFAULT_KDF
+KDF_WORKERS = int(os.environ.get("LUCIA_KDF_WORKERS", str(max(1, (os.cpu_count() or 1) // 2))))
+KDF_QUEUE = int(os.environ.get("LUCIA_KDF_QUEUE", str(DEFAULT_MAX_QUEUE)))
+TOKEN_TTL = float(os.environ.get("LUCIA_TOKEN_TTL", str(DEFAULT_TOKEN_TTL)))
+TOKEN_KEY = os.environ.get("LUCIA_TOKEN_KEY")
+credentials = Credentials(SECRET_PASSWORD, bytes.fromhex(TOKEN_KEY) if TOKEN_KEY else None, KDF,
+                          KDF_WORKERS, KDF_QUEUE, TOKEN_TTL)
+if storage:
+    for _name, _record in storage.load_credentials().items():
+        credentials.set_record(_name, _record)
+if handoff:
+    for _name, _record in handoff.state["credentials"].items():
+        credentials.set_record(_name, _record)
+REGISTRY.callback("lucia_password_checks_queued", "Password checks waiting for or running on the KDF pool",
+                  lambda: credentials.queued)
 # At some point when I stop being lazy, this will be a randomly generated string that will be encrypted 
 
-def recv_line(conn):
-    # Reads a single line (up to a \n) from a socket.
-    # Returns the line without the \n.
-    message = b""
-    while True:
-        chunk = conn.recv(1)  # Read one byte at a time, this is used to solve some errors I was having
-        if not chunk:
-            # Client disconnected
-            return None
-        if chunk == b'\n':
-            # End of the line
-            return message
-        message += chunk
-
-def handle_command(username, command, conn):
-    """Handle special commands from the client."""
+def parse_history_args(args, default_limit):
+    """Parse the optional "[limit] [before=N] [since=N]" arguments of /open and /history."""
+    limit = default_limit
+    cursors = {}
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        try:
+            if sep and name.lower() in ("before", "since"):
+                cursors[name.lower()] = int(value)
+            else:
+                limit = int(arg)
+        except ValueError:
+            raise ValueError(f"Invalid argument '{arg}'")
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+    return min(limit, OPEN_MAX_LIMIT), cursors
+
+def send_history(writer, recipient, conversation, start, end, limit, older=None, newer=None):
+    """
+    Stream messages [start, end) of a conversation in bounded pages.
+    Each message carries its sequence number so clients can page; older and newer
+    are the before= and since= cursors for the pages on either side, if any.
+    """
+    total = conversation.next_seq()
+    codec = writer.codec
+    page_starts = range(start, end, HISTORY_PAGE_SIZE) or [start]
+    for page_start in page_starts:
+        page_end = min(end, page_start + HISTORY_PAGE_SIZE)
+        messages = conversation.get_messages(page_start, page_end) if page_end > page_start else []
+        # Ship each page as it's built; the writer keeps the client from falling too far behind
+        writer.send(codec.history_page(recipient, messages, start, end, total, limit, older, newer,
+                                       first=page_start == start, last=page_end >= end))
+
+def parse_time_arg(value, end=False):
+    """A unix timestamp or an ISO date/time for /search from= and to=; a bare date's end is the next midnight."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    moment = datetime.fromisoformat(value)
+    if end and len(value) <= 10:
+        moment += timedelta(days=1)
+    return moment.timestamp()
+
+def parse_search_args(args):
+    """Split "/search" arguments into (terms, since, until, page, page size)."""
+    words = []
+    since = until = None
+    page, page_size = 1, SEARCH_PAGE_SIZE
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        name = name.lower()
+        if not sep or name not in ("from", "to", "page", "limit"):
+            words.append(arg)
+            continue
+        try:
+            if name == "from":
+                since = parse_time_arg(value)
+            elif name == "to":
+                until = parse_time_arg(value, end=True)
+            elif name == "page":
+                page = int(value)
+            else:
+                page_size = int(value)
+        except ValueError:
+            raise ValueError(f"Invalid argument '{arg}'")
+    if page < 1 or page_size < 1:
+        raise ValueError("page and limit must be at least 1")
+    return words, since, until, page, min(page_size, SEARCH_MAX_PAGE_SIZE)
+
+def handle_search(username, parts, writer):
+    """/search <username|#group|*> <terms> [from=] [to=] [page=] [limit=]"""
+    codec = writer.codec
+    if message_store.search is None:
+        writer.send(codec.error("Search is turned off on this server."))
+        return
+    if len(parts) < 3:
+        writer.send(codec.error("Usage: /search <username|#group|*> <terms> [from=<date>] [to=<date>] [page=N]"))
+        return
+    target = parts[1]
+    words, since, until, page, page_size = parse_search_args(parts[2:])
+    query = parse_query(words)
+    # One more than the page, to know whether there's another after it
+    wanted = page * page_size + 1
+    results = message_store.search_messages(username, None if target == "*" else target, query, wanted,
+                                            since, until)
+    shown = results[(page - 1) * page_size:page * page_size]
+    next_page = None
+    if len(results) == wanted:
+        args = [arg for arg in parts[2:] if not arg.lower().startswith("page=")]
+        next_page = " ".join(["/search", target] + args + [f"page={page + 1}"])
+    writer.send(codec.search_results(" ".join(words), page, shown, next_page))
+
+def parse_list_args(args):
+    """Split "/list" arguments into (name prefix, page, page size)."""
+    prefix = ""
+    page, page_size = 1, LIST_PAGE_SIZE
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        name = name.lower()
+        if not sep or name not in ("page", "limit"):
+            prefix = arg
+            continue
+        try:
+            if name == "page":
+                page = int(value)
+            else:
+                page_size = int(value)
+        except ValueError:
+            raise ValueError(f"Invalid argument '{arg}'")
+    if page < 1 or page_size < 1:
+        raise ValueError("page and limit must be at least 1")
+    return prefix, page, min(page_size, LIST_MAX_PAGE_SIZE)
+
+def handle_list(parts, writer):
+    """/list [prefix] [page=N] [limit=N]: one page of the connected users, in name order."""
+    codec = writer.codec
+    prefix, page, page_size = parse_list_args(parts[1:])
+    online = users.connected_users()
+    if prefix:
+        online = [name for name in online if name.startswith(prefix)]
+    online.sort()
+    writer.send(codec.users(online[(page - 1) * page_size:page * page_size]))
+    if len(online) > page * page_size:
+        args = [arg for arg in parts[1:] if not arg.lower().startswith("page=")]
+        writer.send(codec.info(f"({len(online)} {'matching' if prefix else 'online'}; next page: {' '.join(['/list'] + args + [f'page={page + 1}'])})"))
+
+def presence_scope_name(scope):
+    return "your contacts" if scope == PRESENCE_CONTACTS else "everyone"
+
+def handle_presence(username, parts, writer):
+    """/presence subscribe [contacts|all], /presence unsubscribe, or /presence for the current subscription"""
+    codec = writer.codec
+    action = parts[1].lower() if len(parts) > 1 else ""
+    if action == "subscribe":
+        scope = parts[2].lower() if len(parts) > 2 else PRESENCE_CONTACTS
+        if scope not in PRESENCE_SCOPES:
+            writer.send(codec.error("Usage: /presence subscribe [contacts|all]"))
+            return
+        presence.subscribe(username, writer, scope)
+        # Who's online right now, then only the changes
+        if scope == PRESENCE_CONTACTS:
+            online = [contact for contact in message_store.get_user_contacts(username) if users.is_connected(contact)]
+        else:
+            online = sorted(users.connected_users())
+        writer.send(codec.info(f"Subscribed to presence of {presence_scope_name(scope)}."))
+        if online:
+            writer.send(codec.presence([(name, True) for name in online]))
+    elif action == "unsubscribe":
+        presence.unsubscribe(username, writer)
+        writer.send(codec.info("Unsubscribed from presence."))
+    elif not action:
+        scope = presence.scope(username)
+        writer.send(codec.info(f"Subscribed to presence of {presence_scope_name(scope)}." if scope
+                               else "Not subscribed to presence."))
+    else:
+        writer.send(codec.error("Usage: /presence subscribe [contacts|all] | /presence unsubscribe"))
+
+def handle_command(username, parts, writer):
+    """
+    Handle special commands from the client. parts is the command split into words,
+    e.g. ["/open", "bob", "50"]; replies go out in the client's protocol via writer.codec.
+    In a worker, may return a callable that sends the reply once the bus has synced.
+    """
+    codec = writer.codec
     try:
-        parts = command.split()
         cmd = parts[0].lower()
         
         if cmd == "/list":
-            # List all connected users
-            with user_lock:
-                user_list = ", ".join(connectedUsers.keys())
-            conn.sendall(f"Connected users: {user_list}\n".encode())
+            handle_list(parts, writer)
+        
+        elif cmd == "/presence":
+            handle_presence(username, parts, writer)
         
         elif cmd == "/contacts":
             # List all contacts (users with conversations)
-            contacts = message_store.get_user_contacts(username)
-            if contacts:
-                contact_list = ", ".join(contacts)
-                conn.sendall(f"Your contacts: {contact_list}\n".encode())
+            if len(parts) > 1 and parts[1].lower() == "recent":
+                # Most recently active first, with the time of the last message
+                writer.send(codec.contacts(message_store.get_user_contact_activity(username), with_times=True))
             else:
-                conn.sendall(b"You have no contacts yet.\n")
+                contacts = message_store.get_user_contacts(username)
+                writer.send(codec.contacts([(contact, None) for contact in contacts], with_times=False))
         
         elif cmd == "/new":
             # Start a new conversation with another user
             if len(parts) < 2:
-                conn.sendall(b"ERROR: Usage: /new <username>\n")
+                writer.send(codec.error("Usage: /new <username>"))
                 return
             
             recipient = parts[1]
-            with user_lock:
-                if recipient not in knownUsers:
-                    conn.sendall(f"ERROR: User '{recipient}' not found.\n".encode())
-                    return
+            if recipient.startswith(GROUP_PREFIX):
+                writer.send(codec.error(f"Use /group create {recipient} to start a group."))
+                return
+            if not users.is_known(recipient):
+                writer.send(codec.error(f"User '{recipient}' not found."))
+                return
             
-            conversation = message_store.get_or_create_conversation(username, recipient)
-            conn.sendall(f"Started new conversation with {recipient}.\n".encode())
+            if bus:
+                bus.publish("new", username, recipient)
+            else:
+                message_store.get_or_create_conversation(username, recipient)
+            writer.send(codec.info(f"Started new conversation with {recipient}."))
             print_info(f"New conversation between {username} and {recipient}")
         
         elif cmd == "/open":
-            # Open and display a conversation with another user
+            # Open and display the most recent page of a conversation
             if len(parts) < 2:
-                conn.sendall(b"ERROR: Usage: /open <username>\n")
+                writer.send(codec.error("Usage: /open <username> [limit] [before=<cursor>]"))
                 return
             
             recipient = parts[1]
+            limit, cursors = parse_history_args(parts[2:], OPEN_DEFAULT_LIMIT)
             conversation = message_store.get_conversation(username, recipient)
             
-            if not conversation:
-                conn.sendall(f"No conversation found with {recipient}.\n".encode())
+            if not conversation or not conversation.is_member(username):
+                writer.send(codec.info(f"No conversation found with {recipient}."))
                 return
             
-            # Build conversation display as a single message with embedded newlines
-            lines = [f"=== Conversation with {recipient} ==="]
+            # Messages with seq < before, newest `limit` of them.
+            # Retention may have dropped everything below first_seq().
+            first = conversation.first_seq()
+            end = conversation.next_seq()
+            if "before" in cursors:
+                end = max(first, min(end, cursors["before"]))
+            start = max(first, end - limit)
+            older = start if start > first else None
+            send_history(writer, recipient, conversation, start, end, limit, older=older)
+        
+        elif cmd == "/history":
+            # Fetch only the messages after a cursor, oldest first
+            if len(parts) < 3:
+                writer.send(codec.error("Usage: /history <username> since=<cursor> [limit]"))
+                return
             
-            messages = conversation.get_messages()
-            if not messages:
-                lines.append("(No messages yet)")
-            else:
-                for msg in messages:
-                    lines.append(str(msg))
+            recipient = parts[1]
+            limit, cursors = parse_history_args(parts[2:], OPEN_MAX_LIMIT)
+            if "since" not in cursors:
+                writer.send(codec.error("Usage: /history <username> since=<cursor> [limit]"))
+                return
+            conversation = message_store.get_conversation(username, recipient)
             
-            lines.append("=== End of conversation ===")
+            if not conversation or not conversation.is_member(username):
+                writer.send(codec.info(f"No conversation found with {recipient}."))
+                return
             
-            # Send as a single message (with newlines represented as ||| to avoid protocol issues)
-            response = "|||".join(lines)
-            conn.sendall(response.encode() + b"\n")
+            # Messages with seq > since, oldest `limit` of them
+            start = max(conversation.first_seq(), cursors["since"] + 1)
+            end = min(conversation.next_seq(), start + limit)
+            newer = end - 1 if end < conversation.next_seq() else None
+            send_history(writer, recipient, conversation, start, end, limit, newer=newer)
         
         elif cmd == "/delete":
             # Delete a conversation/contact
             if len(parts) < 2:
-                conn.sendall(b"ERROR: Usage: /delete <username>\n")
+                writer.send(codec.error("Usage: /delete <username>"))
                 return
             
             recipient = parts[1]
-            if message_store.delete_conversation(username, recipient):
-                conn.sendall(f"Deleted conversation with {recipient}.\n".encode())
+            if recipient.startswith(GROUP_PREFIX):
+                # Deleting a group would take it away from everyone else too
+                handle_group(username, ["/group", "leave", recipient], writer)
+                return
+            if bus and message_store.get_conversation(username, recipient):
+                bus.publish("delete", username, recipient)
+                deleted = True
+            else:
+                deleted = message_store.delete_conversation(username, recipient)
+            if deleted:
+                writer.send(codec.info(f"Deleted conversation with {recipient}."))
                 print_info(f"Conversation between {username} and {recipient} deleted")
             else:
-                conn.sendall(f"No conversation found with {recipient}.\n".encode())
+                writer.send(codec.info(f"No conversation found with {recipient}."))
+        
+        elif cmd == "/group":
+            return handle_group(username, parts, writer)
+        
+        elif cmd == "/search":
+            handle_search(username, parts, writer)
+        
+        elif cmd == "/token":
+            # A fresh session token, to log back in with instead of the password
+            writer.send(codec.session_token(*credentials.issue_token(username)))
+        
+        elif cmd == "/stats":
+            # Metrics summary, for admins only
+            if username not in ADMINS:
+                writer.send(codec.error("/stats is only available to admins."))
+                return
+            writer.send(codec.lines(format_stats()))
         
         elif cmd == "/help":
             # Display available commands
-            # Use ||| as delimiter to safely send multi-line text
             help_lines = [
                 "Available commands:",
-                "  /list              - List connected users",
+                "  /list [prefix] [page=N]",
+                "                     - List connected users, optionally only names starting with prefix",
+                "  /presence subscribe [contacts|all]",
+                "                     - Get told when your contacts (or anyone) come online or leave",
+                "  /presence unsubscribe",
+                "                     - Stop presence updates",
                 "  /contacts          - List your contacts (users with conversations)",
+                "  /contacts recent   - List your contacts, most recently active first",
                 "  /new <username>    - Start a new conversation",
-                "  /open <username>   - View conversation history with a user",
+                "  /open <username> [limit] [before=<cursor>]",
+                "                     - View recent conversation history with a user",
+                "  /history <username> since=<cursor> [limit]",
+                "                     - View only messages newer than a cursor",
                 "  /delete <username> - Delete a conversation",
+                "  /group create #<name> [usernames]",
+                "                     - Start a group conversation",
+                "  /group add #<name> <usernames>",
+                "                     - Add people to a group you're in",
+                "  /group leave #<name>",
+                "                     - Leave a group",
+                "  /search <username|#group|*> <terms> [from=<date>] [to=<date>] [page=N]",
+                "                     - Find messages; end a term with * to match its prefix",
+                "  /password <new>    - Set your own password",
+                "  /token             - Get a session token to log back in with instead of your password",
                 "  /help              - Display this help message",
+                "  /stats             - Server statistics (admins only)",
                 "",
-                "To send a message: recipient: your message"
+                "To send a message: recipient: your message",
+                "To send to a group: #group: your message"
             ]
-            help_text = "|||".join(help_lines)
-            conn.sendall(help_text.encode() + b"\n")
+            writer.send(codec.lines(help_lines))
         
         else:
-            conn.sendall(f"ERROR: Unknown command '{cmd}'. Type /help for available commands.\n".encode())
+            writer.send(codec.error(f"Unknown command '{cmd}'. Type /help for available commands."))
     
     except Exception as e:
-        print_error(f"Error handling command '{command}' for {username}: {e}")
+        print_error(f"Error handling command '{' '.join(parts)}' for {username}: {e}")
         try:
-            conn.sendall(f"ERROR: {str(e)}\n".encode())
+            writer.send(codec.error(str(e)))
         except:
             pass
 
-def handle_client(conn, addr):
-    # Handle a single client connection in its own thread.
-    username = None # Define username
-    authenticated = False # Flag to track if user was added to lists
+def handle_group(username, parts, writer):
+    """/group create|add|leave #name [usernames]; see handle_command() for what it returns."""
+    codec = writer.codec
+    usage = "Usage: /group create|add|leave #<name> [usernames]"
+    if len(parts) < 3 or parts[1].lower() not in ("create", "add", "leave"):
+        writer.send(codec.error(usage))
+        return
+    action, name, names = parts[1].lower(), parts[2], parts[3:]
+    if not GROUP_NAME.match(name):
+        writer.send(codec.error("Group names are # followed by up to 32 letters, digits, _ or -."))
+        return
+    for other in names:
+        if not users.is_known(other):
+            writer.send(codec.error(f"User '{other}' not found."))
+            return
+    group = message_store.get_group(name)
     
-    try:
-        # Read the username
-        username_bytes = recv_line(conn)
-        if not username_bytes:
-            print_warning(f"Connection from {addr} closed before sending username")
+    if action == "create":
+        if group is not None:
+            writer.send(codec.error(f"{name} already exists."))
             return
+        if bus:
+            bus.publish("group_create", name, username, *names)
+            # Someone on another worker may have created it first
+            return partial(report_group_created, username, name, len(names), writer)
+        report_group_created(username, name, len(names), writer,
+                             message_store.create_group(name, username, names) is not None)
+        return
+    
+    if group is None or not group.is_member(username):
+        writer.send(codec.error(f"You are not in a group called {name}."))
+        return
+    if action == "add":
+        if not names:
+            writer.send(codec.error(usage))
+            return
+        if bus:
+            added = [other for other in names if not group.is_member(other)]
+            # Their next command waits for it (see ClientSession._command)
+            bus.publish("group_add", name, *added)
+        else:
+            added = message_store.add_group_members(name, names)
+        writer.send(codec.info(f"Added {', '.join(added)} to {name}." if added else "Everyone is already in it."))
+    else:
+        if bus:
+            bus.publish("group_leave", name, username)
+        else:
+            message_store.leave_group(name, username)
+        writer.send(codec.info(f"You left {name}."))
+
+def report_group_created(username, name, invited, writer, created=None) -> bool:
+    """Tell username whether /group create made name; in a worker, once the hub has ordered it."""
+    if created is None:
+        group = message_store.get_group(name)
+        created = group is not None and group.creator == username
+    if created:
+        writer.send(writer.codec.info(f"Created {name}."))
+        print_info(f"{username} created {name} with {invited + 1} member(s)")
+    else:
+        writer.send(writer.codec.error(f"{name} already exists."))
+    return True
+
+def route_message(username, recipient, content, writer):
+    """Route a message from username to recipient."""
+    codec = writer.codec
+    if recipient.startswith(GROUP_PREFIX):
+        route_group_message(username, recipient, content, writer)
+        return
+    # Don't allow sending messages to yourself
+    if recipient == username:
+        writer.send(codec.error("You cannot send messages to yourself."))
+        return
+    
+    # Check if recipient exists
+    known, recipient_writer = users.lookup(recipient)
+    if not known:
+        writer.send(codec.error(f"User '{recipient}' not found."))
+        return
+
+    MESSAGES_ROUTED.inc()
+    if bus:
+        # Every worker stores it once the hub has ordered it; the recipient's worker delivers it
+        bus.publish("message", username, recipient, content, repr(time.time()))
+        if not users.is_connected(recipient):
+            MESSAGES_OFFLINE.inc()
+    else:
+        store_and_deliver(username, recipient, content, recipient_writer)
+
+    # Confirm delivery to sender
+    writer.send(codec.sent(recipient))
+
+def store_and_deliver(username, recipient, content, recipient_writer, timestamp=None):
+    """Store a message and, if the recipient is connected here, queue it on their writer."""
+    message_store.add_message(username, recipient, content, timestamp)
+
+    # If recipient is connected, queue the message on their writer, along with anything
+    # from us they missed while falling behind. This never waits on the recipient's network.
+    # Otherwise it waits in their undelivered queue until they log in.
+    if recipient_writer:
+        def deliver(unread, messages):
+            # Encoded in the recipient's protocol, not the sender's
+            frame = recipient_writer.codec.messages(username, unread, messages)
+            # Ops are applied on the bus thread, not the recipient's event loop
+            if bus:
+                return recipient_writer.deliver_threadsafe(frame)
+            return recipient_writer.deliver(frame)
         
-        username = username_bytes.decode()
-        print_info(f"Connected by {addr} as {username}")
+        if message_store.deliver_pending(recipient, username, deliver, LIVE_BACKLOG_LIMIT):
+            MESSAGES_DELIVERED.inc()
+            if log_enabled(DEBUG):
+                print_received(f"Message from {username} to {recipient}: {content!r}")
+        else:
+            DELIVERY_FAILURES.inc()
+            print_warning(f"{recipient} is falling behind, message from {username} queued for their next login")
+    elif not bus:
+        MESSAGES_OFFLINE.inc()
 
-        with user_lock:
-            if (username in knownUsers):
-                
-                # Check if user is already connected
-                if username in connectedUsers:
-                    print_warning(f"{username} is already connected. Disconnecting new session.")
-                    conn.sendall(b"ERROR: You are already connected elsewhere.\n")
-                    return
-                # Send password prompt
-                conn.sendall(b"Enter password:\n")
-                
-                # Read password response
-                password_bytes = recv_line(conn)
-                if not password_bytes:
-                    print_warning(f"{username} ({addr}) disconnected before sending password")
-                    return
-
-                password = password_bytes.decode()
-
-                # Check password
-                if password != SECRET_PASSWORD:
-                    print_error(f"Incorrect password '{password}' from {username} ({addr}). Disconnecting.")
-                    return # Close connection by exiting thread
-                
+def route_group_message(username, name, content, writer):
+    """Store a message to a group once and send it on to everyone in it who's online."""
+    codec = writer.codec
+    group = message_store.get_group(name)
+    if group is None or not group.is_member(username):
+        writer.send(codec.error(f"You are not in a group called {name}."))
+        return
+    
+    MESSAGES_ROUTED.inc()
+    if bus:
+        bus.publish("group_message", username, name, content, repr(time.time()))
+        writer.send(codec.sent(name))
+        return
+    seq = store_group_message(username, name, content)
+    # Ack before fanning out so the sender hears back first, however big the group
+    writer.send(codec.sent(name))
+    if seq is not None:
+        schedule_fan_out(name, username, seq, False)
 
-                print_success(f"{username} ({addr}) authenticated successfully.")
-                # Add to connected users
-                connectedUsers[username] = conn 
-                authenticated = True # Mark as added to the list
-                conn.sendall(b"Authenticated successfully.\n")
-                
+def store_group_message(username, name, content, timestamp=None):
+    try:
+        return message_store.add_message(username, name, content, timestamp)
+    except ValueError:
+        # They left, or the group went away, since we checked
+        return None
+
+def schedule_fan_out(name, sender, seq, threadsafe):
+    group = message_store.get_group(name)
+    if group is not None and len(group.members) > GROUP_INLINE_FANOUT:
+        GROUP_FANOUT.submit(fan_out_group, name, sender, seq, True)
+    else:
+        fan_out_group(name, sender, seq, threadsafe)
+
+def fan_out_group(name, sender, seq, threadsafe):
+    """
+    Queue group message seq for every member online here. Members who only miss this
+    message all get the same frame, encoded once per codec.frame_key; anyone further behind
+    gets their backlog encoded just for them. Offline members keep their cursor.
+    """
+    with GROUP_FANOUT_LATENCY.time():
+        group = message_store.get_group(name)
+        if group is None:
+            return
+        recipients = []
+        for member in list(group.members):
+            if member != sender:
+                writer = users.get_writer(member)
+                if writer is not None:
+                    recipients.append((member, writer))
+        if not recipients:
+            return
+        newest = group.get_messages(seq, seq + 1)
+        frames = {}
+        
+        def deliver(writer, unread, messages):
+            codec = writer.codec
+            if messages is None:
+                frame = frames.get(codec.frame_key)
+                if frame is None:
+                    frame = frames[codec.frame_key] = codec.group_messages(name, 1, newest)
             else:
-                # New user, add them
-                print_success(f"New user: {username}. Adding to known users.")
-                knownUsers.add(username) 
-                connectedUsers[username] = conn 
-                authenticated = True # Mark as added to the list
-                # At some point, we will have them enter their private key here
-                conn.sendall(f"Welcome, {username}! You are now registered.\n".encode())
+                frame = codec.group_messages(name, unread, messages)
+            return writer.deliver_threadsafe(frame) if threadsafe else writer.deliver(frame)
+        
+        delivered, refused = message_store.deliver_group(name, seq, recipients, deliver, LIVE_BACKLOG_LIMIT)
+    MESSAGES_DELIVERED.inc(delivered)
+    if refused:
+        DELIVERY_FAILURES.inc(refused)
+    if log_enabled(DEBUG):
+        print_received(f"Message from {sender} to {name} ({delivered} member(s) online)")
+
+# Ops replicated through the hub in multi-process mode, applied in the same order on every worker
+def apply_message(username, recipient, content, timestamp):
+    store_and_deliver(username, recipient, content, users.get_writer(recipient), float(timestamp))
+
+def apply_new(username, recipient):
+    message_store.get_or_create_conversation(username, recipient)
+
+def apply_delete(username, recipient):
+    message_store.delete_conversation(username, recipient)
+
+def apply_cursors(origin, username, *pairs):
+    # Our own replica already has them
+    if origin != WORKER_ID:
+        for contact, cursor in zip(pairs[::2], pairs[1::2]):
+            message_store.set_delivery_cursor(username, contact, int(cursor))
+
+def publish_delivery_cursors(username):
+    """At logout, tell the other workers what username has been sent, so a login there doesn't resend it."""
+    pairs = []
+    for contact, cursor in message_store.delivery_cursors(username).items():
+        pairs += [contact, str(cursor)]
+    if pairs:
+        bus.publish("cursors", WORKER_ID, username, *pairs)
+
+def apply_credential(username, record):
+    credentials.set_record(username, record)
+    if storage:
+        storage.set_credential(username, record)
+
+def apply_group_create(name, creator, *members):
+    message_store.create_group(name, creator, list(members))
+
+def apply_group_add(name, *usernames):
+    message_store.add_group_members(name, list(usernames))
+
+def apply_group_leave(name, username):
+    message_store.leave_group(name, username)
+
+def apply_group_message(username, name, content, timestamp):
+    seq = store_group_message(username, name, content, float(timestamp))
+    if seq is not None:
+        # Ops are applied on the bus thread, not the recipients' event loop
+        schedule_fan_out(name, username, seq, True)
+
+CLUSTER_OPS = {
+    "message": apply_message, "new": apply_new, "delete": apply_delete, "cursors": apply_cursors,
+    "group_create": apply_group_create, "group_add": apply_group_add, "group_leave": apply_group_leave,
+    "group_message": apply_group_message, "credential": apply_credential,
+}
+if bus:
+    users.before_release = publish_delivery_cursors
+
+def announce_presence(username, online):
+    """Queue a login or logout for presence subscribers; returns straight away."""
+    # In a worker, the hub's broadcasts report every login, this worker's included (see start_worker)
+    if not bus:
+        presence.changed(username, online)
+
+def send_catch_up(username, writer):
+    """
+    Send everything username missed while offline in one batched write:
+    unread counts per contact and the newest unread messages from each.
+    """
+    claims = message_store.claim_undelivered(username, CATCHUP_PER_CONTACT)
+    if not claims:
+        return
+    total = sum(unread for _, unread, _, _ in claims)
+    entries = []
+    budget = CATCHUP_MAX_MESSAGES
+    for contact, unread, messages, _ in claims:
+        shown = messages[len(messages) - min(len(messages), budget):]
+        budget -= len(shown)
+        older = None
+        if unread > len(shown):
+            before = shown[0].seq if shown else messages[-1].seq + 1
+            older = (min(unread - len(shown), OPEN_MAX_LIMIT), before)
+        entries.append((contact, unread, shown, older))
+    if writer.send(writer.codec.catch_up(total, entries)):
+        print_info(f"Caught {username} up on {total} message(s) from {len(claims)} contact(s)")
+    else:
+        # Connection went away first; keep them for next time
+        message_store.release_undelivered(username, claims)
+
+class ClientSession:
+    """
+    Login and message handling for a single connection.
+    The server engines only read lines and feed them in here, and replies go out
+    through writer.send(), so threaded and asyncio mode share one copy of the logic.
+    """
+
+    def __init__(self, writer, addr):
+        self.writer = writer
+        self.addr = addr
+        # How replies are encoded; a v2 handshake swaps in BinaryCodec.
+        # Kept on the writer too, so other sessions delivering to us use it.
+        self.codec = writer.codec = TextCodec()
+        # Decompresses the client's frames once it has negotiated compression
+        self.inflate = None
+        self.username = None # Define username
+        self.authenticated = False # Flag to track if user was added to lists
+        # What we expect the next line to be: "username", "password" or "message"
+        self.state = "username"
+        # A request held back, as (handler, args), and what the engine should wait for
+        # before calling resume() to handle it: retry_after seconds for a rate limit,
+        # or the pending Future of a password check or hub round trip. The handler
+        # may hold back the next step the same way.
+        self.deferred = None
+        self.retry_after = 0.0
+        self.pending = None
+        self._token_taken = False
+        # Set by the asyncio engine while it waits for the next request, where a hot restart can take over
+        self.idle = False
+
+    @property
+    def binary(self) -> bool:
+        """True once the client has switched to protocol v2; the engine then reads frames."""
+        return self.codec.version >= 2
+
+    def handle_line(self, data: bytes) -> bool:
+        """Process one line from the client. Returns False when the connection should close."""
+        if self.state == "username":
+            options = greeting_options(data, GREETING)
+            if options is not None:
+                # Protocol v2 from here on, starting with a LOGIN frame
+                self._start_binary(options)
+                return True
+            return self._handle_username(data)
+        if self.state == "password":
+            return self._handle_password(data)
+
+        message = data.decode()
+        if message.startswith("/"):
+            category = command_category(message.split(None, 1)[0])
+        else:
+            category = ratelimit.MESSAGE
+        if self._throttled(category, self.handle_line, data):
+            return True
+        
+        # Handle special commands
+        if message.startswith("/"):
+            self._command(message.split())
+        # Regular message - parse format: "recipient: message_content"
+        elif ":" not in message:
+            self.writer.send(self.codec.error("Invalid message format. Use 'recipient: message'"))
+        else:
+            recipient, content = message.split(":", 1)
+            route_message(self.username, recipient.strip(), content.strip(), self.writer)
+        return True
+
+    def _start_binary(self, options):
+        accepted = []
+        deflate = None
+        if ZLIB in options and COMPRESSION != "off":
+            zdict = COMPRESSION == ZDICT and ZDICT in options
+            accepted = [ZLIB, ZDICT] if zdict else [ZLIB]
+            deflate = Deflate(zdict, COMPRESS_MIN, COMPRESS_LEVEL)
+            self.inflate = Inflate(zdict)
+        # The reply to the greeting is the last thing sent uncompressed
+        self.writer.send(b" ".join([GREETING_OK] + [option.encode() for option in accepted]) + b"\n")
+        self.codec = self.writer.codec = BinaryCodec(deflate)
+
+    def handle_frame(self, opcode: int, request_id: int, fields) -> bool:
+        """Process one protocol v2 frame. Returns False when the connection should close."""
+        self.codec.request_id = request_id
+        handler = self.FRAME_HANDLERS.get(opcode)
+        if handler is None:
+            self.writer.send(self.codec.error(f"Unknown opcode {opcode}"))
+            return True
+        state, min_fields, handle = handler
+        if state != self.state or len(fields) < min_fields:
+            self.writer.send(self.codec.error(f"Unexpected opcode {opcode}"))
+            return state != "username"
+        return handle(self, fields)
+
+    def _frame_login(self, fields) -> bool:
+        return self._handle_username(fields[0])
+
+    def _frame_password(self, fields) -> bool:
+        return self._handle_password(fields[0])
 
+    def _frame_send(self, fields) -> bool:
+        if self._throttled(ratelimit.MESSAGE, self._frame_send, fields):
+            return True
+        route_message(self.username, fields[0].decode(), fields[1].decode(), self.writer)
+        return True
 
-        # Main message loop
+    def _frame_command(self, fields) -> bool:
+        if self._throttled(command_category(fields[0].decode()), self._frame_command, fields):
+            return True
+        self._command([field.decode() for field in fields])
+        return True
+
+    # opcode -> (state it's valid in, fields it needs, handler)
+    FRAME_HANDLERS = {
+        LOGIN: ("username", 1, _frame_login),
+        PASSWORD: ("password", 1, _frame_password),
+        SEND: ("message", 2, _frame_send),
+        COMMAND: ("message", 1, _frame_command),
+    }
+
+    def _throttled(self, category, handler, *args) -> bool:
+        """
+        Take a token for a request; if we're over a limit, keep the request for
+        resume() and return True so the caller leaves it for later.
+        """
+        if self._token_taken:
+            # resume() is handling a request that already waited for its token
+            self._token_taken = False
+            return False
+        delay = max(user_limits.take(category, self.username), ip_limits.take(category, self.addr[0]))
+        if not delay:
+            return False
+        self.deferred = (handler, args)
+        self.retry_after = delay
+        return True
+
+    def resume(self) -> bool:
+        """Handle the request held back, once retry_after has passed or pending is done."""
+        handler, args = self.deferred
+        # A request held back by a rate limit has its token already
+        self._token_taken = self.pending is None
+        self.deferred = None
+        self.retry_after = 0.0
+        self.pending = None
+        return handler(*args)
+
+    def _wait_for(self, future, handler, *args):
+        # Have the engine call handler(*args) once future is done
+        self.deferred = (handler, args)
+        self.pending = future
+
+    def _command(self, parts):
+        if parts[0].lower() == "/password":
+            # Needs the KDF pool, so the session handles it rather than handle_command()
+            self._set_password(parts)
+            return
+        if bus:
+            # Let our own earlier messages and /new come back from the hub first,
+            # without holding up everyone else on an asyncio worker
+            synced = bus.sync_future()
+            if not synced.done():
+                self._wait_for(synced, self._run_command, parts)
+                return
+        self._run_command(parts)
+
+    def _run_command(self, parts) -> bool:
+        with command_latency(parts[0]).time():
+            follow_up = handle_command(self.username, parts, self.writer)
+        if follow_up is not None:
+            # The reply needs an op we just published to have come back from the hub
+            self._wait_for(bus.sync_future(), follow_up)
+        return True
+
+    def _handle_username(self, data: bytes) -> bool:
+        if not data:
+            print_warning(f"Connection from {self.addr} closed before sending username")
+            return False
+        
+        username = data.decode()
+        if username.startswith(GROUP_PREFIX) or not username:
+            # Would clash with group names
+            self.writer.send(self.codec.error(f"Usernames can't be empty or start with '{GROUP_PREFIX}'."))
+            return False
+        self.username = username
+        print_info(f"Connected by {self.addr} as {username}")
+
+        # New user: claim the name and connect in one atomic step
+        if bus:
+            # A round trip to the hub; carry on once it answers
+            claimed = users.claim(username, self.writer, True)
+            self._wait_for(claimed, self._username_claimed, claimed)
+            return True
+        return self._username_claimed(users.register_and_connect(username, self.writer))
+
+    def _username_claimed(self, registered) -> bool:
+        username = self.username
+        if isinstance(registered, Future):
+            registered = registered.result()
+        if not registered:
+            # Check if user is already connected
+            if users.is_connected(username):
+                LOGINS["already_connected"].inc()
+                print_warning(f"{username} is already connected. Disconnecting new session.")
+                self.writer.send(self.codec.error("You are already connected elsewhere."))
+                return False
+            # Send password prompt and wait for the next line.
+            # No lock is held while the client types it.
+            self.state = "password"
+            self.writer.send(self.codec.password_required())
+            return True
+
+        LOGINS["registered"].inc()
+        print_success(f"New user: {username}. Adding to known users.")
+        if storage:
+            storage.add_user(username)
+
+        self.authenticated = True # Mark as added to the list
+        self.state = "message"
+        admission.logged_in()
+        announce_presence(username, True)
+        # At some point, we will have them enter their private key here
+        self.writer.send(self.codec.welcome(username, registered=True))
+        self._send_token()
+        return True
+
+    def _handle_password(self, data: bytes) -> bool:
+        username = self.username
+        if not data:
+            print_warning(f"{username} ({self.addr}) disconnected before sending password")
+            return False
+
+        password = data.decode()
+        if password.startswith(TOKEN_PREFIX):
+            # A session token: checking it is one HMAC, and no password looks like one
+            return self._password_checked(credentials.check_token(username, password), "token")
+
+        # Check the password on the KDF pool and carry on once it's done
+        try:
+            future = credentials.verify(username, password)
+        except Busy:
+            LOGINS["busy"].inc()
+            print_warning(f"Too many logins waiting; turning away {username} ({self.addr})")
+            self.writer.send(self.codec.error("Server busy, try again later."))
+            return False
+        self._wait_for(future, self._password_checked, future, "authenticated", time.perf_counter())
+        return True
+
+    def _password_checked(self, result, how, started=None) -> bool:
+        username = self.username
+        if started is not None:
+            PASSWORD_CHECK_LATENCY.observe(time.perf_counter() - started)
+            result = result.result()
+        if not result:
+            LOGINS["bad_password"].inc()
+            print_error(f"Incorrect {'token' if how == 'token' else 'password'} from {username} ({self.addr}). "
+                        f"Disconnecting.")
+            return False
+
+        # Add to connected users, unless someone logged in as them while we waited
+        if bus:
+            claimed = users.claim(username, self.writer, False)
+            self._wait_for(claimed, self._logged_in, how, claimed)
+            return True
+        return self._logged_in(how, users.connect(username, self.writer))
+
+    def _logged_in(self, how, connected) -> bool:
+        username = self.username
+        if isinstance(connected, Future):
+            connected = connected.result()
+        if not connected:
+            LOGINS["already_connected"].inc()
+            print_warning(f"{username} is already connected. Disconnecting new session.")
+            self.writer.send(self.codec.error("You are already connected elsewhere."))
+            return False
+
+        LOGINS[how].inc()
+        print_success(f"{username} ({self.addr}) authenticated successfully{' with a token' if how == 'token' else ''}.")
+        self.authenticated = True # Mark as added to the list
+        self.state = "message"
+        admission.logged_in()
+        announce_presence(username, True)
+        self.writer.send(self.codec.welcome(username, registered=False))
+        self._send_token()
+        send_catch_up(username, self.writer)
+        return True
+
+    def _send_token(self):
+        # v2 clients get a session token right after logging in; text clients ask with /token
+        if self.binary:
+            self.writer.send(self.codec.session_token(*credentials.issue_token(self.username)))
+
+    def _set_password(self, parts):
+        if len(parts) != 2 or not parts[1]:
+            self.writer.send(self.codec.error("Usage: /password <new password>"))
+            return
+        if parts[1].startswith(TOKEN_PREFIX):
+            self.writer.send(self.codec.error(f"Passwords can't start with '{TOKEN_PREFIX}'."))
+            return
+        try:
+            future = credentials.hash(parts[1])
+        except Busy:
+            self.writer.send(self.codec.error("Server busy, try again later."))
+            return
+        self._wait_for(future, self._password_hashed, future)
+
+    def _password_hashed(self, future) -> bool:
+        record = future.result()
+        if bus:
+            bus.publish("credential", self.username, record)
+            # Sign the new token with the record once it's ours too
+            self._wait_for(bus.sync_future(), self._password_changed)
+            return True
+        apply_credential(self.username, record)
+        return self._password_changed()
+
+    def _password_changed(self) -> bool:
+        print_info(f"{self.username} set a new password")
+        self.writer.send(self.codec.info("Password changed. Earlier session tokens no longer work."))
+        self._send_token()
+        return True
+
+    def handoff_state(self):
+        """Everything a hot restart's new process needs to carry on with this client; see adopt()."""
+        return {
+            "addr": self.addr,
+            "username": self.username,
+            "state": self.state,
+            "binary": self.binary,
+            # Whether the client negotiated compression, and with the preset dictionary
+            "zdict": None if self.inflate is None else self.inflate.zdict,
+            "presence": presence.scope(self.username) if self.authenticated else None,
+        }
+
+    def adopt(self, state) -> bool:
+        """
+        Carry on from another process's handoff_state() without the client noticing.
+        Returns False if someone logged in as them in between, like a second login would.
+        """
+        self.username = state["username"]
+        self.state = state["state"]
+        if state["binary"]:
+            deflate = None
+            if state["zdict"] is not None:
+                deflate = Deflate(state["zdict"], COMPRESS_MIN, COMPRESS_LEVEL)
+                self.inflate = Inflate(state["zdict"])
+            self.codec = self.writer.codec = BinaryCodec(deflate)
+        if self.state == "message":
+            if not users.connect(self.username, self.writer):
+                print_warning(f"{self.username} is already connected. Disconnecting the handed over session.")
+                return False
+            self.authenticated = True
+            if state["presence"]:
+                presence.subscribe(self.username, self.writer, state["presence"])
+        return True
+
+    def handle_eof(self):
+        """Log a client that closed its side of the connection."""
+        if self.state == "username":
+            print_warning(f"Connection from {self.addr} closed before sending username")
+        elif self.state == "password":
+            print_warning(f"{self.username} ({self.addr}) disconnected before sending password")
+        else:
+            print_info(f"{self.username} ({self.addr}) disconnected")
+
+    def close(self):
+        """Remove the user from the connected list if this session added them."""
+        # Only remove them if they were successfully authenticated and added
+        if self.authenticated:
+            presence.unsubscribe(self.username, self.writer)
+            # Only removes the entry if this session still owns it
+            if users.disconnect(self.username, self.writer):
+                print_info(f"Removed {self.username} from connected list.")
+                announce_presence(self.username, False)
+            message_store.save_delivery_cursors(self.username)
+            self.authenticated = False
+
+def handle_client(conn, addr, adopted=None):
+    # Handle a single client connection in its own thread.
+    # adopted is the client's state when a hot restart handed it to us.
+    if tls_context is not None:
+        # The TLS handshake happens below, in this thread, so a slow client can't hold up accepting
+        conn = tls.TLSSocket(tls_context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False))
+    writer = ThreadedWriter(conn, OUTBOUND_LIMIT, OVERFLOW_POLICY)
+    session = ClientSession(writer, addr)
+    reader = LineReader(conn)
+    if adopted is None:
+        CONNECTIONS_ACCEPTED.inc()
+    else:
+        admission.adopt(adopted["state"] != "message")
+        reader.feed(adopted["pending"])
+    CONNECTIONS_OPEN.inc()
+    
+    try:
+        if adopted is not None and not session.adopt(adopted):
+            return
+        # Only the handshake has a deadline; reads block for as long as they like after that
+        handshaking = HANDSHAKE_TIMEOUT is not None and session.state != "message"
+        if handshaking:
+            conn.settimeout(HANDSHAKE_TIMEOUT)
+        if tls_context is not None:
+            # Counts towards the login deadline
+            try:
+                conn.do_handshake()
+            except ssl.SSLError as e:
+                TLS_HANDSHAKES["failed"].inc()
+                print_warning(f"Dropping {addr}: TLS handshake failed: {e.reason or e}")
+                return
+            TLS_HANDSHAKES["resumed" if conn.session_reused else "full"].inc()
         while True:
-            # Use the helper to read just the message
-            data = recv_line(conn)
-            if data is None: # Handle client disconnect
-                print_info(f"{username} ({addr}) disconnected")
-                break
-            message = data.decode()
-            
-            # Handle special commands
-            if message.startswith("/"):
-                handle_command(username, message, conn)
+            if restart.requested:
+                # Stop between requests for a hot restart; we're back here if it's called off
+                restart.park(conn, writer, dict(session.handoff_state(), pending=reader.pending()))
                 continue
-            
-            # Regular message - parse format: "recipient: message_content"
-            if ":" in message:
-                parts = message.split(":", 1)
-                recipient = parts[0].strip()
-                content = parts[1].strip()
-                
-                # Don't allow sending messages to yourself
-                if recipient == username:
-                    conn.sendall(b"ERROR: You cannot send messages to yourself.\n")
-                    continue
-                
-                # Check if recipient exists
-                with user_lock:
-                    if recipient not in knownUsers:
-                        conn.sendall(f"ERROR: User '{recipient}' not found.\n".encode())
-                        continue
-                    recipient_conn = connectedUsers.get(recipient)
-                
-                # Store message in conversation
-                message_store.add_message(username, recipient, content)
-                
-                # If recipient is connected, forward the message
-                if recipient_conn:
-                    try:
-                        msg_notification = f"[from {username}]: {content}\n"
-                        recipient_conn.sendall(msg_notification.encode())
-                        print_received(f"Message from {username} to {recipient}: {content!r}")
-                    except Exception as e:
-                        print_error(f"Failed to deliver message to {recipient}: {e}")
-                        conn.sendall(b"ERROR: Failed to deliver message.\n")
-                        continue
-                
-                # Confirm delivery to sender
-                conn.sendall(f"Message sent to {recipient}.\n".encode())
+            if HOT_RESTART and not reader.wait(restart.wakeup, HANDSHAKE_TIMEOUT if handshaking else None):
+                # Woken for a restart while the client was quiet
+                continue
+            if session.binary:
+                frame = read_frame(reader, session.inflate)
+                if frame is None: # Handle client disconnect
+                    session.handle_eof()
+                    break
+                opcode, _, request_id, fields = frame
+                BYTES_IN.inc(HEADER.size + sum(len(field) + 4 for field in fields))
+                if restart.frozen:
+                    # Too late: a hot restart already handed over everyone who stopped in time
+                    restart.hang()
+                keep_going = session.handle_frame(opcode, request_id, fields)
             else:
-                conn.sendall(b"ERROR: Invalid message format. Use 'recipient: message'\n")
+                data = reader.read_line()
+                if data is None: # Handle client disconnect
+                    session.handle_eof()
+                    break
+                BYTES_IN.inc(len(data) + 1)
+                if restart.frozen:
+                    restart.hang()
+                keep_going = session.handle_line(data)
+            while keep_going and session.deferred:
+                # Over a rate limit, or waiting for a password check or the hub: leave
+                # the rest of what they sent unread until it's their turn
+                if session.pending is not None:
+                    wait_futures([session.pending])
+                else:
+                    time.sleep(session.retry_after)
+                if restart.frozen:
+                    restart.hang()
+                keep_going = session.resume()
+            if not keep_going:
+                break
+            if handshaking and session.state == "message":
+                handshaking = False
+                conn.settimeout(None)
             
+    except socket.timeout:
+        print_warning(f"Dropping {addr}: didn't log in within {HANDSHAKE_TIMEOUT:g}s")
+    except LineTooLong as e:
+        print_warning(f"Dropping {addr}: {e}")
+        writer.send(session.codec.error("Frame too long." if session.binary else "Line too long."))
     except Exception as e:
         print_error(f"Error with {addr}: {e}")
     finally:
-        # Only remove them if they were successfully authenticated and added
-        if authenticated:
-            with user_lock:
-                # Check if they are still in the list before deleting
-                if username in connectedUsers:
-                    del connectedUsers[username]
-                    print_info(f"Removed {username} from connected list.")
-        
+        CONNECTIONS_OPEN.dec()
+        admission.release(session.state != "message")
+        session.close()
+        # Let the writer flush anything still queued before the socket goes away
+        writer.close()
         try:
             conn.close()
         except Exception:
             pass
 
-def main():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+# asyncio mode: each connection's (stream_reader, stream_writer, writer) by session, for
+# a hot restart to hand over, and tasks nobody else holds on to
+async_connections = {}
+background_tasks = set()
+# Set when a hot restart is called off, for connections waiting at a request boundary
+restart_resumed = None
 
+def start_background(coro):
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def park_async(session):
+    """Stop between requests for a hot restart; returns if it's called off."""
+    session.idle = True
+    while restart.requested:
+        await restart_resumed.wait()
+    session.idle = False
+
+async def hang_async():
+    """For a connection that finds a hot restart already handed over everyone who stopped in time."""
+    await asyncio.get_running_loop().create_future()
+
+async def handle_client_async(stream_reader, stream_writer, adopted=None):
+    # Handle a single client connection as a task on the event loop.
+    # adopted is the client's state when a hot restart handed it to us.
+    addr = stream_writer.get_extra_info("peername")
+    ssl_object = stream_writer.get_extra_info("ssl_object")
+    if ssl_object is not None:
+        # Only the handshakes that worked get this far; asyncio drops the rest itself
+        TLS_HANDSHAKES["resumed" if ssl_object.session_reused else "full"].inc()
+    if adopted is None:
+        refused = admission.admit()
+        if refused:
+            print_warning(f"Turning away {addr}: too many {refused}")
+            # Buffered by the transport, so this never waits on the client
+            stream_writer.write(SERVER_BUSY)
+            stream_writer.close()
+            return
+    else:
+        admission.adopt(adopted["state"] != "message")
+    writer = AsyncWriter(stream_writer, OUTBOUND_LIMIT, OVERFLOW_POLICY)
+    session = ClientSession(writer, addr)
+    if adopted is None:
+        CONNECTIONS_ACCEPTED.inc()
+    CONNECTIONS_OPEN.inc()
+    if HOT_RESTART:
+        async_connections[session] = (stream_reader, stream_writer, writer)
+    handshake_timer = None
+
+    try:
+        if adopted is not None and not session.adopt(adopted):
+            return
+        # Cut the connection if it hasn't logged in by the deadline
+        if HANDSHAKE_TIMEOUT is not None and session.state != "message":
+            def handshake_expired():
+                # Once handed over, the socket is the new process's business
+                if session.state != "message" and not restart.frozen:
+                    print_warning(f"Dropping {addr}: didn't log in within {HANDSHAKE_TIMEOUT:g}s")
+                    stream_writer.transport.abort()
+            handshake_timer = asyncio.get_running_loop().call_later(HANDSHAKE_TIMEOUT, handshake_expired)
+        while True:
+            if restart.requested:
+                await park_async(session)
+            try:
+                # Nothing of the next request has been taken from stream_reader while idle,
+                # so a hot restart can hand over what it has buffered as it is
+                session.idle = True
+                if session.binary:
+                    header = await stream_reader.readexactly(HEADER.size)
+                    session.idle = False
+                    if restart.frozen:
+                        await hang_async()
+                    length, opcode, flags, request_id = HEADER.unpack(header)
+                    check_length(length)
+                    payload = await stream_reader.readexactly(length)
+                    BYTES_IN.inc(HEADER.size + length)
+                    fields = decode_payload(flags, payload, session.inflate)
+                    keep_going = session.handle_frame(opcode, request_id, fields)
+                else:
+                    line = await stream_reader.readuntil(b"\n")
+                    session.idle = False
+                    if restart.frozen:
+                        await hang_async()
+                    BYTES_IN.inc(len(line))
+                    keep_going = session.handle_line(line[:-1])
+            except asyncio.IncompleteReadError: # Handle client disconnect
+                session.handle_eof()
+                break
+            while keep_going and session.deferred:
+                # Over a rate limit, or waiting for a password check or the hub: leave
+                # the rest of what they sent unread until it's their turn
+                if session.pending is not None:
+                    await asyncio.wait([asyncio.wrap_future(session.pending)])
+                else:
+                    await asyncio.sleep(session.retry_after)
+                if restart.frozen:
+                    await hang_async()
+                keep_going = session.resume()
+            if not keep_going:
+                break
+            # Stop reading from a client that isn't reading its replies
+            await writer.drain()
+
+    except asyncio.LimitOverrunError:
+        print_warning(f"Dropping {addr}: Line exceeds {MAX_LINE_LENGTH} bytes")
+        writer.send(session.codec.error("Line too long."))
+    except LineTooLong as e:
+        print_warning(f"Dropping {addr}: {e}")
+        writer.send(session.codec.error("Frame too long." if session.binary else "Line too long."))
+    except Exception as e:
+        print_error(f"Error with {addr}: {e}")
+    finally:
+        async_connections.pop(session, None)
+        if handshake_timer is not None:
+            handshake_timer.cancel()
+        CONNECTIONS_OPEN.dec()
+        admission.release(session.state != "message")
+        session.close()
+        await writer.close()
+        try:
+            stream_writer.close()
+            await stream_writer.wait_closed()
+        except Exception:
+            pass
+
+def raise_fd_limit():
+    """Raise the open file limit as far as allowed so we can hold many idle clients."""
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+def request_restart(signum, frame):
+    # SIGUSR2 in threaded mode; the accept loop takes it from here
+    restart.signalled = True
+
+def start_successor():
+    """Start a fresh copy of the server for a hot restart. Returns it once it's ready, or None."""
+    print_info("Hot restart: starting a new server process")
+    try:
+        # Same token key, so session tokens handed out here keep working there
+        successor = hotrestart.Successor([sys.executable, os.path.abspath(__file__)] + sys.argv[1:],
+                                         dict(os.environ, LUCIA_TOKEN_KEY=credentials.key.hex()))
+    except OSError as e:
+        print_error(f"Hot restart: couldn't start a new server process: {e}")
+        restart.abort()
+        return None
+    if not successor.wait_ready():
+        print_error("Hot restart: the new server process didn't start; carrying on")
+        successor.kill()
+        restart.abort()
+        return None
+    return successor
+
+def finish_restart(successor, listener, clients):
+    """Hand the listening socket, the stopped clients and the store to successor, and exit."""
+    state = {"users": users.known_users(), "credentials": credentials.records(),
+             "store": message_store.snapshot()}
+    if storage:
+        # Flush the last group commit; the new process opens the data dir once it has the handover
+        storage.close()
+    try:
+        successor.hand_over(listener, clients, state)
+    except OSError as e:
+        print_error(f"Hot restart failed halfway, exiting: {e}")
+        shutdown_logging()
+        os._exit(1)
+    dropped = admission.connections - len(clients)
+    print_success(f"Hot restart: handed {len(clients)} connection(s) over to process {successor.proc.pid}"
+                  + (f", dropped {dropped} that didn't stop in time" if dropped else ""))
+    shutdown_logging()
+    os._exit(0)
+
+def hot_restart_threaded(listener):
+    """
+    Hot restart from the accept loop: stop every connection between requests, flush
+    their replies and hand everything over to a new process. Only returns if that
+    process doesn't start, in which case everyone carries on here.
+    """
+    successor = start_successor()
+    if successor is None:
+        return
+    restart.begin()
+    if not restart.wait_parked(lambda: admission.connections, RESTART_TIMEOUT):
+        print_warning("Hot restart: not every connection stopped in time")
+    if not successor.alive():
+        print_error("Hot restart: the new server process exited; carrying on")
+        successor.kill()
+        restart.abort()
+        return
+    parked = restart.freeze()
+    # Group messages already routed reach the queues before they're flushed
+    GROUP_FANOUT.submit(lambda: None).result()
+    deadline = time.monotonic() + RESTART_TIMEOUT
+    for _, writer, _ in parked:
+        writer.close(max(0.0, deadline - time.monotonic()))
+    # A writer still sending would leave half a frame behind, so its client isn't handed over
+    clients = [(conn, state) for conn, writer, state in parked if not writer.thread.is_alive()]
+    finish_restart(successor, listener, clients)
+
+def request_restart_async(server):
+    # SIGUSR2 in asyncio mode
+    if not restart.signalled:
+        restart.signalled = True
+        start_background(hot_restart_async(server))
+
+async def hot_restart_async(server):
+    """hot_restart_threaded() for the asyncio engine."""
+    loop = asyncio.get_running_loop()
+    successor = await loop.run_in_executor(None, start_successor)
+    if successor is None:
+        return
+    restart_resumed.clear()
+    restart.begin()
+    deadline = loop.time() + RESTART_TIMEOUT
+    while not all(session.idle for session in async_connections) and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    if not successor.alive():
+        print_error("Hot restart: the new server process exited; carrying on")
+        successor.kill()
+        restart.abort()
+        restart_resumed.set()
+        return
+    listener = server.sockets[0]
+    # Stop accepting; the kernel queues new connections until the new process takes over.
+    # Connections accepted just before take a few loop iterations to start their handler
+    # and stop at the first request like everyone else.
+    loop.remove_reader(listener.fileno())
+    for _ in range(5):
+        await asyncio.sleep(0)
+    while not all(session.idle for session in async_connections) and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    # From here on nothing reads a request, and everyone idle is handed over
+    # with whatever they've sent so far
+    restart.freeze()
+    stopped = []
+    for session, (stream_reader, stream_writer, writer) in list(async_connections.items()):
+        if not session.idle:
+            continue
+        stream_writer.transport.pause_reading()
+        # StreamReader has no public way to look at what it has buffered
+        state = dict(session.handoff_state(), pending=bytes(stream_reader._buffer))
+        stopped.append((stream_writer, writer, state))
+    if len(stopped) < len(async_connections):
+        print_warning("Hot restart: not every connection stopped in time")
+    # Group messages already routed reach the queues before they're flushed
+    await asyncio.wrap_future(GROUP_FANOUT.submit(lambda: None))
+    await asyncio.sleep(0)
+    await asyncio.gather(*(writer.close(RESTART_TIMEOUT) for _, writer, _ in stopped))
+    deadline = loop.time() + RESTART_TIMEOUT
+    while (any(stream_writer.transport.get_write_buffer_size() for stream_writer, _, _ in stopped)
+           and loop.time() < deadline):
+        await asyncio.sleep(0.01)
+    # A writer that didn't finish would leave half a frame behind, so its client isn't handed over
+    clients = [(stream_writer.get_extra_info("socket"), state) for stream_writer, writer, state in stopped
+               if writer.task.done() and not writer.task.cancelled()
+               and not stream_writer.transport.get_write_buffer_size()]
+    finish_restart(successor, listener, clients)
+
+async def adopt_async():
+    """Carry on with the clients a hot restart handed us."""
+    loop = asyncio.get_running_loop()
+
+    async def adopt(conn, state):
+        # What open_connection() does, except that what the old process had read already
+        # is in the buffer before the transport starts adding anything new behind it
+        stream_reader = asyncio.StreamReader(limit=MAX_LINE_LENGTH + 1)
+        stream_reader.feed_data(state["pending"])
+        protocol = asyncio.StreamReaderProtocol(stream_reader)
+        try:
+            transport, _ = await loop.connect_accepted_socket(lambda: protocol, sock=conn)
+        except OSError as e:
+            print_warning(f"Couldn't take over {state['addr']}: {e}")
+            conn.close()
+            return
+        stream_writer = asyncio.StreamWriter(transport, protocol, stream_reader, loop)
+        start_background(handle_client_async(stream_reader, stream_writer, state))
+
+    await asyncio.gather(*(adopt(conn, state) for conn, state in handoff.clients))
+
+async def serve_async():
+    global restart_resumed
+    restart_resumed = asyncio.Event()
+    if handoff:
+        # Not accepting until the clients we were handed have their names back
+        server = await asyncio.start_server(handle_client_async, sock=handoff.listener,
+                                            limit=MAX_LINE_LENGTH + 1, start_serving=False)
+        await adopt_async()
+        print_info(f"Took over {len(handoff.clients)} connection(s) on {HOST}:{PORT} (asyncio)")
+    else:
+        # asyncio does the TLS handshake before handle_client_async() starts, under its own deadline
+        tls_options = {"ssl": tls_context, "ssl_handshake_timeout": HANDSHAKE_TIMEOUT} if tls_context else {}
+        server = await asyncio.start_server(
+            handle_client_async, HOST, PORT,
+            limit=MAX_LINE_LENGTH + 1, backlog=LISTEN_BACKLOG, reuse_address=True,
+            reuse_port=bus is not None, **tls_options
+        )
+        print_info(f"Server listening on {HOST}:{PORT} (asyncio{', TLS' if tls_context else ''})")
+    if HOT_RESTART:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, request_restart_async, server)
+    async with server:
+        await server.serve_forever()
+
+def serve_threaded():
+    if handoff:
+        sock = handoff.listener
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if bus:
+            # Every worker binds the port; the kernel spreads connections between them
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((HOST, PORT))
+        sock.listen(LISTEN_BACKLOG)
+    with sock:
         # Allow the socket to timeout so we can handle KeyboardInterrupt
         sock.settimeout(1.0)  
         
-        sock.bind((HOST, PORT))
-        sock.listen()
-        print_info(f"Server listening on {HOST}:{PORT}")
+        if handoff:
+            for conn, state in handoff.clients:
+                # Whoever had the socket before may have made it non-blocking
+                conn.setblocking(True)
+                threading.Thread(target=handle_client, args=(conn, state["addr"], state), daemon=True).start()
+            print_info(f"Took over {len(handoff.clients)} connection(s) on {HOST}:{PORT}")
+        else:
+            print_info(f"Server listening on {HOST}:{PORT}" + (" (TLS)" if tls_context else ""))
+        if HOT_RESTART:
+            signal.signal(signal.SIGUSR2, request_restart)
         
+        while True:
+            if restart.signalled:
+                hot_restart_threaded(sock)
+            try:
+                conn, addr = sock.accept()
+                refused = admission.admit()
+                if refused:
+                    print_warning(f"Turning away {addr}: too many {refused}")
+                    # Over TLS, telling them would take a handshake, which would hold up accepting
+                    if tls_context is None:
+                        try:
+                            # A fresh socket's send buffer is empty, so this won't have to wait
+                            conn.setblocking(False)
+                            conn.send(SERVER_BUSY)
+                        except OSError:
+                            pass
+                    conn.close()
+                    continue
+                
+                t = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
+                t.start()
+                
+            except socket.timeout:
+                pass 
+
+def serve_supervisor():
+    """
+    Run the hub and WORKERS copies of this server as worker processes on the same port.
+    Workers are started fresh with exec rather than forked, since forking a process
+    that already has threads running (the log writer, the janitor) isn't safe.
+    """
+    hub_dir = tempfile.mkdtemp(prefix="lucia-")
+    hub = Hub(os.path.join(hub_dir, "hub.sock"), WORKERS)
+    hub.start()
+    procs = []
+    try:
+        for i in range(WORKERS):
+            # Workers share the token key, so a token from one works on all of them
+            env = dict(os.environ, LUCIA_HUB=hub.path, LUCIA_WORKER_ID=str(i), LUCIA_WORKERS="1",
+                       LUCIA_TOKEN_KEY=credentials.key.hex())
+            if METRICS_PORT:
+                # One metrics port per worker
+                env["LUCIA_METRICS_PORT"] = str(METRICS_PORT + i)
+            args = [arg for arg in sys.argv[1:] if not arg.startswith("--workers=")]
+            procs.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)] + args, env=env))
+        print_info(f"Started {WORKERS} workers on {HOST}:{PORT}")
+        while all(proc.poll() is None for proc in procs):
+            time.sleep(0.5)
+        print_error("A worker exited; stopping the others")
+    except KeyboardInterrupt:
+        print_warning("Shutting down server")
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        hub.close()
         try:
-            while True:
-                try:
-                    conn, addr = sock.accept()
-                    
-                    t = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-                    t.start()
-                    
-                except socket.timeout:
-                    pass 
-
-        except KeyboardInterrupt:
-            print_warning("Shutting down server")
+            os.rmdir(hub_dir)
+        except OSError:
+            pass
+        shutdown_logging()
+
+def start_worker():
+    """Connect to the hub and wait until every worker is there before accepting clients."""
+    def hub_gone():
+        # Without the hub this replica can't stay consistent with the others
+        print_error("Lost the connection to the hub, exiting")
+        shutdown_logging()
+        os._exit(1)
+    bus.on_close = hub_gone
+    bus.on_presence = presence.changed
+    bus.start(CLUSTER_OPS)
+    bus.ready.wait()
+
+def start_metrics():
+    serve_metrics(METRICS_PORT)
+    print_info(f"Metrics at http://127.0.0.1:{METRICS_PORT}/metrics")
+
+def take_over_metrics():
+    handoff.wait_for_predecessor()
+    if METRICS_PORT:
+        start_metrics()
+
+def main():
+    if WORKERS > 1 and not HUB_PATH:
+        serve_supervisor()
+        return
+    if bus:
+        start_worker()
+    if PID_FILE:
+        with open(PID_FILE, "w") as f:
+            f.write(f"{os.getpid()}\n")
+    if handoff:
+        # Clients are served straight away; the metrics port is free once the old process is gone
+        threading.Thread(target=take_over_metrics, daemon=True).start()
+    elif METRICS_PORT:
+        start_metrics()
+    try:
+        if MODE == "asyncio":
+            raise_fd_limit()
+            asyncio.run(serve_async())
+        else:
+            serve_threaded()
+    except KeyboardInterrupt:
+        print_warning("Shutting down server")
+    finally:
+        if MEMORY_BUDGET is not None or MAX_MESSAGES is not None or MAX_AGE is not None:
+            stats = message_store.memory_stats()
+            print_info(f"Message store: {stats['evictions']} evictions, {stats['reloads']} reloads, "
+                       f"{stats['trimmed']} messages trimmed by retention")
+        if storage:
+            # Flush whatever the last group commit hasn't written yet
+            storage.close()
+        shutdown_logging()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
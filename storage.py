@@ -0,0 +1,524 @@
+"""
+Durable storage backends for Lucia's MessageStore.
+The in-memory store stays the default; LogBackend adds an append-only,
+segmented log on disk so messages and users survive a restart.
+
+Layout of a LogBackend directory:
+    users.log               one registered username per line
+    credentials.log         "username password-record" lines; a user's last line wins
+    conversations.log       create/delete records mapping conversation ids to participants,
+                            plus each participant's delivery cursor
+    seg-00000001.log        message records, appended in order
+    seg-00000001.idx        written when a segment is sealed: per-conversation counts,
+                            last timestamps and record offsets, sorted by conversation
+
+On startup only the users, the conversation table and each sealed segment's
+small per-conversation directory are read, plus a scan of the one active
+segment. Message history is read back from the log lazily, the first time a
+conversation is used.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Message record header: crc32, conversation id, timestamp, sender index, content length
+RECORD = struct.Struct("<IIdBI")
+# Conversation table record: crc32, op (b"C" create / b"D" delete), conversation id, name lengths.
+# Delivery cursor records (op b"R") put the participant index in the first length
+# and are followed by the cursor itself.
+CONV_RECORD = struct.Struct("<IcIHH")
+CURSOR = struct.Struct("<Q")
+# Sealed segment index: header (magic, conversation count) and one directory entry per
+# conversation (id, message count, last timestamp, index of its first offset)
+INDEX_MAGIC = b"LIDX"
+INDEX_HEADER = struct.Struct("<4sI")
+INDEX_ENTRY = struct.Struct("<IIdQ")
+
+# Roll over to a new segment file once the active one reaches this size.
+# Restart scans only the active segment, so this also bounds recovery time.
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+# Group commit: buffered records are written and fsynced together this often (seconds)
+DEFAULT_FSYNC_INTERVAL = 0.05
+
+# (timestamps, senders, content, offsets) in the same layout Conversation keeps in memory
+Columns = Tuple[array, bytearray, bytearray, array]
+
+
+class StorageBackend(ABC):
+    """
+    Interface MessageStore uses to persist conversations.
+    Conversations are identified by the integer id create_conversation() hands out.
+    """
+
+    @abstractmethod
+    def conversations(self) -> Iterator[Tuple[int, tuple, int, Optional[float]]]:
+        """Yields (id, key, message count, last message timestamp) for every stored conversation."""
+
+    @abstractmethod
+    def create_conversation(self, key: tuple) -> int:
+        ...
+
+    @abstractmethod
+    def append(self, conversation_id: int, timestamp: float, sender_index: int, content: bytes):
+        ...
+
+    @abstractmethod
+    def delete_conversation(self, conversation_id: int):
+        ...
+
+    def delivery_cursors(self) -> Dict[int, List[int]]:
+        """Conversation id -> the last saved delivery cursor of each participant."""
+        return {}
+
+    def set_delivery_cursor(self, conversation_id: int, participant_index: int, seq: int):
+        pass
+
+    @abstractmethod
+    def load_history(self, conversation_id: int) -> Columns:
+        ...
+
+    @abstractmethod
+    def load_users(self) -> List[str]:
+        ...
+
+    @abstractmethod
+    def add_user(self, username: str):
+        ...
+
+    @abstractmethod
+    def load_credentials(self) -> Dict[str, str]:
+        """Password records by username (see credentials.py)."""
+
+    @abstractmethod
+    def set_credential(self, username: str, record: str):
+        ...
+
+    def close(self):
+        pass
+
+
+class _Segment:
+    """A sealed, read-only segment and the directory from its index file."""
+
+    def __init__(self, number: int, log_path: str, idx_path: str):
+        self.number = number
+        self.log_path = log_path
+        self.idx_path = idx_path
+        # Sorted conversation ids, and the raw directory entries in the same order.
+        # Kept packed so thousands of segments don't turn into millions of tuples.
+        self.ids = array("I")
+        self.entries = b""
+        self.positions_start = 0
+        self._log_map = None
+        self._idx_map = None
+
+    def read_directory(self):
+        with open(self.idx_path, "rb") as f:
+            magic, count = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC:
+                raise ValueError(f"{self.idx_path} is not a Lucia index file")
+            self.entries = f.read(INDEX_ENTRY.size * count)
+        self.ids = array("I", (entry[0] for entry in INDEX_ENTRY.iter_unpack(self.entries)))
+        self.positions_start = INDEX_HEADER.size + INDEX_ENTRY.size * count
+
+    def entry(self, conversation_id: int) -> Optional[Tuple[int, int, float, int]]:
+        """Returns (id, count, last timestamp, first offset index), or None if not in this segment."""
+        i = bisect_left(self.ids, conversation_id)
+        if i == len(self.ids) or self.ids[i] != conversation_id:
+            return None
+        return INDEX_ENTRY.unpack_from(self.entries, i * INDEX_ENTRY.size)
+
+    def positions(self, conversation_id: int) -> array:
+        _, count, _, first = self.entry(conversation_id)
+        if self._idx_map is None:
+            with open(self.idx_path, "rb") as f:
+                self._idx_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = self.positions_start + first * 8
+        offsets = array("Q")
+        offsets.frombytes(self._idx_map[start:start + count * 8])
+        return offsets
+
+    def log(self) -> mmap.mmap:
+        if self._log_map is None:
+            with open(self.log_path, "rb") as f:
+                self._log_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._log_map
+
+    def close(self):
+        for mapped in (self._log_map, self._idx_map):
+            if mapped is not None:
+                mapped.close()
+        self._log_map = self._idx_map = None
+
+
+def _scan_log(data, positions: Dict[int, array], counts: Dict[int, int], last: Dict[int, float]) -> int:
+    """
+    Walks message records in data, filling in per-conversation offsets, counts and
+    last timestamps. Returns the offset just past the last intact record.
+    """
+    offset = 0
+    size = len(data)
+    while offset + RECORD.size <= size:
+        crc, conversation_id, timestamp, sender, length = RECORD.unpack_from(data, offset)
+        end = offset + RECORD.size + length
+        if end > size or zlib.crc32(data[offset + 4:end]) != crc:
+            break
+        positions.setdefault(conversation_id, array("Q")).append(offset)
+        counts[conversation_id] = counts.get(conversation_id, 0) + 1
+        last[conversation_id] = timestamp
+        offset = end
+    return offset
+
+
+class LogBackend(StorageBackend):
+    """
+    Append-only segmented log with group commit.
+    append() only copies the record into a buffer; a background thread writes and
+    fsyncs the buffer every fsync_interval seconds, so one fsync covers many messages.
+    Sealing a full segment (its fsync and index file) happens on that thread too.
+    """
+
+    def __init__(self, directory: str, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 fsync_interval: float = DEFAULT_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        self._conv_buffer = bytearray()
+        self._user_buffer = bytearray()
+        self._cred_buffer = bytearray()
+
+        self._users: List[str] = []
+        self._credentials: Dict[str, str] = {}
+        # Conversation table: id -> key, for conversations that haven't been deleted
+        self._keys: Dict[int, tuple] = {}
+        self._cursors: Dict[int, List[int]] = {}
+        self._next_id = 1
+        self._segments: List[_Segment] = []
+        # Everything about the active segment lives in memory until it is sealed
+        self._active_positions: Dict[int, array] = {}
+        self._active_counts: Dict[int, int] = {}
+        self._active_last: Dict[int, float] = {}
+        # Rolled over but not sealed yet, oldest first:
+        # (number, file, positions, counts, last), none of which changes any more
+        self._sealing: List[tuple] = []
+        # Only one thread seals at a time
+        self._seal_lock = threading.Lock()
+
+        self._users_file = self._open_append("users.log", self._recover_users)
+        self._cred_file = self._open_append("credentials.log", self._recover_credentials)
+        self._conv_file = self._open_append("conversations.log", self._recover_conversations)
+        self._open_segments()
+
+        self._closed = False
+        self._wakeup = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    # --- Startup and recovery ---
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _open_append(self, name: str, recover):
+        path = self._path(name)
+        valid_end = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                valid_end = recover(f.read())
+        f = open(path, "ab")
+        # Cut off a record that was only half written when we last stopped
+        f.truncate(valid_end)
+        return f
+
+    def _recover_users(self, data: bytes) -> int:
+        self._users = [name.decode() for name in data.split(b"\n")[:-1]]
+        return data.rfind(b"\n") + 1
+
+    def _recover_credentials(self, data: bytes) -> int:
+        for line in data.split(b"\n")[:-1]:
+            username, _, record = line.decode().rpartition(" ")
+            self._credentials[username] = record
+        return data.rfind(b"\n") + 1
+
+    def _recover_conversations(self, data: bytes) -> int:
+        offset = 0
+        while offset + CONV_RECORD.size <= len(data):
+            crc, op, conversation_id, len1, len2 = CONV_RECORD.unpack_from(data, offset)
+            if op == b"R":
+                end = offset + CONV_RECORD.size + CURSOR.size
+            else:
+                end = offset + CONV_RECORD.size + len1 + len2
+            if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+                break
+            names = data[offset + CONV_RECORD.size:end]
+            if op == b"C":
+                self._keys[conversation_id] = (names[:len1].decode(), names[len1:].decode())
+            elif op == b"R":
+                if conversation_id in self._keys:
+                    self._cursors.setdefault(conversation_id, [0, 0])[len1] = CURSOR.unpack(names)[0]
+            else:
+                self._keys.pop(conversation_id, None)
+                self._cursors.pop(conversation_id, None)
+            self._next_id = max(self._next_id, conversation_id + 1)
+            offset = end
+        return offset
+
+    def _segment_paths(self, number: int) -> Tuple[str, str]:
+        return self._path(f"seg-{number:08d}.log"), self._path(f"seg-{number:08d}.idx")
+
+    def _open_segments(self):
+        numbers = sorted(
+            int(name[4:12]) for name in os.listdir(self.directory)
+            if name.startswith("seg-") and name.endswith(".log")
+        )
+        if not numbers:
+            numbers = [1]
+        for number in numbers[:-1]:
+            log_path, idx_path = self._segment_paths(number)
+            if not os.path.exists(idx_path):
+                # Crashed between rolling over and writing this segment's index
+                with open(log_path, "rb") as f:
+                    data = f.read()
+                positions, counts, last = {}, {}, {}
+                _scan_log(data, positions, counts, last)
+                self._write_index(idx_path, positions, counts, last)
+            segment = _Segment(number, log_path, idx_path)
+            segment.read_directory()
+            self._segments.append(segment)
+
+        # The newest segment is the active one; rebuild its index by scanning it
+        self._active_number = numbers[-1]
+        log_path, _ = self._segment_paths(self._active_number)
+        data = b""
+        if os.path.exists(log_path):
+            with open(log_path, "rb") as f:
+                data = f.read()
+        valid_end = _scan_log(data, self._active_positions, self._active_counts, self._active_last)
+        self._segment_file = open(log_path, "ab")
+        self._segment_file.truncate(valid_end)
+        self._active_size = valid_end
+
+    def _write_index(self, idx_path: str, positions: Dict[int, array],
+                     counts: Dict[int, int], last: Dict[int, float]):
+        live = sorted(cid for cid in positions if cid in self._keys)
+        entries = bytearray(INDEX_HEADER.pack(INDEX_MAGIC, len(live)))
+        offsets = array("Q")
+        for conversation_id in live:
+            entries += INDEX_ENTRY.pack(conversation_id, counts[conversation_id],
+                                        last[conversation_id], len(offsets))
+            offsets.extend(positions[conversation_id])
+        tmp_path = idx_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(entries)
+            f.write(offsets.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # Readers only ever see a complete index file
+        os.replace(tmp_path, idx_path)
+
+    # --- StorageBackend ---
+
+    def conversations(self) -> Iterator[Tuple[int, tuple, int, Optional[float]]]:
+        with self._lock:
+            keys = dict(self._keys)
+            totals: Dict[int, int] = {}
+            last: Dict[int, float] = {}
+            for segment in self._segments:
+                for conversation_id, count, last_ts, _ in INDEX_ENTRY.iter_unpack(segment.entries):
+                    totals[conversation_id] = totals.get(conversation_id, 0) + count
+                    last[conversation_id] = last_ts
+            unsealed = [(counts, last_ts) for _, _, _, counts, last_ts in self._sealing]
+            for counts, last_ts in unsealed + [(self._active_counts, self._active_last)]:
+                for conversation_id, count in counts.items():
+                    totals[conversation_id] = totals.get(conversation_id, 0) + count
+                    last[conversation_id] = last_ts[conversation_id]
+        for conversation_id, key in keys.items():
+            yield conversation_id, key, totals.get(conversation_id, 0), last.get(conversation_id)
+
+    def create_conversation(self, key: tuple) -> int:
+        user1, user2 = (name.encode() for name in key)
+        with self._lock:
+            conversation_id = self._next_id
+            self._next_id += 1
+            self._keys[conversation_id] = key
+            body = CONV_RECORD.pack(0, b"C", conversation_id, len(user1), len(user2))[4:] + user1 + user2
+            self._conv_buffer += struct.pack("<I", zlib.crc32(body)) + body
+        return conversation_id
+
+    def delete_conversation(self, conversation_id: int):
+        with self._lock:
+            self._keys.pop(conversation_id, None)
+            body = CONV_RECORD.pack(0, b"D", conversation_id, 0, 0)[4:]
+            self._conv_buffer += struct.pack("<I", zlib.crc32(body)) + body
+            # Its records stay in the log as garbage; they're ignored from now on
+            self._active_positions.pop(conversation_id, None)
+            self._active_counts.pop(conversation_id, None)
+            self._active_last.pop(conversation_id, None)
+            self._cursors.pop(conversation_id, None)
+
+    def delivery_cursors(self) -> Dict[int, List[int]]:
+        with self._lock:
+            return {cid: list(cursors) for cid, cursors in self._cursors.items()}
+
+    def set_delivery_cursor(self, conversation_id: int, participant_index: int, seq: int):
+        body = CONV_RECORD.pack(0, b"R", conversation_id, participant_index, 0)[4:] + CURSOR.pack(seq)
+        with self._lock:
+            if conversation_id not in self._keys:
+                return
+            self._cursors.setdefault(conversation_id, [0, 0])[participant_index] = seq
+            self._conv_buffer += struct.pack("<I", zlib.crc32(body)) + body
+
+    def append(self, conversation_id: int, timestamp: float, sender_index: int, content: bytes):
+        body = RECORD.pack(0, conversation_id, timestamp, sender_index, len(content))[4:] + content
+        record = struct.pack("<I", zlib.crc32(body)) + body
+        with self._lock:
+            self._active_positions.setdefault(conversation_id, array("Q")).append(self._active_size)
+            self._active_counts[conversation_id] = self._active_counts.get(conversation_id, 0) + 1
+            self._active_last[conversation_id] = timestamp
+            self._buffer += record
+            self._active_size += len(record)
+            if self._active_size >= self.segment_size:
+                self._roll_segment()
+
+    def load_history(self, conversation_id: int) -> Columns:
+        timestamps = array("d")
+        senders = bytearray()
+        content = bytearray()
+        offsets = array("Q", [0])
+
+        def read_records(data, record_offsets):
+            for offset in record_offsets:
+                _, _, timestamp, sender, length = RECORD.unpack_from(data, offset)
+                start = offset + RECORD.size
+                timestamps.append(timestamp)
+                senders.append(sender)
+                content.extend(data[start:start + length])
+                offsets.append(len(content))
+
+        with self._lock:
+            segments = [s for s in self._segments if s.entry(conversation_id) is not None]
+            # Unsealed segments, the active one last: (path, offsets of our records)
+            unsealed = [(self._segment_paths(number)[0], positions[conversation_id])
+                        for number, _, positions, _, _ in self._sealing if conversation_id in positions]
+            active = array("Q", self._active_positions.get(conversation_id, ()))
+            if active:
+                # Make sure buffered records are in the file before reading them back
+                self._write_buffers()
+                unsealed.append((self._segment_paths(self._active_number)[0], active))
+
+        for segment in segments:
+            read_records(segment.log(), segment.positions(conversation_id))
+        for path, record_offsets in unsealed:
+            with open(path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    read_records(data, record_offsets)
+        return timestamps, senders, content, offsets
+
+    def load_users(self) -> List[str]:
+        return list(self._users)
+
+    def add_user(self, username: str):
+        with self._lock:
+            self._user_buffer += username.encode() + b"\n"
+
+    def load_credentials(self) -> Dict[str, str]:
+        return dict(self._credentials)
+
+    def set_credential(self, username: str, record: str):
+        with self._lock:
+            self._cred_buffer += f"{username} {record}\n".encode()
+
+    # --- Group commit ---
+
+    def _write_buffers(self):
+        # Caller holds self._lock
+        for buffer, f in ((self._user_buffer, self._users_file),
+                          (self._cred_buffer, self._cred_file),
+                          (self._conv_buffer, self._conv_file),
+                          (self._buffer, self._segment_file)):
+            if buffer:
+                f.write(buffer)
+                f.flush()
+                del buffer[:]
+
+    def _roll_segment(self):
+        # Caller holds self._lock. Start a new active segment; the flusher thread
+        # seals the old one, so append() never waits for its fsync and index.
+        self._write_buffers()
+        self._sealing.append((self._active_number, self._segment_file, self._active_positions,
+                              self._active_counts, self._active_last))
+        self._active_number += 1
+        self._segment_file = open(self._segment_paths(self._active_number)[0], "ab")
+        self._active_size = 0
+        self._active_positions = {}
+        self._active_counts = {}
+        self._active_last = {}
+        self._wakeup.set()
+
+    def _seal_segments(self):
+        # fsync each rolled-over segment and write its index, then let readers use the index
+        with self._seal_lock:
+            with self._lock:
+                sealing = list(self._sealing)
+            for entry in sealing:
+                number, f, positions, counts, last = entry
+                os.fsync(f.fileno())
+                f.close()
+                log_path, idx_path = self._segment_paths(number)
+                self._write_index(idx_path, positions, counts, last)
+                segment = _Segment(number, log_path, idx_path)
+                segment.read_directory()
+                with self._lock:
+                    self._segments.append(segment)
+                    self._sealing.remove(entry)
+
+    def sync(self):
+        """Writes and fsyncs everything appended so far."""
+        # Older segments first, so nothing is durable while what came before it isn't
+        self._seal_segments()
+        with self._lock:
+            self._write_buffers()
+            fds = [f.fileno() for f in (self._users_file, self._cred_file, self._conv_file, self._segment_file)]
+        # fsync without the lock so appends carry on filling the next batch meanwhile
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            except OSError:
+                # The segment was sealed (and fsynced) while we weren't holding the lock
+                pass
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.fsync_interval)
+            self._wakeup.clear()
+            if self._closed:
+                return
+            with self._lock:
+                pending = bool(self._buffer or self._conv_buffer or self._user_buffer or self._cred_buffer
+                               or self._sealing)
+            if pending:
+                self.sync()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._flusher.join()
+        self.sync()
+        with self._lock:
+            for f in (self._users_file, self._cred_file, self._conv_file, self._segment_file):
+                f.close()
+            for segment in self._segments:
+                segment.close()
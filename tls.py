@@ -0,0 +1,170 @@
+"""
+TLS for Lucia connections, shared by the server and the client.
+
+Only TLS 1.3 is offered. Its handshake takes a single round trip, and right
+after it the server sends the client session tickets. A client that connects
+again hands one back and resumes: no certificate is sent or checked, and the
+server skips the signature that is the expensive part of a full handshake.
+The tickets are encrypted with a key that lives in the server process, so they
+stop working once it exits, and each worker process has its own.
+
+Where Python and the kernel allow it (Python 3.12+, OpenSSL 3 built with kTLS,
+Linux's tls module loaded), OpenSSL hands record encryption over to the kernel
+after the handshake, which encrypts as it copies our writes into the socket
+instead of OpenSSL encrypting into a buffer of its own first. That only works
+on a real socket, so it's the threaded server and the client that benefit; the
+asyncio engine's TLS always runs in user space. Where it isn't available it
+quietly stays in user space.
+"""
+
+import select
+import socket
+import ssl
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Session tickets the server sends after each full handshake (OpenSSL's default is 2)
+DEFAULT_TICKETS = 2
+
+
+def server_context(certfile: str, keyfile: Optional[str] = None, tickets: int = DEFAULT_TICKETS,
+                   ktls: bool = True) -> ssl.SSLContext:
+    """A context for accepting TLS 1.3 connections with the given PEM certificate chain and key."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_3
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = tickets
+    if ktls:
+        context.options |= getattr(ssl, "OP_ENABLE_KTLS", 0)
+    return context
+
+
+def client_context(cafile: Optional[str] = None, ktls: bool = True) -> ssl.SSLContext:
+    """
+    A context for connecting to a Lucia server. Certificates are checked against
+    cafile if given (for a self-signed server, its own certificate), else the system's.
+    """
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_3
+    if ktls:
+        context.options |= getattr(ssl, "OP_ENABLE_KTLS", 0)
+    return context
+
+
+class SessionCache:
+    """The newest session ticket from each server, for resuming the next connection to it."""
+
+    def __init__(self):
+        self._sessions: Dict[Tuple[str, int], ssl.SSLSession] = {}
+
+    def get(self, host: str, port: int) -> Optional[ssl.SSLSession]:
+        return self._sessions.get((host, port))
+
+    def save(self, host: str, port: int, sock):
+        """
+        Keep sock's session if the server gave it a ticket. In TLS 1.3 the tickets
+        come after the handshake, so call this once something has been read.
+        """
+        session = sock.session
+        if session is not None and session.has_ticket:
+            self._sessions[(host, port)] = session
+
+
+class TLSSocket:
+    """
+    A TLS connection that one thread can read while another writes, as the
+    threaded server and the client do. OpenSSL doesn't allow two threads in one
+    connection at the same time, and a blocking read would hold it for as long
+    as the peer is quiet. So the socket is non-blocking, each call into OpenSSL
+    holds a lock for as long as it takes to run, and the waiting for the network
+    happens outside the lock.
+
+    Has the parts of the socket interface the rest of Lucia uses.
+    """
+
+    def __init__(self, sock: ssl.SSLSocket):
+        self.sock = sock
+        self._lock = threading.Lock()
+        self._timeout: Optional[float] = sock.gettimeout()
+        sock.setblocking(False)
+        # The end of the handshake, the session tickets and the first data go out as separate
+        # small writes, which Nagle's algorithm would hold back until the peer's delayed ACK
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def settimeout(self, timeout: Optional[float]):
+        """Like socket.settimeout(), for do_handshake() and recv_into()."""
+        self._timeout = timeout
+
+    def gettimeout(self) -> Optional[float]:
+        return self._timeout
+
+    def _wait(self, events: int, deadline: Optional[float]):
+        if deadline is None:
+            timeout = None
+        else:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise socket.timeout("timed out")
+        poller = select.poll()
+        poller.register(self.sock, events)
+        if not poller.poll(None if timeout is None else timeout * 1000):
+            raise socket.timeout("timed out")
+
+    def _call(self, method, *args, deadline: Optional[float] = None):
+        """Run an SSLSocket method until it no longer needs to wait for the network."""
+        while True:
+            with self._lock:
+                try:
+                    return method(*args)
+                except ssl.SSLWantReadError:
+                    events = select.POLLIN
+                except ssl.SSLWantWriteError:
+                    events = select.POLLOUT
+            self._wait(events, deadline)
+
+    def _deadline(self) -> Optional[float]:
+        return None if self._timeout is None else time.monotonic() + self._timeout
+
+    def do_handshake(self):
+        self._call(self.sock.do_handshake, deadline=self._deadline())
+
+    def recv_into(self, buffer) -> int:
+        return self._call(self.sock.recv_into, buffer, deadline=self._deadline())
+
+    def recv(self, size: int) -> bytes:
+        return self._call(self.sock.recv, size, deadline=self._deadline())
+
+    def sendall(self, data: bytes):
+        # Writes block for as long as the peer takes to read, same as a plain socket with no timeout
+        view = memoryview(data)
+        while view:
+            # A write cut short by WantWrite is retried with the same bytes, as OpenSSL requires
+            view = view[self._call(self.sock.send, view):]
+
+    def pending(self) -> int:
+        """Bytes already decrypted and waiting to be read, which poll() on the socket doesn't see."""
+        with self._lock:
+            return self.sock.pending()
+
+    def shutdown(self, how: int):
+        # Only the TCP connection: a close_notify could need to wait on the network
+        socket.socket.shutdown(self.sock, how)
+
+    def close(self):
+        self.sock.close()
+
+    @property
+    def session(self) -> Optional[ssl.SSLSession]:
+        with self._lock:
+            return self.sock.session
+
+    @property
+    def session_reused(self) -> bool:
+        return self.sock.session_reused
+
+    def version(self) -> Optional[str]:
+        return self.sock.version()